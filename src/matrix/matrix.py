@@ -26,16 +26,33 @@
           Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
           02110-1301, USA.
 """
+import numpy as np
+import struct
 
+# Header for raw grid files: method, version, x size, y size, cell data type
+RAW_HEADER = struct.Struct('<Bfll3s')
+
+# .............................................................................
 class Grid(object):
    """
    @summary: Base class for Lifemapper grids.  This class can be used with 
                 uncompressed grids.
+   @note: The data can either be a list of lists or a 2-D NumPy array.  Arrays
+             are stored contiguously using the smallest unsigned type that
+             holds the class range (see findDtype)
    """
+   METHOD = 0
+   VERSION = 1.0
    # ...........................
-   def __init__(self, griddedData=None):
+   def __init__(self, griddedData=None, useArray=False):
+      """
+      @summary: Constructor
+      @param griddedData: (optional) A list of lists or a 2-D NumPy array
+      @param useArray: (optional) If True, store the data as a 2-D NumPy array 
+                          even if a list of lists is provided
+      """
       if griddedData is not None:
-         self._initFromGrid(griddedData)
+         self._initFromGrid(griddedData, useArray=useArray)
       else:
          self.ySize = None
          self.xSize = None
@@ -43,7 +60,12 @@ class Grid(object):
          self.classes = set([])
 
    # ...........................
-   def _initFromGrid(self, griddedData):
+   def _initFromGrid(self, griddedData, useArray=False):
+      if useArray or isinstance(griddedData, np.ndarray):
+         griddedData = np.asarray(griddedData)
+         if griddedData.size > 0:
+            griddedData = np.ascontiguousarray(griddedData, 
+                 dtype=findDtype(griddedData.min(), griddedData.max()))
       self.ySize = len(griddedData)
       self.xSize = len(griddedData[0])
       self.data = griddedData
@@ -54,27 +76,237 @@ class Grid(object):
       """
       @summary: Finds all of the unique classes in the data
       """
-      self.classes = set([])
+      if isinstance(self.data, np.ndarray):
+         if self.data.dtype in (np.uint8, np.uint16):
+            # Counting is linear time for small unsigned types
+            self.classes = set(np.flatnonzero(
+                                  np.bincount(self.data.ravel())).tolist())
+         else:
+            self.classes = set(np.unique(self.data).tolist())
+      else:
+         self.classes = set([])
+         for row in self.data:
+            for col in row:
+               self.classes.add(col)
+   
+   # ...........................
+   def isArray(self):
+      """
+      @summary: Returns True if the data is stored as a NumPy array
+      """
+      return isinstance(self.data, np.ndarray)
+   
+   # ...........................
+   def toArray(self):
+      """
+      @summary: Returns the data as a 2-D NumPy array.  If the data is already
+                   stored as an array, it is returned without copying
+      """
+      if isinstance(self.data, np.ndarray):
+         return self.data
+      arr = np.array(self.data)
+      return arr.astype(findDtype(arr.min(), arr.max()))
+   
+   # ...........................
+   def toPaddedArray(self, xSize, ySize):
+      """
+      @summary: Returns the data as a 2-D NumPy array padded with zeros on the 
+                   right and bottom so that it has the specified dimensions
+      @param xSize: The number of columns in the padded array
+      @param ySize: The number of rows in the padded array
+      """
+      arr = self.toArray()
+      if arr.shape == (ySize, xSize):
+         return arr
+      paddedArr = np.zeros((ySize, xSize), dtype=arr.dtype)
+      paddedArr[:arr.shape[0], :arr.shape[1]] = arr
+      return paddedArr
+   
+   # ...........................
+   def flatten(self):
+      """
+      @summary: Returns the data as a flat list in row-major order
+      """
+      if isinstance(self.data, np.ndarray):
+         return self.data.ravel().tolist()
+      lArray = []
       for row in self.data:
-         for col in row:
-            self.classes.add(col)
+         lArray.extend(row)
+      return lArray
+   
+   # ...........................
+   def toList(self):
+      """
+      @summary: Returns the data as a list of lists
+      """
+      if isinstance(self.data, np.ndarray):
+         return self.data.tolist()
+      return self.data
    
    # ...........................
    def query(self, x, y):
+      if isinstance(self.data, np.ndarray):
+         return int(self.data[y, x])
       return self.data[y][x]
 
    # ...........................
-   def read(self, fn):
-      self.data = []
-      with open(fn) as f:
-         for line in f:
-            self.data.append([int(i) for i in line.split(' ')])
+   def queryWindow(self, x0, y0, x1, y1):
+      """
+      @summary: Returns the values in a window of the grid
+      @param x0: The left edge of the window (inclusive)
+      @param y0: The top edge of the window (inclusive)
+      @param x1: The right edge of the window (exclusive)
+      @param y1: The bottom edge of the window (exclusive)
+      @return: A 2-D NumPy array with y1-y0 rows and x1-x0 columns
+      """
+      self._checkWindow(x0, y0, x1, y1)
+      if isinstance(self.data, np.ndarray):
+         return np.array(self.data[y0:y1, x0:x1])
+      return np.array([row[x0:x1] for row in self.data[y0:y1]], 
+                      dtype=np.int64).reshape(y1 - y0, x1 - x0)
 
    # ...........................
-   def write(self, fn):
-      with open(fn, 'w') as f:
-         for row in self.data:
-            f.write('%s\n' % ' '.join([str(i) for i in row]))
+   def queryMany(self, xs, ys):
+      """
+      @summary: Returns the values at many points of the grid
+      @param xs: An array of x coordinates
+      @param ys: An array of y coordinates, broadcast against xs
+      @return: A NumPy array of values with the broadcast shape of xs and ys
+      """
+      xs, ys = self._checkPoints(xs, ys)
+      return np.asarray(self.toArray()[ys, xs])
+
+   # ...........................
+   def classCounts(self, window=None):
+      """
+      @summary: Counts the cells of each class
+      @param window: (optional) An (x0, y0, x1, y1) window to count the cells
+                        of instead of the whole grid (see queryWindow)
+      @return: A dictionary of class to number of cells
+      """
+      if window is None:
+         return countValues(self.toArray())
+      return countValues(self.queryWindow(*window))
+
+   # ...........................
+   def count(self, value, window=None):
+      """
+      @summary: Counts the cells of one class
+      @param value: The class to count
+      @param window: (optional) An (x0, y0, x1, y1) window to count the cells
+                        of instead of the whole grid (see queryWindow)
+      """
+      return self.classCounts(window=window).get(value, 0)
+
+   # ...........................
+   def _checkPoints(self, xs, ys):
+      """
+      @summary: Checks that points are inside of the grid
+      @return: The x and y coordinates as broadcast integer arrays
+      """
+      xs, ys = np.broadcast_arrays(np.asarray(xs, dtype=np.int64), 
+                                   np.asarray(ys, dtype=np.int64))
+      if xs.size > 0 and (xs.min() < 0 or xs.max() >= self.xSize or 
+                          ys.min() < 0 or ys.max() >= self.ySize):
+         raise Exception, "Points must be inside of the grid"
+      return xs, ys
+
+   # ...........................
+   def _checkWindow(self, x0, y0, x1, y1):
+      """
+      @summary: Checks that a window is inside of the grid
+      """
+      if not (0 <= x0 <= x1 <= self.xSize and 0 <= y0 <= y1 <= self.ySize):
+         raise Exception, "Window (%s, %s, %s, %s) is outside of the grid" % (
+                                                              x0, y0, x1, y1)
+
+   # ...........................
+   def read(self, fn, useMmap=True):
+      """
+      @summary: Reads a grid from a file.  Raw binary files (see writeRaw) are
+                   detected by their header, anything else is read as space
+                   separated text
+      @param fn: The filename to read from
+      @param useMmap: (optional) Memory map raw files rather than reading them
+                         into memory
+      """
+      with open(fn, 'rb') as f:
+         isRaw = f.read(1) == struct.pack('<B', Grid.METHOD)
+      
+      if isRaw:
+         self.readRaw(fn, useMmap=useMmap)
+      else:
+         self.data = []
+         with open(fn) as f:
+            for line in f:
+               self.data.append([int(i) for i in line.split(' ')])
+         self.ySize = len(self.data)
+         self.xSize = len(self.data[0])
+         self.findClasses()
+
+   # ...........................
+   def readRaw(self, fn, useMmap=True):
+      """
+      @summary: Reads a grid written by writeRaw
+      @param fn: The filename to read from
+      @param useMmap: (optional) If True, the data is memory mapped read-only so
+                         queries and row slices are read from the page cache
+                         on demand.  If False, the data is read into memory
+      """
+      with open(fn, 'rb') as f:
+         method, version, self.xSize, self.ySize, dtStr = RAW_HEADER.unpack(
+                                                     f.read(RAW_HEADER.size))
+         dt = np.dtype(dtStr)
+         
+         # Classes are stored after the cells so that they can be read without
+         #    touching the data
+         f.seek(RAW_HEADER.size + self.xSize * self.ySize * dt.itemsize)
+         nClasses = struct.unpack('<L', f.read(4))[0]
+         self.classes = set(struct.unpack('<%sl' % nClasses, 
+                                          f.read(4 * nClasses)))
+         
+         if useMmap:
+            self.data = np.memmap(fn, dtype=dt, mode='r', 
+                                  offset=RAW_HEADER.size, 
+                                  shape=(self.ySize, self.xSize))
+         else:
+            f.seek(RAW_HEADER.size)
+            self.data = np.fromfile(f, dtype=dt, 
+                        count=self.xSize * self.ySize).reshape(self.ySize, 
+                                                               self.xSize)
+
+   # ...........................
+   def write(self, fn, raw=False):
+      """
+      @summary: Writes the grid to a file
+      @param fn: The filename to write to
+      @param raw: (optional) If True, write the headered binary format (see
+                     writeRaw) instead of space separated text
+      """
+      if raw:
+         self.writeRaw(fn)
+      else:
+         with open(fn, 'w') as f:
+            for row in self.data:
+               f.write('%s\n' % ' '.join([str(i) for i in row]))
+
+   # ...........................
+   def writeRaw(self, fn):
+      """
+      @summary: Writes the grid as little-endian binary cells following a 
+                   fixed size header so that the file can be memory mapped
+      @param fn: The filename to write to
+      """
+      arr = self.toArray()
+      arr = arr.astype(arr.dtype.newbyteorder('<'), copy=False)
+      classes = sorted(self.classes)
+      
+      with open(fn, 'wb') as f:
+         f.write(RAW_HEADER.pack(Grid.METHOD, Grid.VERSION, self.xSize, 
+                                 self.ySize, arr.dtype.str))
+         f.write(np.ascontiguousarray(arr).tobytes())
+         f.write(struct.pack('<L', len(classes)))
+         f.write(struct.pack('<%sl' % len(classes), *classes))
 
 # .............................................................................
 class _CompressedGrid(Grid):
@@ -86,6 +318,27 @@ class _CompressedGrid(Grid):
    def query(self, x, y):
       raise Exception, "Query must be implemented in sub class"
    
+   # ...........................
+   def queryWindow(self, x0, y0, x1, y1):
+      raise Exception, "Query window must be implemented in sub class"
+   
+   # ...........................
+   def queryMany(self, xs, ys):
+      raise Exception, "Query many must be implemented in sub class"
+   
+   # ...........................
+   def classCounts(self, window=None):
+      """
+      @summary: Counts the cells of each class from the values of a window.  
+                   Sub classes count from their runs or leaves instead
+      @param window: (optional) An (x0, y0, x1, y1) window to count the cells
+                        of instead of the whole grid (see queryWindow)
+      @return: A dictionary of class to number of cells
+      """
+      if window is None:
+         window = (0, 0, self.xSize, self.ySize)
+      return countValues(self.queryWindow(*window))
+   
    # ...........................
    def read(self, fn):
       raise Exception, "Read must be implemented in sub class"   
@@ -94,3 +347,42 @@ class _CompressedGrid(Grid):
    def write(self, fn):
       raise Exception, "Write must be implemented in sub class"
       
+
+# .............................................................................
+def findDtype(minV, maxV):
+   """
+   @summary: Finds the smallest integer data type that can hold the range of 
+                classes in a grid.  Unsigned 8 or 16 bit types are preferred
+   @param minV: The minimum class value
+   @param maxV: The maximum class value
+   """
+   if minV >= 0 and maxV < 2**8:
+      return np.uint8
+   elif minV >= 0 and maxV < 2**16:
+      return np.uint16
+   else:
+      return np.promote_types(np.min_scalar_type(int(minV)), 
+                              np.min_scalar_type(int(maxV)))
+
+# .............................................................................
+def countValues(values, weights=None):
+   """
+   @summary: Counts how many cells hold each value
+   @param values: An array of values
+   @param weights: (optional) An array with the number of cells that each 
+                      value stands for, one each by default
+   @return: A dictionary of value to number of cells, without zero counts
+   """
+   values = np.asarray(values).ravel()
+   if values.size == 0:
+      return {}
+   if values.dtype in (np.uint8, np.uint16):
+      # Counting is linear time for small unsigned types
+      counts = np.bincount(values, weights=weights)
+      classes = np.flatnonzero(counts)
+      counts = counts[classes]
+   else:
+      classes, ids = np.unique(values, return_inverse=True)
+      counts = np.bincount(ids, weights=weights)
+   return dict([(cl, int(num)) for cl, num in zip(classes.tolist(), 
+                                                  counts.tolist()) if num > 0])
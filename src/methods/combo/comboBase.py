@@ -29,8 +29,39 @@
           Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
           02110-1301, USA.
 """
+import numpy as np
+import struct
 
-from matrix.matrix import _CompressedGrid
+from matrix.matrix import _CompressedGrid, countValues, Grid
+from methods.rle.hilbert import CompactHilbertRLECompressedGrid, \
+                                HilbertRLECompressedGrid
+from methods.rle.morton import MortonRLECompressedGrid
+from methods.rle.normal import NormalRLECompressedGrid
+from methods.rle.rleBase import idsToRuns, packedRunSizes, packRuns
+from methods.trees.treeBase import valueBits
+
+# Header for combination files: method, version, run length encoding method,
+#    run length encoding version, x size, y size
+COMBO_HEADER = struct.Struct('<BfBfll')
+
+# Node type bytes of combination files.  Leaves of mixed files (see 
+#    MIXED_METHODS) that are run length encoded add the METHOD of their 
+#    encoding to MIXED_RLE_NODE
+VALUE_NODE = 1
+RLE_NODE = 2
+INTERNAL_NODE = 3
+RAW_NODE = 4
+MIXED_RLE_NODE = 16
+
+# The default candidates for leaves that pick their own encoding.  Grid leaves
+#    are stored raw, with the fewest bits per cell
+MIXED_METHODS = (NormalRLECompressedGrid, HilbertRLECompressedGrid, Grid)
+
+# Run length encoding methods that can be used for the leaves, by METHOD
+RLE_METHODS = dict([(m.METHOD, m) for m in [NormalRLECompressedGrid, 
+                                            HilbertRLECompressedGrid, 
+                                            CompactHilbertRLECompressedGrid,
+                                            MortonRLECompressedGrid]])
 
 # .............................................................................
 class _ComboCompressionBaseClass(_CompressedGrid):
@@ -38,7 +69,7 @@ class _ComboCompressionBaseClass(_CompressedGrid):
    @summary: This is the base class for two-stage compression algorithms
    """
    # .............................
-   def __init__(self, rleMethod, orderThreshold=8, grid=None):
+   def __init__(self, rleMethod, orderThreshold=8, grid=None, executor=None):
       """
       @summary: Base class constructor for combination (two-stage) compression
       @param rleMethod: This is the run-length encoding compression method to 
@@ -46,20 +77,301 @@ class _ComboCompressionBaseClass(_CompressedGrid):
       @param orderThreshold: (optional: default=8), once there are fewer than
                                 two to this number elements (2^orderThreshold)
                                 in the grid section, switch to the run-length
-                                encoding method.
+                                encoding method
       @param grid: (optional) A Grid to compress 
+      @param executor: (optional) Used to compress the run-length encoded 
+                          sections of the grid in parallel (see compress)
       """
       self.rleMethod = rleMethod
-      self.threshold = 2**orderThreshold
+      self.orderThreshold = orderThreshold
+      self.threshold = self._findThreshold(orderThreshold)
       if grid is not None:
-         self.compress(grid)
+         self.compress(grid, executor=executor)
       else:
          self._initialize()
    
+   # .............................
+   def _findThreshold(self, orderThreshold):
+      """
+      @summary: Returns the number of cells at or below which a section is 
+                   run-length encoded.  Sub-classes may accept other order 
+                   thresholds
+      @param orderThreshold: The order threshold passed to the constructor
+      """
+      try:
+         return 2**orderThreshold
+      except TypeError:
+         raise Exception, "Invalid order threshold: %s" % orderThreshold
+   
    # .............................
    def _initialize(self):
       """
       @summary: Use this method in sub-classes to initialize any variables
       """
       pass
-   
\ No newline at end of file
+   
+
+# .............................................................................
+def compressLeaf(args):
+   """
+   @summary: Run-length encodes one section of a grid.  This is a module level
+                function so that it can be sent to a process pool
+   @param args: A (run-length encoding class, 2-D array) pair.  If a list of
+                   candidates is given instead of a class (see 
+                   MIXED_METHODS), the smallest encoding is kept
+   """
+   rleMethod, mtx = args
+   if not isMixed(rleMethod):
+      return rleMethod(grid=Grid(griddedData=mtx))
+   
+   leaves = []
+   for method in rleMethod:
+      if method is Grid:
+         leaves.append(Grid(griddedData=mtx))
+      else:
+         leaves.append(method(grid=Grid(griddedData=mtx)))
+   sizes = [leafSize(leaf) for leaf in leaves]
+   return leaves[sizes.index(min(sizes))]
+
+# .............................................................................
+def leafSize(leaf):
+   """
+   @summary: Returns the number of bytes used to write a leaf, not counting
+                its type byte or the shared classes
+   @param leaf: A run length encoded grid or a Grid for a raw leaf
+   """
+   if not isinstance(leaf, _CompressedGrid):
+      return len(packRawLeaf(leaf.toArray()))
+   vals, counts, tail = leaf._getRuns()
+   size = packedRunSizes(counts).sum()
+   if tail is not None:
+      size += packedRunSizes([tail[1]]).sum()
+   return int(size)
+
+# .............................................................................
+def assignLeafClassIds(leaves):
+   """
+   @summary: Assigns a one byte identifier to each distinct run tuple of a 
+                list of leaves.  The most frequent tuples get the lowest 
+                identifiers, ties go to the tuple that appears first
+   @param leaves: A list of leaves, raw leaves are skipped
+   @return: A dictionary of tuple to identifier
+   """
+   clCounts = {}
+   firstSeen = []
+   for leaf in leaves:
+      if isinstance(leaf, _CompressedGrid):
+         for cl, _ in leaf.cmpData:
+            if not clCounts.has_key(cl):
+               clCounts[cl] = 0
+               firstSeen.append(cl)
+            clCounts[cl] += 1
+   
+   # Sorting is stable so ties stay in the order they were first seen
+   sortedClasses = sorted(firstSeen, key=lambda cl: clCounts[cl], 
+                          reverse=True)
+   
+   #   Zero is reserved for the separator
+   if len(sortedClasses) > 255:
+      raise Exception, "Too many distinct runs (%s) to store" % len(
+                                                                 sortedClasses)
+   return dict([(cl, i + 1) for i, cl in enumerate(sortedClasses)])
+
+# .............................................................................
+def packLeaf(leaf, clIds, mixed):
+   """
+   @summary: Packs an encoded leaf, starting with its type byte
+   @param leaf: A run length encoded grid or a Grid for a raw leaf
+   @param clIds: A dictionary of run tuple to class identifier
+   @param mixed: If True, run length encoded leaves record their method in 
+                    the type byte
+   """
+   if not isinstance(leaf, _CompressedGrid):
+      return struct.pack('<B', RAW_NODE) + packRawLeaf(leaf.toArray())
+   
+   if mixed:
+      nodeType = MIXED_RLE_NODE + leaf.METHOD
+   else:
+      nodeType = RLE_NODE
+   cmpData = leaf.cmpData
+   runIds = np.array([clIds[cl] for cl, _ in cmpData], dtype=np.uint8)
+   counts = np.array([num for _, num in cmpData], dtype=np.int64)
+   return struct.pack('<B', nodeType) + packRuns(runIds, counts)
+
+# .............................................................................
+def unpackLeaf(buf, pos, nodeType, xSize, ySize, rleMethod, rleLeaves):
+   """
+   @summary: Unpacks an encoded leaf following its type byte.  Run length 
+                encoded leaves are added to rleLeaves so that their runs can 
+                be set once the classes have been read (see setLeafRuns)
+   @param buf: A string holding the file contents
+   @param pos: The offset of the leaf, after its type byte
+   @param nodeType: The type byte of the leaf
+   @param xSize: The number of columns in the leaf
+   @param ySize: The number of rows in the leaf
+   @param rleMethod: The run length encoding class from the header, used for
+                        leaves that do not record their own
+   @param rleLeaves: A list of (leaf, class identifiers, counts) tuples
+   @return: The leaf and the offset following it
+   """
+   if nodeType == RAW_NODE:
+      cells, pos = unpackRawLeaf(buf, pos, xSize, ySize)
+      return Grid(griddedData=cells), pos
+   
+   if nodeType == RLE_NODE:
+      leaf = rleMethod()
+   elif nodeType > MIXED_RLE_NODE:
+      leaf = getRLEMethod(nodeType - MIXED_RLE_NODE)()
+   else:
+      raise Exception, "Unknown leaf type: %s" % nodeType
+   leaf._setSize(xSize, ySize)
+   runIds, counts, pos = unpackLeafRuns(buf, pos, leaf._linearLength(), 
+                                        leaf.RUN_WIDTH)
+   rleLeaves.append((leaf, runIds, counts))
+   return leaf, pos
+
+# .............................................................................
+def countLeafClasses(values, areas, leafWindows):
+   """
+   @summary: Combines the cells of the uniform sections of a tree and of its
+                encoded leaves into class counts
+   @param values: An array with the value of each uniform section
+   @param areas: An array with the number of cells of each uniform section
+                    to count
+   @param leafWindows: A list of (leaf, window) pairs for the encoded leaves.
+                          The window is relative to the leaf, or None to 
+                          count the whole leaf from its runs
+   @return: A dictionary of class to number of cells
+   """
+   counts = countValues(values, areas)
+   for leaf, window in leafWindows:
+      for cl, num in leaf.classCounts(window=window).iteritems():
+         counts[cl] = counts.get(cl, 0) + num
+   return counts
+
+# .............................................................................
+def getRLEMethod(method):
+   """
+   @summary: Returns the run length encoding class for a METHOD identifier
+   @param method: The METHOD of the run length encoding class
+   """
+   if not RLE_METHODS.has_key(method):
+      raise Exception, "Unknown run length encoding method: %s" % method
+   return RLE_METHODS[method]
+
+# .............................................................................
+def isMixed(rleMethod):
+   """
+   @summary: Returns True if each leaf picks its encoding from a list of 
+                candidates rather than using a single run length encoding
+   @param rleMethod: A run length encoding class or a list of candidates
+   """
+   return isinstance(rleMethod, (list, tuple))
+
+# .............................................................................
+def packRawLeaf(mtx):
+   """
+   @summary: Packs the cells of a raw leaf.  The distinct values of the leaf 
+                are written first, then the index of the value of each cell,
+                in row-major order, with the fewest bits needed
+   @param mtx: A 2-D NumPy array with the cells of the leaf
+   """
+   cells = np.asarray(mtx).ravel()
+   vals = np.unique(cells)
+   nBits = valueBits(len(vals))
+   ids = np.searchsorted(vals, cells)
+   bits = (ids[:, np.newaxis] >> np.arange(nBits - 1, -1, -1)) & 1
+   return ''.join([struct.pack('<B%sB' % len(vals), len(vals), 
+                               *vals.tolist()),
+                   np.packbits(bits.astype(np.uint8).ravel()).tobytes()])
+
+# .............................................................................
+def unpackRawLeaf(buf, pos, xSize, ySize):
+   """
+   @summary: Unpacks a raw leaf written by packRawLeaf
+   @param buf: A string holding the packed leaf
+   @param pos: The offset of the leaf in the buffer
+   @param xSize: The number of columns in the leaf
+   @param ySize: The number of rows in the leaf
+   @return: A 2-D NumPy array with the cells of the leaf and the offset 
+               following the leaf
+   """
+   numVals = struct.unpack_from('<B', buf, pos)[0]
+   vals = np.frombuffer(buf, dtype=np.uint8, count=numVals, offset=pos + 1)
+   pos += 1 + numVals
+   
+   nBits = valueBits(numVals)
+   numBytes = (xSize * ySize * nBits + 7) / 8
+   bits = np.unpackbits(np.frombuffer(buf, dtype=np.uint8, count=numBytes, 
+                                      offset=pos))
+   ids = bits[:xSize * ySize * nBits].reshape(-1, nBits).dot(
+                  1 << np.arange(nBits - 1, -1, -1, dtype=np.int64))
+   return vals[ids].reshape(ySize, xSize), pos + numBytes
+
+# .............................................................................
+def unpackLeafRuns(buf, pos, numCells, runWidth):
+   """
+   @summary: Unpacks the runs of a run length encoded leaf.  Leaves do not 
+                end with a separator, so runs are read until they cover all 
+                of the cells of the leaf
+   @param buf: A string holding the packed runs
+   @param pos: The offset of the first run in the buffer
+   @param numCells: The number of cells in the linear array of the leaf
+   @param runWidth: The number of cells in each run tuple
+   @return: A list of class identifiers, a list with the number of 
+               repetitions of each run and the offset following the runs
+   """
+   runIds = []
+   counts = []
+   # A shorter, final run counts as one group
+   numGroups = (numCells + runWidth - 1) / runWidth
+   while numGroups > 0:
+      clId, num = struct.unpack_from('<BB', buf, pos)
+      pos += 2
+      if num == 0:
+         # Wider repetition count
+         num = struct.unpack_from('<H', buf, pos)[0]
+         pos += 2
+         if num == 0:
+            num = struct.unpack_from('<L', buf, pos)[0]
+            pos += 4
+      runIds.append(clId)
+      counts.append(num)
+      numGroups -= num
+   return runIds, counts, pos
+
+# .............................................................................
+def setLeafRuns(leaves, clDict):
+   """
+   @summary: Sets the runs of run length encoded leaves from their class 
+                identifiers and the class dictionary shared by all of them
+   @param leaves: A list of (leaf, class identifiers, counts) tuples
+   @param clDict: A dictionary of class identifier to tuple
+   """
+   # Translate the identifiers of all of the leaves with the same run width
+   #    together.  The few leaves with a shorter, final run are translated on
+   #    their own
+   widthLeaves = {}
+   for leaf, runIds, counts in leaves:
+      if leaf._linearLength() % leaf.RUN_WIDTH:
+         leaf._setRuns(idsToRuns(np.array(runIds, dtype=np.uint8), 
+                                 np.array(counts, dtype=np.int64), clDict))
+      else:
+         widthLeaves.setdefault(leaf.RUN_WIDTH, []).append(
+                                                      (leaf, runIds, counts))
+   
+   for sameLeaves in widthLeaves.itervalues():
+      ends = np.cumsum([len(runIds) for _, runIds, _ in sameLeaves]).tolist()
+      allIds = np.zeros(ends[-1], dtype=np.uint8)
+      allCounts = np.zeros(ends[-1], dtype=np.int64)
+      start = 0
+      for (_, runIds, counts), end in zip(sameLeaves, ends):
+         allIds[start:end] = runIds
+         allCounts[start:end] = counts
+         start = end
+      vals, allCounts, _ = idsToRuns(allIds, allCounts, clDict)
+      
+      start = 0
+      for (leaf, _, _), end in zip(sameLeaves, ends):
+         leaf._setRuns((vals[start:end], allCounts[start:end], None))
+         start = end
@@ -28,13 +28,29 @@
           Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
           02110-1301, USA.
 """
+import numpy as np
 import struct
+import time
 
-from matrix.matrix import _CompressedGrid, Grid
-from methods.combo.comboBase import _ComboCompressionBaseClass
+from matrix.matrix import _CompressedGrid, Grid, findDtype
+from methods.combo.comboBase import _ComboCompressionBaseClass, \
+                                    assignLeafClassIds, COMBO_HEADER, \
+                                    compressLeaf, countLeafClasses, \
+                                    getRLEMethod, INTERNAL_NODE, isMixed, \
+                                    MIXED_METHODS, packLeaf, setLeafRuns, \
+                                    unpackLeaf, VALUE_NODE
+from methods.rle.morton import pointsToMorton
+from methods.rle.rleBase import countDistinctGroups, encodeRowRuns, \
+                                packClasses, packedRunSizes, unpackClasses
+from methods.trees.linearQuadTree import findUniformBlocks
+from methods.trees.quadTree import linkQuadtree
 
 from methods.rle.hilbert import HilbertRLECompressedGrid
 
+# The number of cells in each chunk of blocks that QuadtreeComboSweep sends to
+#    an executor
+CELLS_PER_CHUNK = 2**20
+
 # .............................................................................
 class QuadtreeComboCompressedGrid(_ComboCompressionBaseClass):
    """
@@ -45,6 +61,47 @@ class QuadtreeComboCompressedGrid(_ComboCompressionBaseClass):
    METHOD = 5
    VERSION = 2.0
    
+   # ...........................
+   def __init__(self, rleMethod, orderThreshold=8, grid=None, executor=None,
+                timeBudget=None, sizeBudget=None):
+      """
+      @summary: Constructor
+      @param rleMethod: This is the run-length encoding compression method to 
+                           use once the threshold is reached
+      @param orderThreshold: (optional: default=8), once there are fewer than
+                                two to this number elements (2^orderThreshold)
+                                in the grid section, switch to the run-length
+                                encoding method.  If 'auto', the order 
+                                threshold with the smallest estimated size 
+                                is picked for each grid that is compressed
+      @param grid: (optional) A Grid to compress 
+      @param executor: (optional) Used to compress the run-length encoded 
+                          sections of the grid in parallel (see compress)
+      @param timeBudget: (optional) With an 'auto' threshold, stop trying 
+                            thresholds after this many seconds
+      @param sizeBudget: (optional) With an 'auto' threshold, stop trying 
+                            thresholds once one is estimated to take no more
+                            than this many bytes
+      """
+      self.timeBudget = timeBudget
+      self.sizeBudget = sizeBudget
+      _ComboCompressionBaseClass.__init__(self, rleMethod, 
+                                          orderThreshold=orderThreshold, 
+                                          grid=grid, executor=executor)
+   
+   # ...........................
+   def _findThreshold(self, orderThreshold):
+      """
+      @summary: Returns the number of cells at or below which a section is 
+                   run-length encoded, or None for an 'auto' threshold, which
+                   is set when a grid is compressed
+      @param orderThreshold: The order threshold passed to the constructor
+      """
+      if orderThreshold == 'auto':
+         return None
+      return _ComboCompressionBaseClass._findThreshold(self, orderThreshold)
+   
+   # ...........................
    def _initialize(self):
       self.cmpData = {}
       self.xSize = None
@@ -52,7 +109,18 @@ class QuadtreeComboCompressedGrid(_ComboCompressionBaseClass):
       self.order = 0
 
    # ...........................
-   def compress(self, mtx):
+   def compress(self, mtx, executor=None):
+      """
+      @summary: Compresses a Grid
+      @param mtx: The Grid to compress
+      @param executor: (optional) An object with a map method, such as a 
+                          multiprocessing Pool, used to run-length encode the
+                          sections below the threshold in parallel.  The 
+                          result is the same as compressing serially.  With
+                          an 'auto' threshold or leaves that pick their own 
+                          encoding, the blocks are encoded in chunks with it
+                          (see QuadtreeComboSweep)
+      """
       self.cmpData = {}
       self.xSize = mtx.xSize
       self.ySize = mtx.ySize
@@ -65,161 +133,558 @@ class QuadtreeComboCompressedGrid(_ComboCompressionBaseClass):
       while 2**self.order < max([self.xSize, self.ySize]):
          self.order += 1
       
-      sqMtx = []
-      for row in mtx.data:
-         sqMtx.append(row + (2**self.order - len(row)) * [0])
-      for i in xrange(len(sqMtx), 2**self.order):
-         sqMtx.append(2**self.order * [0])
+      if self.orderThreshold == 'auto' or isMixed(self.rleMethod):
+         sweep = QuadtreeComboSweep(mtx, executor=executor)
+         orderThreshold = self.orderThreshold
+         if orderThreshold == 'auto':
+            orderThreshold = sweep.bestThreshold(self.rleMethod, 
+                                                 timeBudget=self.timeBudget, 
+                                                 sizeBudget=self.sizeBudget)
+            self.threshold = 2**orderThreshold
+         self.cmpData = sweep.compress(self.rleMethod, orderThreshold).cmpData
+         return
+      
+      sqMtx = mtx.toPaddedArray(2**self.order, 2**self.order)
       
-      self.cmpData = quadtreeComboCompress(sqMtx, self.rleMethod, self.threshold)
+      self.cmpData = quadtreeComboCompress(sqMtx, self.rleMethod, self.threshold,
+                                           executor=executor)
    
    # ...........................
    def decompress(self):
-      data = quadtreeComboDecompress(self.cmpData, self.xSize)
-      mtx = Grid(griddedData=data)
+      data = quadtreeComboDecompress(self.cmpData, 2**self.order)
+      mtx = Grid(griddedData=[row[:self.xSize] for row in data[:self.ySize]])
       return mtx
 
+   # ...........................
+   def query(self, x, y):
+      """
+      @summary: Queries the compressed grid to find the value at the specified
+                   coordinates.  Run length encoded leaves are queried with 
+                   the coordinates relative to the leaf
+      @param x: The x (horizontal) coordinate, starts from the left, zero-based
+      @param y: The y (vertical) coordinate, starts at the top, zero-based
+      """
+      minX = minY = 0
+      maxX = maxY = 2**self.order
+      
+      val = self.cmpData
+      
+      while isinstance(val, dict):
+         cmpX = (maxX+minX) / 2
+         cmpY = (maxY+minY) / 2
+         if x < cmpX and y < cmpY:
+            maxX = cmpX
+            maxY = cmpY
+            val = val[1]
+         elif x < cmpX:
+            maxX = cmpX
+            minY = cmpY
+            val = val[3]
+         elif y < cmpY:
+            minX = cmpX
+            maxY = cmpY
+            val = val[2]
+         else:
+            minX = cmpX
+            minY = cmpY
+            val = val[4]
+      
+      if isinstance(val, Grid):
+         return val.query(x - minX, y - minY)
+      return val
+
+   # ...........................
+   def queryWindow(self, x0, y0, x1, y1):
+      """
+      @summary: Queries the compressed grid for all of the values in a window.
+                   Only the subtrees that intersect the window are visited
+      @param x0: The left edge of the window (inclusive)
+      @param y0: The top edge of the window (inclusive)
+      @param x1: The right edge of the window (exclusive)
+      @param y1: The bottom edge of the window (exclusive)
+      @return: A 2-D NumPy array with y1-y0 rows and x1-x0 columns
+      """
+      self._checkWindow(x0, y0, x1, y1)
+      ret = np.zeros((y1 - y0, x1 - x0), dtype=np.int64)
+      quadtreeComboQueryWindow(self.cmpData, ret, x0, y0, x1, y1, 0, 0, 
+                               2**self.order)
+      if ret.size > 0:
+         ret = ret.astype(findDtype(ret.min(), ret.max()))
+      return ret
+   
+   # ...........................
+   def queryMany(self, xs, ys):
+      """
+      @summary: Queries the compressed grid for the values at many points.  
+                   The points are sorted into the order that the tree stores
+                   its leaves so that each node is visited at most once and
+                   each run length encoded leaf is queried once for all of 
+                   its points
+      @param xs: An array of x coordinates
+      @param ys: An array of y coordinates, broadcast against xs
+      @return: A NumPy array of values with the broadcast shape of xs and ys
+      """
+      xs, ys = self._checkPoints(xs, ys)
+      codes = pointsToMorton(xs, ys).ravel()
+      order = np.argsort(codes)
+      
+      vals = np.zeros(codes.shape, dtype=np.int64)
+      quadtreeComboQueryMany(self.cmpData, codes[order], xs.ravel()[order], 
+                             ys.ravel()[order], vals, 0, len(vals), 0, 0, 0, 
+                             2**self.order)
+      
+      ret = np.empty_like(vals)
+      ret[order] = vals
+      if ret.size > 0:
+         ret = ret.astype(findDtype(ret.min(), ret.max()))
+      return ret.reshape(xs.shape)
+   
+   # ...........................
+   def classCounts(self, window=None):
+      """
+      @summary: Counts the cells of each class from the sizes of the uniform
+                   sections and the runs of the encoded leaves.  Only the 
+                   leaves cut by the window or the edge of the grid are 
+                   counted cell by cell
+      @param window: (optional) An (x0, y0, x1, y1) window to count the cells
+                        of instead of the whole grid (see queryWindow)
+      @return: A dictionary of class to number of cells
+      """
+      if window is None:
+         window = (0, 0, self.xSize, self.ySize)
+      self._checkWindow(*window)
+      return countLeafClasses(*quadtreeComboLeafAreas(self.cmpData, window, 
+                                                      2**self.order))
+   
+   # ...........................
+   def read(self, fn):
+      """
+      @summary: Reads in the compressed grid from a file
+      @param fn: The filename to read from
+      """
+      with open(fn, 'rb') as f:
+         buf = f.read()
+      
+      (method, version, rleMethod, rleVersion, self.xSize, 
+       self.ySize) = COMBO_HEADER.unpack_from(buf)
+      if rleMethod == 0:
+         # Each leaf picked its own encoding
+         self.rleMethod = MIXED_METHODS
+      else:
+         self.rleMethod = getRLEMethod(rleMethod)
+      
+      self.order = 0
+      while 2**self.order < max([self.xSize, self.ySize]):
+         self.order += 1
+      
+      self.cmpData, leaves, pos = unpackData(buf, COMBO_HEADER.size, 
+                                             2**self.order, self.rleMethod)
+      
+      # Classes follow the separator
+      setLeafRuns(leaves, unpackClasses(buf, pos + 1))
+   
    # ...........................
    def write(self, fn):
       """
-      @summary: Writes out the compressed grid
+      @summary: Writes out the compressed grid.  The tree is written in 
+                   pre-order, followed by a separator and the classes of the
+                   run length encoded leaves
       @param fn: The filename to write to
       """
-       
-      # ...........................
-      # Find categories
+      leaves = []
+      nodes = []
+      stack = [self.cmpData]
+      while stack:
+         node = stack.pop()
+         nodes.append(node)
+         if isinstance(node, dict):
+            stack.extend([node[4], node[3], node[2], node[1]])
+         elif isinstance(node, Grid):
+            leaves.append(node)
+      
+      clIds = assignLeafClassIds(leaves)
+      mixed = isMixed(self.rleMethod)
+      
+      # Mixed files have zero for the RLE method and version
+      if mixed:
+         parts = [COMBO_HEADER.pack(self.METHOD, self.VERSION, 0, 0.0, 
+                                    self.xSize, self.ySize)]
+      else:
+         parts = [COMBO_HEADER.pack(self.METHOD, self.VERSION, 
+                                    self.rleMethod.METHOD, 
+                                    self.rleMethod.VERSION, 
+                                    self.xSize, self.ySize)]
       
-      # Find all classes
-      clDict = {}
-       
-      def findCategories(d):
-         cats = {}
-         if isinstance(d, int):
-            return {}
-         elif isinstance(d, _CompressedGrid):
-            # Do stuff here
-            for cl, _ in d.cmpData:
-               if cats.has_key(cl):
-                  cats[cl] += 1
-               else:
-                  cats[cl] = 1
+      for node in nodes:
+         if isinstance(node, int):
+            parts.append(struct.pack('<BB', VALUE_NODE, node))
+         elif isinstance(node, Grid):
+            parts.append(packLeaf(node, clIds, mixed))
          else:
-            dicts = [findCategories(d[1]),
-                     findCategories(d[2]),
-                     findCategories(d[3]),
-                     findCategories(d[4])]
-            for catDict in dicts:
-               for k in catDict.keys():
-                  if cats.has_key(k):
-                     cats[k] += catDict[k]
-                  else:
-                     cats[k] = catDict[k]
-         return cats
-          
-      clDict = findCategories(self.cmpData)
-       
-      sortedClasses = sorted(list(clDict.viewitems()), key=lambda k: k[1], reverse=True)
-       
-      #   Assign them ids
-      clIds = {}
-      i = 0
-      for cl, _ in sortedClasses:
-         i += 1
-         clIds[cl] = i
-         
-      # Write out results
+            parts.append(struct.pack('<B', INTERNAL_NODE))
+      
+      # Classes follow a separator
+      parts.append(struct.pack('<B', 0))
+      parts.append(packClasses(clIds))
+      
       with open(fn, 'wb') as f:
-         # Write method
-         f.write(struct.pack('<B', self.METHOD))
-         # Write version
-         f.write(struct.pack('<f', self.VERSION))
-         
-         # RLE method and version
-         f.write(struct.pack('<B', self.rleMethod.METHOD))
-         f.write(struct.pack('<f', self.rleMethod.VERSION))
-         
-         # Write x size and y size
-         f.write(struct.pack('<l', self.xSize))
-         f.write(struct.pack('<l', self.ySize))
-         
-         
-         def packData(data, f):
-            if isinstance(data, int):
-               f.write(struct.pack('<B', 1))
-               f.write(struct.pack('<B', data))
-            elif isinstance(data, _CompressedGrid):
-               f.write(struct.pack('<B', 2))
+         f.write(''.join(parts))
+      
+# .............................................................................
+class QuadtreeComboSweep(object):
+   """
+   @summary: Builds the quadtree of a grid once, with the uniform blocks of 
+                every level, so that it can be cut at any threshold.  Each 
+                cut gives the same QuadtreeComboCompressedGrid as compressing
+                the grid with that threshold and run-length encoding method
+   """
+   # ...........................
+   def __init__(self, grid, executor=None):
+      """
+      @summary: Constructor
+      @param grid: The Grid to compress
+      @param executor: (optional) An object with a map method, such as a 
+                          multiprocessing Pool, used to encode and size the 
+                          blocks of a level in chunks in parallel.  The map 
+                          must return the results in order
+      """
+      self.executor = executor
+      self.xSize = grid.xSize
+      self.ySize = grid.ySize
+      
+      self.order = 0
+      while 2**self.order < max([self.xSize, self.ySize]):
+         self.order += 1
+      
+      sqMtx = grid.toPaddedArray(2**self.order, 2**self.order)
+      self.uniform, self.blockVals = findUniformBlocks(sqMtx)
+      
+      # Cells of the blocks that are not uniform, by level, and their runs, 
+      #    by method and level
+      self._blocks = {}
+      self._runs = {}
+
+   # ...........................
+   def cutLevel(self, orderThreshold):
+      """
+      @summary: Returns the level of the blocks that are run-length encoded 
+                   for a threshold.  Blocks at this level have sides of 
+                   2**level and are the largest blocks with no more than 
+                   2**orderThreshold cells
+      @param orderThreshold: The order threshold (see 
+                                _ComboCompressionBaseClass)
+      """
+      return min(orderThreshold / 2, self.order)
 
-               # Might need to write x and y sizes
-               # Write data
-               for cl, num in data.cmpData:
-                  # Write out class identifier
-                  f.write(struct.pack('<B', clIds[cl]))
-            
-                  # Bit twidding based on run-length, if over threshold, we need to 
-                  #   write it out with more bytes.  We need to indicate this though
-                  #   so that it can be handled on read
-                  if num < 256:
-                     f.write(struct.pack('<B', num))
-                  elif num < 65536:
-                     # Write indicator to bump up size
-                     f.write(struct.pack('<B', 0))
-                     # Write number
-                     f.write(struct.pack('<H', num))
-                  else:
-                     # Write indicator to bump up twice
-                     f.write(struct.pack('<B', 0))
-                     f.write(struct.pack('<H', 0))
-                     # Write number
-                     f.write(struct.pack('<L', num))
+   # ...........................
+   def compress(self, rleMethod, orderThreshold=8):
+      """
+      @summary: Cuts the tree for a threshold and encodes the blocks at the 
+                   cut that are not uniform
+      @param rleMethod: The run-length encoding class to use, or a list of 
+                           candidates for each block to pick the smallest 
+                           encoding from (see MIXED_METHODS)
+      @param orderThreshold: (optional) The order threshold (see 
+                                _ComboCompressionBaseClass)
+      @return: A QuadtreeComboCompressedGrid
+      """
+      level = self.cutLevel(orderThreshold)
+      side = 2**level
       
-            else:
-               f.write(struct.pack('<B', 3))
-               packData(data[1], f)
-               packData(data[2], f)
-               packData(data[3], f)
-               packData(data[4], f)
+      nodes = None
+      if level > 0:
+         methods = list(rleMethod) if isMixed(rleMethod) else [rleMethod]
+         choices = self._chooseEncodings(methods, level)[0]
+         nodes = np.empty(len(choices), dtype=object)
+         for m, method in enumerate(methods):
+            idxs = np.flatnonzero(choices == m).tolist()
+            if method is Grid:
+               blocks = self._getBlocks(level)
+               for i in idxs:
+                  nodes[i] = Grid(griddedData=blocks[i].reshape(side, side))
+            elif idxs:
+               vals, counts, bounds = self._getRuns(method, level)
+               bounds = bounds.tolist()
+               for i in idxs:
+                  leaf = method()
+                  leaf._setSize(side, side)
+                  leaf._setRuns((vals[bounds[i]:bounds[i+1]], 
+                                 counts[bounds[i]:bounds[i+1]], None))
+                  nodes[i] = leaf
       
-         # Pack data
-         packData(self.cmpData, f)
+      cmp = QuadtreeComboCompressedGrid(rleMethod, 
+                                        orderThreshold=orderThreshold)
+      cmp.xSize = self.xSize
+      cmp.ySize = self.ySize
+      cmp.order = self.order
+      cmp.cmpData = linkQuadtree(self.uniform, self.blockVals, level, nodes)
+      return cmp
+
+   # ...........................
+   def estimateSize(self, rleMethod, orderThreshold):
+      """
+      @summary: Returns the number of bytes that QuadtreeComboCompressedGrid
+                   would write for a threshold, without building the tree
+      @param rleMethod: The run-length encoding class to use, or a list of 
+                           candidates (see compress)
+      @param orderThreshold: The order threshold (see 
+                                _ComboCompressionBaseClass)
+      """
+      level = self.cutLevel(orderThreshold)
       
-         # Write out categories
-         # Write separator
-         f.write(struct.pack('<B', 0))
+      # Header, separator and no classes for a single value
+      size = COMBO_HEADER.size + 1
+      if self.order == 0 or self.uniform[self.order][0]:
+         return size + 2
+      
+      # Every internal node has four children that are internal nodes, 
+      #    values or encoded leaves
+      numInternal = sum([(~self.uniform[l]).sum() 
+                                    for l in xrange(level + 1, self.order + 1)])
+      numLeaves = 0
+      if level > 0:
+         methods = list(rleMethod) if isMixed(rleMethod) else [rleMethod]
+         choices, sizes = self._chooseEncodings(methods, level)
+         numLeaves = len(choices)
+         size += numLeaves + sizes.min(axis=0).sum()
          
-         # Write out all classes
-         for k in clIds.keys():
-            # Write id
-            f.write(struct.pack('<B', clIds[k]))
-            # Write number of items in key
-            f.write(struct.pack('<B', len(list(k))))
-            # Write items
-            for i in list(k):
-               f.write(struct.pack('<B', i))
+         # Run tuples of the same width share classes
+         widthVals = {}
+         for m, method in enumerate(methods):
+            if method is not Grid:
+               vals, counts, bounds = self._getRuns(method, level)
+               chosen = np.repeat(choices == m, np.diff(bounds))
+               widthVals.setdefault(vals.shape[1], []).append(vals[chosen])
+         for width, valsList in widthVals.iteritems():
+            size += countDistinctGroups(np.concatenate(valsList)) * (2 + width)
+      numValues = 3 * numInternal + 1 - numLeaves
+      return int(size + numInternal + 2 * numValues)
+
+   # ...........................
+   def bestThreshold(self, rleMethod, candidates=None, timeBudget=None, 
+                     sizeBudget=None):
+      """
+      @summary: Finds the order threshold with the smallest estimated size
+      @param rleMethod: The run-length encoding class to use, or a list of 
+                           candidates (see compress)
+      @param candidates: (optional) The order thresholds to try, in order.  
+                            Defaults to the even thresholds that can cut the
+                            tree, starting from 8 and moving outwards.  Odd 
+                            thresholds cut the tree at the same level as the
+                            even threshold below them
+      @param timeBudget: (optional) Stop trying thresholds after this many 
+                            seconds
+      @param sizeBudget: (optional) Stop trying thresholds once one is 
+                            estimated to take no more than this many bytes
+      """
+      if candidates is None:
+         candidates = sorted(range(0, 2 * self.order + 1, 2), 
+                             key=lambda t: (abs(t - 8), t))
+      
+      startTime = time.time()
+      best = bestSize = None
+      for orderThreshold in candidates:
+         size = self.estimateSize(rleMethod, orderThreshold)
+         if bestSize is None or size < bestSize:
+            best = orderThreshold
+            bestSize = size
+         if sizeBudget is not None and bestSize <= sizeBudget:
+            break
+         if timeBudget is not None and time.time() - startTime >= timeBudget:
+            break
+      return best
+
+   # ...........................
+   def _chooseEncodings(self, methods, level):
+      """
+      @summary: Picks the encoding that takes the fewest bytes for each block
+                   at a level that is not uniform.  The shared classes are 
+                   not counted
+      @param methods: A list of candidate classes (see MIXED_METHODS)
+      @param level: The level of the blocks
+      @return: An array with the index of the method picked for each block 
+                  and an array with the number of bytes that each method 
+                  takes for each block
+      """
+      numBlocks = (~self.uniform[level]).sum()
+      sizes = np.zeros((len(methods), numBlocks), dtype=np.int64)
+      if numBlocks == 0:
+         return np.zeros(0, dtype=np.int64), sizes
       
+      for m, method in enumerate(methods):
+         if method is Grid:
+            # Distinct values, then the fewest bits for each cell
+            numVals = np.concatenate(self._mapBlocks(countBlockValues, 
+                                                     self._getBlocks(level)))
+            nBits = np.searchsorted(2**np.arange(32), numVals)
+            sizes[m] = 1 + numVals + (4**level * nBits + 7) / 8
+         else:
+            vals, counts, bounds = self._getRuns(method, level)
+            sizes[m] = np.add.reduceat(packedRunSizes(counts), bounds[:-1])
+      return np.argmin(sizes, axis=0), sizes
+
+   # ...........................
+   def _getBlocks(self, level):
+      """
+      @summary: Returns a 2-D array with the cells of each block at a level 
+                   that is not uniform, in row-major order, one block per row
+      @param level: The level of the blocks
+      """
+      if not self._blocks.has_key(level):
+         # The cells of each block are contiguous and in Morton order
+         side = 2**level
+         rowMajor = pointsToMorton(np.arange(side)[np.newaxis, :], 
+                                   np.arange(side)[:, np.newaxis]).ravel()
+         self._blocks[level] = self.blockVals[0].reshape(-1, 4**level)[
+                        np.flatnonzero(~self.uniform[level])][:, rowMajor]
+      return self._blocks[level]
+
+   # ...........................
+   def _getRuns(self, rleMethod, level):
+      """
+      @summary: Returns the runs of all of the blocks at a level that are not
+                   uniform (see encodeRowRuns).  The blocks are encoded 
+                   together, or in chunks with the executor, the first time
+                   they are needed
+      @param rleMethod: The run-length encoding class to use
+      @param level: The level of the blocks
+      """
+      key = (rleMethod, level)
+      if not self._runs.has_key(key):
+         side = 2**level
+         leaf = rleMethod()
+         leaf._setSize(side, side)
+         
+         # Move the cells to their positions in the linear array of the method
+         positions = leaf._linearIndices(np.arange(side)[np.newaxis, :], 
+                                         np.arange(side)[:, np.newaxis])
+         self._runs[key] = joinRowRuns(self._mapBlocks(encodeBlockRuns, 
+                              self._getBlocks(level), positions.ravel(), 
+                              leaf._linearLength(), leaf.RUN_WIDTH))
+      return self._runs[key]
+
+   # ...........................
+   def _mapBlocks(self, func, blocks, *args):
+      """
+      @summary: Calls a function on chunks of blocks, with the executor if 
+                   there is one
+      @param func: A module level function that takes a tuple of a 2-D array
+                      of blocks, one per row, and the extra arguments
+      @param blocks: A 2-D array of blocks, one per row
+      @return: A list of the results for each chunk, in order
+      """
+      if self.executor is None or len(blocks) == 0:
+         return [func((blocks,) + args)]
+      blocksPerChunk = max(1, CELLS_PER_CHUNK / blocks.shape[1])
+      return list(self.executor.map(func, 
+                                    [(blocks[i:i + blocksPerChunk],) + args 
+                                     for i in xrange(0, len(blocks), 
+                                                     blocksPerChunk)]))
+
+# .............................................................................
+def countBlockValues(args):
+   """
+   @summary: Counts the distinct values of each block.  This is a module 
+                level function so that it can be sent to a process pool
+   @param args: A tuple with a 2-D array of blocks, one per row
+   @return: An array with the number of distinct values of each block
+   """
+   blocks, = args
+   return 1 + (np.diff(np.sort(blocks, axis=1), axis=1) != 0).sum(axis=1)
+
+# .............................................................................
+def encodeBlockRuns(args):
+   """
+   @summary: Moves the cells of each block to their positions in the linear 
+                array of a run-length encoding method and encodes the blocks 
+                (see encodeRowRuns).  This is a module level function so that
+                it can be sent to a process pool
+   @param args: A (2-D array of blocks in row-major order, one per row, 
+                   position of each cell, length of the linear arrays, group 
+                   size) tuple
+   """
+   blocks, positions, linearLength, groupSize = args
+   rows = np.zeros((len(blocks), linearLength), dtype=blocks.dtype)
+   rows[:, positions] = blocks
+   return encodeRowRuns(rows, groupSize)
+
+# .............................................................................
+def joinRowRuns(results):
+   """
+   @summary: Joins the runs of consecutive chunks of rows as if the rows had 
+                been encoded together
+   @param results: A list of (values, counts, bounds) tuples from 
+                      encodeRowRuns
+   """
+   if len(results) == 1:
+      return results[0]
+   
+   # The bounds of each chunk start from the runs of the chunks before it
+   offsets = np.cumsum([0] + [len(counts) for _, counts, _ in results])
+   bounds = [b[:-1] + off for (_, _, b), off in zip(results, offsets)]
+   bounds.append(offsets[-1:])
+   return np.concatenate([vals for vals, _, _ in results]), \
+          np.concatenate([counts for _, counts, _ in results]), \
+          np.concatenate(bounds)
+
+# .............................................................................
+def quadtreeComboCompress(mtx, method, sizeThreshold, executor=None):
+   """
+   @summary: Performs quadtree compression.  The quadtree part is built first
+                and then the sections below the threshold are run-length
+                encoded, in parallel if an executor is provided
+   @param mtx: List of lists or 2-D NumPy array, assumed to be square
+   @param method: The run-length encoding class for the sections below the 
+                     threshold
+   @param sizeThreshold: The number of cells at or below which a section is
+                            run-length encoded
+   @param executor: (optional) An object with a map method, such as a 
+                       multiprocessing Pool.  The map must return the results
+                       in order
+   """
+   top = {}
+   leaves = []
+   _splitSections(np.asarray(mtx), sizeThreshold, top, 0, leaves)
+   
+   if executor is not None:
+      cmpLeaves = executor.map(compressLeaf, 
+                               [(method, sect) for _, _, sect in leaves])
+   else:
+      cmpLeaves = map(compressLeaf, [(method, sect) for _, _, sect in leaves])
+   
+   for (parent, key, _), leaf in zip(leaves, cmpLeaves):
+      parent[key] = leaf
+   return top[0]
+
 # .............................................................................
-def quadtreeComboCompress(mtx, method, sizeThreshold):
+def _splitSections(mtx, sizeThreshold, parent, key, leaves):
    """
-   @summary: Performs quadtree compression
-   @param mtx: List of lists, assumed to be square
+   @summary: Builds the quadtree part of the compressed matrix.  Sections 
+                that need to be run-length encoded are added to leaves as 
+                (parent, key, section) tuples to be filled in later
+   @param mtx: A square 2-D NumPy array section
+   @param sizeThreshold: The number of cells at or below which a section is
+                            run-length encoded
+   @param parent: The dictionary to add this section to
+   @param key: The key of this section in the parent
+   @param leaves: A list of the sections to run-length encode
    """
-   minV = min([min(r) for r in mtx])
-   maxV = max([max(r) for r in mtx])
+   minV = mtx.min()
+   maxV = mtx.max()
 
    if minV == maxV:
-      return minV
+      parent[key] = int(minV)
+   elif mtx.size <= sizeThreshold:
+      parent[key] = None
+      leaves.append((parent, key, mtx))
    else:
-      numVals = len(mtx)**2
-      if numVals <= sizeThreshold:
-         return method(grid=Grid(griddedData=mtx))
-      else:
-         h = len(mtx)
-         return {
-              1 : quadtreeComboCompress([mtx[i][:h/2] for i in range(h/2)], method, sizeThreshold),
-              2 : quadtreeComboCompress([mtx[i][h/2:] for i in range(h/2)], method, sizeThreshold),
-              3 : quadtreeComboCompress([mtx[i][:h/2] for i in range(h/2, h)], method, sizeThreshold),
-              4 : quadtreeComboCompress([mtx[i][h/2:] for i in range(h/2, h)], method, sizeThreshold)
-                }
+      h = len(mtx) / 2
+      node = {}
+      parent[key] = node
+      _splitSections(mtx[:h, :h], sizeThreshold, node, 1, leaves)
+      _splitSections(mtx[:h, h:], sizeThreshold, node, 2, leaves)
+      _splitSections(mtx[h:, :h], sizeThreshold, node, 3, leaves)
+      _splitSections(mtx[h:, h:], sizeThreshold, node, 4, leaves)
    
 # .............................................................................
 def quadtreeComboDecompress(cmpMtx, sideLength):
@@ -231,7 +696,9 @@ def quadtreeComboDecompress(cmpMtx, sideLength):
    if isinstance(cmpMtx, int):
       return [[cmpMtx for i in xrange(sideLength)] for j in xrange(sideLength)]
    elif isinstance(cmpMtx, _CompressedGrid):
-      return cmpMtx.decompress().data
+      return cmpMtx.decompress().toList()
+   elif isinstance(cmpMtx, Grid):
+      return cmpMtx.toList()
    else:
       ret = []
       l = sideLength / 2
@@ -245,84 +712,166 @@ def quadtreeComboDecompress(cmpMtx, sideLength):
          ret.append(bottomLeft[i] + bottomRight[i])
       return ret
 
-
-   
-   
-   
-   
+# .............................................................................
+def quadtreeComboQueryWindow(cmpMtx, ret, x0, y0, x1, y1, minX, minY, 
+                             sideLength):
+   """
+   @summary: Fills in the part of a window covered by a quadtree section.  
+                Run-length encoded sections are queried for the part of the 
+                window that they cover
+   @param cmpMtx: The compressed section of the matrix
+   @param ret: The 2-D array for the window to fill in
+   @param x0: The left edge of the window (inclusive)
+   @param y0: The top edge of the window (inclusive)
+   @param x1: The right edge of the window (exclusive)
+   @param y1: The bottom edge of the window (exclusive)
+   @param minX: The left edge of this section
+   @param minY: The top edge of this section
+   @param sideLength: The length of each side of this section
+   """
+   # Find the part of the window covered by this section
+   iMinX = max(x0, minX)
+   iMinY = max(y0, minY)
+   iMaxX = min(x1, minX + sideLength)
+   iMaxY = min(y1, minY + sideLength)
+   if iMinX >= iMaxX or iMinY >= iMaxY:
+      return
    
-#    # ...........................
-#    def query(self, x, y):
-#       minX = minY = 0
-#       maxX = maxY = self.xSize
-#       
-#       val = self.data
-#       
-#       while not isinstance(val, int):
-#          cmpX = (maxX+minX) / 2
-#          cmpY = (maxY+minY) / 2
-#          if x < cmpX and y < cmpY:
-#             maxX = cmpX
-#             maxY = cmpY
-#             val = val[1]
-#          elif x < cmpX:
-#             maxX = cmpX
-#             minY = cmpY
-#             val = val[3]
-#          elif y < cmpY:
-#             minX = cmpX
-#             maxY = cmpY
-#             val = val[2]
-#          else:
-#             minX = cmpX
-#             minY = cmpY
-#             val = val[4]
-#    
-#       return val
-#    
-#    # ...........................
-#    def read(self, filename):
-#       # TODO
-#       with open(filename, 'rb') as f:
-#          self.xSize = struct.unpack('<l', f.read(4))[0]
-#          self.ySize = struct.unpack('<l', f.read(4))[0]
-# 
-#          self.data = unpackData(f)
-#    
-#    # ...........................
-#    def write(self, filename):
-#       with open(filename, 'wb') as f:
-#          # write version
-#          f.write(struct.pack('<l', self.xSize))
-#          f.write(struct.pack('<l', self.ySize))
-#          packData(self.data, f)
+   if isinstance(cmpMtx, int):
+      ret[iMinY-y0:iMaxY-y0, iMinX-x0:iMaxX-x0] = cmpMtx
+   elif isinstance(cmpMtx, Grid):
+      ret[iMinY-y0:iMaxY-y0, iMinX-x0:iMaxX-x0] = cmpMtx.queryWindow(
+            iMinX - minX, iMinY - minY, iMaxX - minX, iMaxY - minY)
+   else:
+      l = sideLength / 2
+      quadtreeComboQueryWindow(cmpMtx[1], ret, x0, y0, x1, y1, minX, minY, l)
+      quadtreeComboQueryWindow(cmpMtx[2], ret, x0, y0, x1, y1, minX + l, 
+                               minY, l)
+      quadtreeComboQueryWindow(cmpMtx[3], ret, x0, y0, x1, y1, minX, 
+                               minY + l, l)
+      quadtreeComboQueryWindow(cmpMtx[4], ret, x0, y0, x1, y1, minX + l, 
+                               minY + l, l)
 
 # .............................................................................
-def packData(data, f):
-   if isinstance(data, int):
-      f.write(struct.pack('<?', True))
-      f.write(struct.pack('<B', data))
+def quadtreeComboQueryMany(cmpMtx, codes, xs, ys, vals, lo, hi, base, minX, 
+                           minY, sideLength):
+   """
+   @summary: Looks up sorted points in a quadtree combo section.  Points are 
+                identified by their Morton code, which orders them the same 
+                way that the quadtree orders its quadrants
+   @param cmpMtx: The compressed section of the matrix
+   @param codes: A sorted array of Morton codes for the points
+   @param xs: The x coordinates of the points, in the same order as codes
+   @param ys: The y coordinates of the points, in the same order as codes
+   @param vals: An array to fill in with the value of each point
+   @param lo: The index of the first point in this section
+   @param hi: The index after the last point in this section
+   @param base: The Morton code of the first cell of this section
+   @param minX: The left edge of this section
+   @param minY: The top edge of this section
+   @param sideLength: The length of each side of this section
+   """
+   if lo >= hi:
+      return
+   
+   if isinstance(cmpMtx, dict):
+      half = sideLength / 2
+      q = half * half
+      # Split the points between the quadrants
+      splits = np.searchsorted(codes[lo:hi], [base + q, base + 2*q, base + 3*q])
+      splits = [lo] + (lo + splits).tolist() + [hi]
+      for i in xrange(4):
+         quadtreeComboQueryMany(cmpMtx[i+1], codes, xs, ys, vals, splits[i], 
+                                splits[i+1], base + i * q, 
+                                minX + (i & 1) * half, minY + (i >> 1) * half,
+                                half)
+   elif isinstance(cmpMtx, Grid):
+      vals[lo:hi] = cmpMtx.queryMany(xs[lo:hi] - minX, ys[lo:hi] - minY)
    else:
-      f.write(struct.pack('<?', False))
-      packData(data[1], f)
-      packData(data[2], f)
-      packData(data[3], f)
-      packData(data[4], f)
+      vals[lo:hi] = cmpMtx
 
 # .............................................................................
-def unpackData(f):
-   isInt = struct.unpack('<?', f.read(1))[0]
-   if isInt:
-      return struct.unpack('<B', f.read(1))[0]
-   else:
-      return {
-              1: unpackData(f),
-              2: unpackData(f),
-              3: unpackData(f),
-              4: unpackData(f)
-             }
+def quadtreeComboLeafAreas(cmpMtx, window, sideLength):
+   """
+   @summary: Finds the number of cells of each uniform section that are 
+                inside of a window and the part of each encoded leaf that is 
+                inside of it.  Sections outside of the window are skipped
+   @param cmpMtx: The compressed matrix
+   @param window: An (x0, y0, x1, y1) window
+   @param sideLength: The length of each side of the matrix
+   @return: An array of section values, an array of the number of cells of 
+               each section in the window and a list of (leaf, window) 
+               pairs (see countLeafClasses)
+   """
+   x0, y0, x1, y1 = window
+   values = []
+   areas = []
+   leafWindows = []
+   stack = [(cmpMtx, 0, 0, sideLength)]
+   while stack:
+      node, minX, minY, side = stack.pop()
+      w = h = side
+      iMinX = max(x0, minX)
+      iMinY = max(y0, minY)
+      iMaxX = min(x1, minX + w)
+      iMaxY = min(y1, minY + h)
+      if iMinX >= iMaxX or iMinY >= iMaxY:
+         continue
+      if isinstance(node, int):
+         values.append(node)
+         areas.append((iMaxX - iMinX) * (iMaxY - iMinY))
+      elif isinstance(node, Grid):
+         if (iMaxX - iMinX, iMaxY - iMinY) == (w, h):
+            leafWindows.append((node, None))
+         else:
+            leafWindows.append((node, (iMinX - minX, iMinY - minY, 
+                                       iMaxX - minX, iMaxY - minY)))
+      else:
+         l = side / 2
+         stack.extend([(node[1], minX, minY, l), 
+                       (node[2], minX + l, minY, l), 
+                       (node[3], minX, minY + l, l), 
+                       (node[4], minX + l, minY + l, l)])
+   return np.array(values, dtype=np.int64), np.array(areas, dtype=np.int64), \
+          leafWindows
+
+# .............................................................................
+def unpackData(buf, pos, sideLength, rleMethod):
+   """
+   @summary: Unpacks the tree written by QuadtreeComboCompressedGrid.write.  
+                The runs of the run length encoded leaves are returned as 
+                class identifiers because the class dictionary comes after 
+                the tree
+   @param buf: A string holding the file contents
+   @param pos: The offset of the tree in the buffer
+   @param sideLength: The length of each side of the whole tree
+   @param rleMethod: The run length encoding class of the leaves, not used 
+                        for leaves that record their own encoding
+   @return: The tree, a list of (leaf, class identifiers, counts) tuples for
+               the run length encoded leaves and the offset following the 
+               tree
+   """
+   leaves = []
+   top = {}
+   # Each stack entry is the parent, key and side length of a section still
+   #    to be read.  Children are pushed in reverse so they are read in order
+   stack = [(top, 0, sideLength)]
+   while stack:
+      parent, key, side = stack.pop()
+      nodeType = struct.unpack_from('<B', buf, pos)[0]
+      pos += 1
+      if nodeType == VALUE_NODE:
+         parent[key] = struct.unpack_from('<B', buf, pos)[0]
+         pos += 1
+      elif nodeType != INTERNAL_NODE:
+         parent[key], pos = unpackLeaf(buf, pos, nodeType, side, side, 
+                                       rleMethod, leaves)
+      else:
+         node = {}
+         parent[key] = node
+         stack.extend([(node, k, side / 2) for k in (4, 3, 2, 1)])
+   return top[0], leaves, pos
 
-   
 # .............................................................................
 def test():
    data = [
@@ -0,0 +1,560 @@
+"""
+@summary: This module contains an S-Tree variant class that uses an S-Tree
+             compression technique until a threshold is met, then switches to
+             a run-length encoding technique to fill in details
+@author: CJ Grady
+@version: 1.0
+@status: beta
+
+@license: gpl2
+@copyright: Copyright (C) 2014, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+"""
+import numpy as np
+import struct
+
+from matrix.matrix import Grid, findDtype
+from methods.combo.comboBase import _ComboCompressionBaseClass, \
+                                    assignLeafClassIds, COMBO_HEADER, \
+                                    compressLeaf, countLeafClasses, \
+                                    getRLEMethod, \
+                                    INTERNAL_NODE, isMixed, MIXED_METHODS, \
+                                    packLeaf, setLeafRuns, unpackLeaf, \
+                                    VALUE_NODE
+from methods.rle.rleBase import packClasses, unpackClasses
+from methods.trees.sTree import streeCodes
+
+# .............................................................................
+class STreeComboCompressedGrid(_ComboCompressionBaseClass):
+   """
+   @summary: This class provides a two-stage approach for compressing a grid by
+                first using an S-Tree, which divides the grid in half along
+                alternating axes, and then switching to a run-length encoding
+                mechanism once a threshold is reached
+   """
+   METHOD = 9
+   VERSION = 1.0
+   
+   def _initialize(self):
+      self.cmpData = {}
+      self.xSize = None
+      self.ySize = None
+      self.xOrder = self.yOrder = self.order = 0
+
+   # ...........................
+   def compress(self, mtx, executor=None):
+      """
+      @summary: Compresses a Grid
+      @param mtx: The Grid to compress
+      @param executor: (optional) An object with a map method, such as a 
+                          multiprocessing Pool, used to run-length encode the
+                          sections below the threshold in parallel.  The 
+                          result is the same as compressing serially
+      """
+      self.cmpData = {}
+      self.xSize = mtx.xSize
+      self.ySize = mtx.ySize
+      
+      assert len(mtx.data) == mtx.ySize
+      assert len(mtx.data[0]) == mtx.xSize
+      
+      # Determine orders
+      self._findOrders()
+      
+      paddedMtx = mtx.toPaddedArray(2**self.xOrder, 2**self.yOrder)
+      
+      self.cmpData = streeComboCompress(paddedMtx, self.xOrder, self.yOrder, 
+                                        self.rleMethod, self.threshold, 
+                                        executor=executor)
+   
+   # ...........................
+   def _findOrders(self):
+      """
+      @summary: Finds the orders of the padded grid from its size
+      """
+      self.xOrder = self.yOrder = 0
+      
+      while 2**self.xOrder < self.xSize:
+         self.xOrder += 1
+         
+      while 2**self.yOrder < self.ySize:
+         self.yOrder += 1
+      
+      self.order = 0
+      while 2**self.order < max([self.xSize, self.ySize]):
+         self.order += 1
+   
+   # ...........................
+   def decompress(self):
+      data = streeComboDecompress(self.cmpData, 2**self.xOrder, 2**self.yOrder)
+      mtx = Grid(griddedData=data[:self.ySize, :self.xSize])
+      return mtx
+
+   # ...........................
+   def query(self, x, y):
+      """
+      @summary: Queries the compressed grid to find the value at the specified
+                   coordinates.  Run length encoded leaves are queried with 
+                   the coordinates relative to the leaf
+      @param x: The x (horizontal) coordinate, starts from the left, zero-based
+      @param y: The y (vertical) coordinate, starts at the top, zero-based
+      """
+      minX = minY = 0
+      maxX = 2**self.xOrder
+      maxY = 2**self.yOrder
+      
+      val = self.cmpData
+      
+      while isinstance(val, dict):
+         if val['splitX']:
+            cmpX = (maxX+minX) / 2
+            if x < cmpX:
+               maxX = cmpX
+               val = val[1]
+            else:
+               minX = cmpX
+               val = val[2]
+         else:
+            cmpY = (maxY+minY) / 2
+            if y < cmpY:
+               maxY = cmpY
+               val = val[1]
+            else:
+               minY = cmpY
+               val = val[2]
+      
+      if isinstance(val, Grid):
+         return val.query(x - minX, y - minY)
+      return val
+
+   # ...........................
+   def queryWindow(self, x0, y0, x1, y1):
+      """
+      @summary: Queries the compressed grid for all of the values in a window.
+                   Only the subtrees that intersect the window are visited
+      @param x0: The left edge of the window (inclusive)
+      @param y0: The top edge of the window (inclusive)
+      @param x1: The right edge of the window (exclusive)
+      @param y1: The bottom edge of the window (exclusive)
+      @return: A 2-D NumPy array with y1-y0 rows and x1-x0 columns
+      """
+      self._checkWindow(x0, y0, x1, y1)
+      ret = np.zeros((y1 - y0, x1 - x0), dtype=np.int64)
+      streeComboQueryWindow(self.cmpData, ret, x0, y0, x1, y1, 0, 0, 
+                            2**self.xOrder, 2**self.yOrder)
+      if ret.size > 0:
+         ret = ret.astype(findDtype(ret.min(), ret.max()))
+      return ret
+   
+   # ...........................
+   def queryMany(self, xs, ys):
+      """
+      @summary: Queries the compressed grid for the values at many points.  
+                   The points are sorted into the order that the tree stores
+                   its leaves so that each node is visited at most once and
+                   each run length encoded leaf is queried once for all of 
+                   its points
+      @param xs: An array of x coordinates
+      @param ys: An array of y coordinates, broadcast against xs
+      @return: A NumPy array of values with the broadcast shape of xs and ys
+      """
+      xs, ys = self._checkPoints(xs, ys)
+      codes = streeCodes(xs, ys, self.xOrder, self.yOrder).ravel()
+      order = np.argsort(codes)
+      
+      vals = np.zeros(codes.shape, dtype=np.int64)
+      streeComboQueryMany(self.cmpData, codes[order], xs.ravel()[order], 
+                          ys.ravel()[order], vals, 0, len(vals), 0, 0, 0, 
+                          2**self.xOrder, 2**self.yOrder)
+      
+      ret = np.empty_like(vals)
+      ret[order] = vals
+      if ret.size > 0:
+         ret = ret.astype(findDtype(ret.min(), ret.max()))
+      return ret.reshape(xs.shape)
+   
+   # ...........................
+   def classCounts(self, window=None):
+      """
+      @summary: Counts the cells of each class from the sizes of the uniform
+                   sections and the runs of the encoded leaves.  Only the 
+                   leaves cut by the window or the edge of the grid are 
+                   counted cell by cell
+      @param window: (optional) An (x0, y0, x1, y1) window to count the cells
+                        of instead of the whole grid (see queryWindow)
+      @return: A dictionary of class to number of cells
+      """
+      if window is None:
+         window = (0, 0, self.xSize, self.ySize)
+      self._checkWindow(*window)
+      return countLeafClasses(*streeComboLeafAreas(self.cmpData, window, 
+                                                   2**self.xOrder, 
+                                                   2**self.yOrder))
+   
+   # ...........................
+   def read(self, fn):
+      """
+      @summary: Reads in the compressed grid from a file
+      @param fn: The filename to read from
+      """
+      with open(fn, 'rb') as f:
+         buf = f.read()
+      
+      (method, version, rleMethod, rleVersion, self.xSize, 
+       self.ySize) = COMBO_HEADER.unpack_from(buf)
+      if rleMethod == 0:
+         # Each leaf picked its own encoding
+         self.rleMethod = MIXED_METHODS
+      else:
+         self.rleMethod = getRLEMethod(rleMethod)
+      
+      self._findOrders()
+      
+      self.cmpData, leaves, pos = unpackData(buf, COMBO_HEADER.size, 
+                                             self.xOrder, self.yOrder, 
+                                             self.rleMethod)
+      
+      # Classes follow the separator
+      setLeafRuns(leaves, unpackClasses(buf, pos + 1))
+   
+   # ...........................
+   def write(self, fn):
+      """
+      @summary: Writes out the compressed grid.  The tree is written in 
+                   pre-order without split flags because the split direction
+                   at each depth is implied by the orders of the grid
+      @param fn: The filename to write to
+      """
+      leaves = []
+      nodes = []
+      stack = [self.cmpData]
+      while stack:
+         node = stack.pop()
+         nodes.append(node)
+         if isinstance(node, dict):
+            stack.extend([node[2], node[1]])
+         elif isinstance(node, Grid):
+            leaves.append(node)
+      
+      clIds = assignLeafClassIds(leaves)
+      mixed = isMixed(self.rleMethod)
+      
+      # Mixed files have zero for the RLE method and version
+      if mixed:
+         parts = [COMBO_HEADER.pack(self.METHOD, self.VERSION, 0, 0.0, 
+                                    self.xSize, self.ySize)]
+      else:
+         parts = [COMBO_HEADER.pack(self.METHOD, self.VERSION, 
+                                    self.rleMethod.METHOD, 
+                                    self.rleMethod.VERSION, 
+                                    self.xSize, self.ySize)]
+      
+      for node in nodes:
+         if isinstance(node, int):
+            parts.append(struct.pack('<BB', VALUE_NODE, node))
+         elif isinstance(node, Grid):
+            parts.append(packLeaf(node, clIds, mixed))
+         else:
+            parts.append(struct.pack('<B', INTERNAL_NODE))
+      
+      # Classes follow a separator
+      parts.append(struct.pack('<B', 0))
+      parts.append(packClasses(clIds))
+      
+      with open(fn, 'wb') as f:
+         f.write(''.join(parts))
+
+# .............................................................................
+def streeComboCompress(mtx, xOrder, yOrder, method, sizeThreshold, 
+                       executor=None):
+   """
+   @summary: Performs s-tree compression.  The s-tree part is built first and
+                then the sections below the threshold are run-length encoded,
+                in parallel if an executor is provided
+   @param mtx: 2-D NumPy array with 2**yOrder rows and 2**xOrder columns
+   @param xOrder: 2**xOrder elements in each row
+   @param yOrder: 2**yOrder rows
+   @param method: The run-length encoding class for the sections below the 
+                     threshold
+   @param sizeThreshold: The number of cells at or below which a section is
+                            run-length encoded
+   @param executor: (optional) An object with a map method, such as a 
+                       multiprocessing Pool.  The map must return the results
+                       in order
+   """
+   top = {}
+   leaves = []
+   _splitSections(np.asarray(mtx), xOrder, yOrder, sizeThreshold, top, 0, 
+                  leaves)
+   
+   if executor is not None:
+      cmpLeaves = executor.map(compressLeaf, 
+                               [(method, sect) for _, _, sect in leaves])
+   else:
+      cmpLeaves = map(compressLeaf, [(method, sect) for _, _, sect in leaves])
+   
+   for (parent, key, _), leaf in zip(leaves, cmpLeaves):
+      parent[key] = leaf
+   return top[0]
+
+# .............................................................................
+def _splitSections(mtx, xOrder, yOrder, sizeThreshold, parent, key, leaves):
+   """
+   @summary: Builds the s-tree part of the compressed matrix.  Sections that
+                need to be run-length encoded are added to leaves as 
+                (parent, key, section) tuples to be filled in later
+   @param mtx: A 2-D NumPy array section
+   @param xOrder: 2**xOrder elements in each row of the section
+   @param yOrder: 2**yOrder rows in the section
+   @param sizeThreshold: The number of cells at or below which a section is
+                            run-length encoded
+   @param parent: The dictionary to add this section to
+   @param key: The key of this section in the parent
+   @param leaves: A list of the sections to run-length encode
+   """
+   minV = mtx.min()
+   maxV = mtx.max()
+
+   if minV == maxV:
+      parent[key] = int(minV)
+   elif mtx.size <= sizeThreshold:
+      parent[key] = None
+      leaves.append((parent, key, mtx))
+   elif xOrder > yOrder:
+      h = 2**(xOrder-1)
+      node = {'splitX' : True}
+      parent[key] = node
+      _splitSections(mtx[:, :h], xOrder-1, yOrder, sizeThreshold, node, 1, 
+                     leaves)
+      _splitSections(mtx[:, h:], xOrder-1, yOrder, sizeThreshold, node, 2, 
+                     leaves)
+   else:
+      h = 2**(yOrder-1)
+      node = {'splitX' : False}
+      parent[key] = node
+      _splitSections(mtx[:h], xOrder, yOrder-1, sizeThreshold, node, 1, 
+                     leaves)
+      _splitSections(mtx[h:], xOrder, yOrder-1, sizeThreshold, node, 2, 
+                     leaves)
+
+# .............................................................................
+def streeComboDecompress(cmpMtx, xSize, ySize):
+   """
+   @summary: Decompresses an s-tree combination compressed matrix
+   @param cmpMtx: The compressed matrix
+   @param xSize: The number of columns in the matrix, 2**xOrder
+   @param ySize: The number of rows in the matrix, 2**yOrder
+   @return: A 2-D NumPy array
+   """
+   ret = np.zeros((ySize, xSize), dtype=np.int64)
+   
+   # Each stack entry is a section and its left edge, top edge, width and 
+   #    height
+   stack = [(cmpMtx, 0, 0, xSize, ySize)]
+   while stack:
+      node, minX, minY, w, h = stack.pop()
+      if isinstance(node, int):
+         ret[minY:minY+h, minX:minX+w] = node
+      elif isinstance(node, Grid):
+         ret[minY:minY+h, minX:minX+w] = node.queryWindow(0, 0, w, h)
+      elif node['splitX']:
+         stack.append((node[1], minX, minY, w / 2, h))
+         stack.append((node[2], minX + w / 2, minY, w / 2, h))
+      else:
+         stack.append((node[1], minX, minY, w, h / 2))
+         stack.append((node[2], minX, minY + h / 2, w, h / 2))
+   
+   if ret.size > 0:
+      ret = ret.astype(findDtype(ret.min(), ret.max()))
+   return ret
+
+# .............................................................................
+def streeComboQueryWindow(cmpMtx, ret, x0, y0, x1, y1, minX, minY, xSize, 
+                          ySize):
+   """
+   @summary: Fills in the part of a window covered by an s-tree section.  
+                Run-length encoded sections are queried for the part of the 
+                window that they cover
+   @param cmpMtx: The compressed section of the matrix
+   @param ret: The 2-D array for the window to fill in
+   @param x0: The left edge of the window (inclusive)
+   @param y0: The top edge of the window (inclusive)
+   @param x1: The right edge of the window (exclusive)
+   @param y1: The bottom edge of the window (exclusive)
+   @param minX: The left edge of this section
+   @param minY: The top edge of this section
+   @param xSize: The number of columns in this section
+   @param ySize: The number of rows in this section
+   """
+   # Find the part of the window covered by this section
+   iMinX = max(x0, minX)
+   iMinY = max(y0, minY)
+   iMaxX = min(x1, minX + xSize)
+   iMaxY = min(y1, minY + ySize)
+   if iMinX >= iMaxX or iMinY >= iMaxY:
+      return
+   
+   if isinstance(cmpMtx, int):
+      ret[iMinY-y0:iMaxY-y0, iMinX-x0:iMaxX-x0] = cmpMtx
+   elif isinstance(cmpMtx, Grid):
+      ret[iMinY-y0:iMaxY-y0, iMinX-x0:iMaxX-x0] = cmpMtx.queryWindow(
+            iMinX - minX, iMinY - minY, iMaxX - minX, iMaxY - minY)
+   elif cmpMtx['splitX']:
+      l = xSize / 2
+      streeComboQueryWindow(cmpMtx[1], ret, x0, y0, x1, y1, minX, minY, l, 
+                            ySize)
+      streeComboQueryWindow(cmpMtx[2], ret, x0, y0, x1, y1, minX + l, minY, 
+                            l, ySize)
+   else:
+      l = ySize / 2
+      streeComboQueryWindow(cmpMtx[1], ret, x0, y0, x1, y1, minX, minY, 
+                            xSize, l)
+      streeComboQueryWindow(cmpMtx[2], ret, x0, y0, x1, y1, minX, minY + l, 
+                            xSize, l)
+
+# .............................................................................
+def streeComboQueryMany(cmpMtx, codes, xs, ys, vals, lo, hi, base, minX, minY,
+                        xSize, ySize):
+   """
+   @summary: Looks up sorted points in an s-tree combo section
+   @param cmpMtx: The compressed section of the matrix
+   @param codes: A sorted array of s-tree codes for the points (see 
+                    streeCodes)
+   @param xs: The x coordinates of the points, in the same order as codes
+   @param ys: The y coordinates of the points, in the same order as codes
+   @param vals: An array to fill in with the value of each point
+   @param lo: The index of the first point in this section
+   @param hi: The index after the last point in this section
+   @param base: The code of the first cell of this section
+   @param minX: The left edge of this section
+   @param minY: The top edge of this section
+   @param xSize: The number of columns in this section
+   @param ySize: The number of rows in this section
+   """
+   if lo >= hi:
+      return
+   
+   if isinstance(cmpMtx, dict):
+      h = xSize * ySize / 2
+      # Split the points between the halves
+      split = lo + int(np.searchsorted(codes[lo:hi], base + h))
+      if cmpMtx['splitX']:
+         xSize /= 2
+         streeComboQueryMany(cmpMtx[1], codes, xs, ys, vals, lo, split, base, 
+                             minX, minY, xSize, ySize)
+         streeComboQueryMany(cmpMtx[2], codes, xs, ys, vals, split, hi, 
+                             base + h, minX + xSize, minY, xSize, ySize)
+      else:
+         ySize /= 2
+         streeComboQueryMany(cmpMtx[1], codes, xs, ys, vals, lo, split, base, 
+                             minX, minY, xSize, ySize)
+         streeComboQueryMany(cmpMtx[2], codes, xs, ys, vals, split, hi, 
+                             base + h, minX, minY + ySize, xSize, ySize)
+   elif isinstance(cmpMtx, Grid):
+      vals[lo:hi] = cmpMtx.queryMany(xs[lo:hi] - minX, ys[lo:hi] - minY)
+   else:
+      vals[lo:hi] = cmpMtx
+
+# .............................................................................
+def streeComboLeafAreas(cmpMtx, window, xSize, ySize):
+   """
+   @summary: Finds the number of cells of each uniform section that are 
+                inside of a window and the part of each encoded leaf that is 
+                inside of it.  Sections outside of the window are skipped
+   @param cmpMtx: The compressed matrix
+   @param window: An (x0, y0, x1, y1) window
+   @param xSize: The number of columns in the matrix, 2**xOrder
+   @param ySize: The number of rows in the matrix, 2**yOrder
+   @return: An array of section values, an array of the number of cells of 
+               each section in the window and a list of (leaf, window) 
+               pairs (see countLeafClasses)
+   """
+   x0, y0, x1, y1 = window
+   values = []
+   areas = []
+   leafWindows = []
+   stack = [(cmpMtx, 0, 0, xSize, ySize)]
+   while stack:
+      node, minX, minY, w, h = stack.pop()
+      iMinX = max(x0, minX)
+      iMinY = max(y0, minY)
+      iMaxX = min(x1, minX + w)
+      iMaxY = min(y1, minY + h)
+      if iMinX >= iMaxX or iMinY >= iMaxY:
+         continue
+      if isinstance(node, int):
+         values.append(node)
+         areas.append((iMaxX - iMinX) * (iMaxY - iMinY))
+      elif isinstance(node, Grid):
+         if (iMaxX - iMinX, iMaxY - iMinY) == (w, h):
+            leafWindows.append((node, None))
+         else:
+            leafWindows.append((node, (iMinX - minX, iMinY - minY, 
+                                       iMaxX - minX, iMaxY - minY)))
+      elif node['splitX']:
+         stack.extend([(node[1], minX, minY, w / 2, h), 
+                       (node[2], minX + w / 2, minY, w / 2, h)])
+      else:
+         stack.extend([(node[1], minX, minY, w, h / 2), 
+                       (node[2], minX, minY + h / 2, w, h / 2)])
+   return np.array(values, dtype=np.int64), np.array(areas, dtype=np.int64), \
+          leafWindows
+
+# .............................................................................
+def unpackData(buf, pos, xOrder, yOrder, rleMethod):
+   """
+   @summary: Unpacks the tree written by STreeComboCompressedGrid.write.  The
+                runs of the run length encoded leaves are returned as class
+                identifiers because the class dictionary comes after the tree
+   @param buf: A string holding the file contents
+   @param pos: The offset of the tree in the buffer
+   @param xOrder: 2**xOrder elements in each row of the whole tree
+   @param yOrder: 2**yOrder rows in the whole tree
+   @param rleMethod: The run length encoding class of the leaves, not used 
+                        for leaves that record their own encoding
+   @return: The tree, a list of (leaf, class identifiers, counts) tuples for
+               the run length encoded leaves and the offset following the 
+               tree
+   """
+   leaves = []
+   top = {}
+   # Each stack entry is the parent, key and orders of a section still to be
+   #    read.  Children are pushed in reverse so they are read in order
+   stack = [(top, 0, xOrder, yOrder)]
+   while stack:
+      parent, key, xOrd, yOrd = stack.pop()
+      nodeType = struct.unpack_from('<B', buf, pos)[0]
+      pos += 1
+      if nodeType == VALUE_NODE:
+         parent[key] = struct.unpack_from('<B', buf, pos)[0]
+         pos += 1
+      elif nodeType != INTERNAL_NODE:
+         parent[key], pos = unpackLeaf(buf, pos, nodeType, 2**xOrd, 2**yOrd, 
+                                       rleMethod, leaves)
+      elif xOrd > yOrd:
+         node = {'splitX' : True}
+         parent[key] = node
+         stack.extend([(node, k, xOrd - 1, yOrd) for k in (2, 1)])
+      else:
+         node = {'splitX' : False}
+         parent[key] = node
+         stack.extend([(node, k, xOrd, yOrd - 1) for k in (2, 1)])
+   return top[0], leaves, pos
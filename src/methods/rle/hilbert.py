@@ -27,24 +27,25 @@
           Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
           02110-1301, USA.
 """
-import struct
+from collections import OrderedDict
+import numpy as np
+import threading
 
-from matrix.matrix import _CompressedGrid, Grid
+from matrix.matrix import Grid
+from methods.rle.rleBase import _RLECompressedGrid, decodeRuns, encodeRuns
 
 # .............................................................................
-class HilbertRLECompressedGrid(_CompressedGrid):
+class HilbertRLECompressedGrid(_RLECompressedGrid):
    """
    @summary: This class compresses a grid using a Hilbert space filling curve.
    """
    METHOD = 2
    VERSION = 2.0
+   RUN_WIDTH = 4
+   COMPACT = False
    # ...........................
-   def __init__(self, grid=None):
-      if grid is not None:
-         self.compress(grid)
-      else:
-         self.lyrs = []
-         self.order = 0
+   def _initialize(self):
+      self.order = 0
    
    # ...........................
    def compress(self, grid):
@@ -54,221 +55,195 @@ class HilbertRLECompressedGrid(_CompressedGrid):
       """
       self.xSize = grid.xSize
       self.ySize = grid.ySize
-      self.lyrs = []
 
       # Determine order
-      self.order = 0
-      while 2**self.order < max([self.xSize, self.ySize]):
-         self.order += 1
-
+      self.order = findOrder(self.xSize, self.ySize)
 
-      lArray = 4**self.order * [0]
-      
-      # go through matrix and add items to array
-      for x in xrange(self.xSize):
-         for y in xrange(self.ySize):
-            idx = pointToHilbert(x, y, self.order)
-            lArray[idx] = grid.data[y][x]
+      # Place each cell at its position along the curve
+      gridArray = grid.toArray()
+      positions = PERMUTATION_CACHE.get(self.xSize, self.ySize, 
+                                        compact=self.COMPACT)
+      if self.COMPACT:
+         lArray = np.zeros(self.xSize * self.ySize, dtype=gridArray.dtype)
+      else:
+         lArray = np.zeros(4**self.order, dtype=gridArray.dtype)
+      lArray[positions] = gridArray.ravel()
 
-      self.cmpData = []
-      
       # Compress by fours
-      cur = (lArray[0], lArray[1], lArray[2], lArray[3])
-      num = 1
-      for i in xrange(4, len(lArray), 4):
-         try:
-            if cur == (lArray[i], lArray[i+1], lArray[i+2], lArray[i+3]):
-               num += 1
-            else:
-               self.cmpData.append((cur, num))
-               cur = (lArray[i], lArray[i+1], lArray[i+2], lArray[i+3])
-               num = 1
-         except IndexError:
-            # This happens if there is an odd number of items
-            self.cmpData.append((cur, num))
-            cur = tuple(lArray[i:-1])
-            num = 1
-
-#       # Compress by twos
-#       cur = (lArray[0], lArray[1])
-#       num = 1
-#       for i in xrange(2, len(lArray), 2):
-#          try:
-#             if cur == (lArray[i], lArray[i+1]):
-#                num += 1
-#             else:
-#                self.cmpData.append((cur, num))
-#                cur = (lArray[i], lArray[i+1])
-#                num = 1
-#          except IndexError:
-#             # This happens if there is an odd number of items
-#             self.cmpData.append((cur, num))
-#             cur = (lArray[-1])
-#             num = 1
-      self.cmpData.append((cur, num))
+      self._setRuns(encodeRuns(lArray, self.RUN_WIDTH))
 
    # ...........................
    def decompress(self):
       """
       @summary: Decompresses the compressed grid into a Grid object
       """
-      data = []
-      for y in xrange(self.ySize):
-         row = []
-         for x in xrange(self.xSize):
-            row.append(0)
-         data.append(row)
+      lArray = decodeRuns(*self._getRuns())
       
-      lArray = []
-      for cur, num in self.cmpData:
-         lArray.extend(num*cur)
-            
-      for y in xrange(self.ySize):
-         for x in xrange(self.xSize):
-            idx = pointToHilbert(x, y, self.order)
-            data[y][x] = lArray[idx]
+      # Gather the cells from their positions along the curve
+      positions = PERMUTATION_CACHE.get(self.xSize, self.ySize, 
+                                        compact=self.COMPACT)
+      data = lArray[positions].reshape(self.ySize, self.xSize)
 
       return Grid(griddedData = data)
    
    # ...........................
-   def query(self, x, y):
+   def _linearIndex(self, x, y):
       """
-      @summary: Queries the compressed grid to find the value at the specified 
-                   coordinates
-      @param x: The x (horizontal) coordinate, starts from the left, zero-based
-      @param y: The y (vertical) coordinate, starts at the top, zero-based
+      @summary: Returns the position of a cell in the linear array
       """
-      idx = pointToHilbert(x, y, self.order)
-      ret = None
-      
-      pos = 0
-      for cur, num in self.cmpData:
-         pos = pos + num * len(cur)
-         if pos > idx:
-            tmp = list(cur)
-            biggerList = num * tmp
-            retIdx = idx - pos
-            ret = biggerList[retIdx]
-            break
-            #ret = (num * list(cur))[idx - pos]
-      return ret
+      return pointToHilbert(x, y, self.order)
+   
+   # ...........................
+   def _linearIndices(self, xs, ys):
+      """
+      @summary: Returns the positions of many cells in the linear array
+      """
+      return pointsToHilbert(xs, ys, self.order)
+   
+   # ...........................
+   def _setSize(self, xSize, ySize):
+      """
+      @summary: Sets the dimensions of the grid and the order of the curve
+      """
+      _RLECompressedGrid._setSize(self, xSize, ySize)
+      self.order = findOrder(self.xSize, self.ySize)
 
    # ...........................
-   def read(self, fn):
+   def _linearLength(self):
       """
-      @summary: Reads in the compressed grid from a file
-      @param fn: The filename to read from
+      @summary: Returns the number of cells in the linear array
       """
-      with open(fn, 'rb') as f:
-         method = struct.unpack('<B', f.read(1))[0]
-         version = struct.unpack('<f', f.read(4))[0]
-         self.xSize = struct.unpack('<l', f.read(4))[0]
-         self.ySize = struct.unpack('<l', f.read(4))[0]
+      if self.COMPACT:
+         return self.xSize * self.ySize
+      return 4**self.order
 
-         tmpData = []
-         
-         # Read all data and compile list with keys
-         tmp = f.read(1)
-         while struct.unpack('<B', tmp)[0] != 0:
-            cl = struct.unpack('<B', tmp)[0]
-            num = struct.unpack('<B', f.read(1))[0]
-            if num == 0:
-               num = struct.unpack('<H', f.read(2))[0]
-               if num == 0:
-                  num = struct.unpack('<L', f.read(4))[0]
-            tmpData.append((cl, num))
-            tmp = f.read(1)
-         
-         # Read classes
-         clDict = {}
-         tmp = f.read(1)
-         while tmp != "":
-            clId = struct.unpack('<B', tmp)[0]
-            nCats = struct.unpack('<B', f.read(1))[0]
-            val = []
-            for i in xrange(nCats):
-               nVal = struct.unpack('<B', f.read(1))[0]
-               val.append(nVal)
-            clDict[clId] = val
-            tmp = f.read(1)
-         
-         # Translate keys into classes
-         self.cmpData = []
-         
-         for k, num in tmpData:
-            self.cmpData.append((clDict[k], num))
+# .............................................................................
+class CompactHilbertRLECompressedGrid(HilbertRLECompressedGrid):
+   """
+   @summary: This class compresses a grid using a Hilbert space filling curve 
+                but only orders the cells that are inside of the grid.  The 
+                grid is not padded out to a 2**order by 2**order square, so 
+                the linear array has xSize * ySize cells
+   """
+   METHOD = 6
+   VERSION = 2.0
+   COMPACT = True
+   # ...........................
+   def _linearIndex(self, x, y):
+      """
+      @summary: Returns the position of a cell in the linear array
+      """
+      return hilbertRank(x, y, self.order, self.xSize, self.ySize)
+   
+   # ...........................
+   def _linearIndices(self, xs, ys):
+      """
+      @summary: Returns the positions of many cells in the linear array
+      """
+      return hilbertRanks(xs, ys, self.order, self.xSize, self.ySize)
 
+# .............................................................................
+class HilbertPermutationCache(object):
+   """
+   @summary: Caches the Hilbert curve position of every cell for grids of a 
+                given size so that grids of the same size can be reordered 
+                with a single gather or scatter.  The least recently used 
+                permutations are evicted once the cache grows larger than the
+                specified number of bytes
+   """
+   # ...........................
+   def __init__(self, maxBytes=256 * 1024**2):
+      """
+      @summary: Constructor
+      @param maxBytes: (optional) The maximum number of bytes to use for 
+                          permutations.  The most recently used permutation 
+                          is always kept, even if it is larger than this
+      """
+      self.maxBytes = maxBytes
+      self.nBytes = 0
+      self._perms = OrderedDict()
+      # Grids may be compressed from several threads
+      self._lock = threading.Lock()
+   
    # ...........................
-   def write(self, fn):
+   def get(self, xSize, ySize, compact=False):
+      """
+      @summary: Returns an array with the position along the Hilbert curve of 
+                   each cell of a grid, in row-major order
+      @param xSize: The number of columns in the grid
+      @param ySize: The number of rows in the grid
+      @param compact: (optional) If True, the positions only count the cells 
+                         that are inside of the grid, rather than every cell 
+                         of the enclosing 2**order by 2**order square
+      """
+      key = (xSize, ySize, compact)
+      with self._lock:
+         perm = self._perms.pop(key, None)
+         if perm is not None:
+            # Move to the most recently used end
+            self._perms[key] = perm
+      if perm is None:
+         order = findOrder(xSize, ySize)
+         if compact:
+            perm = hilbertRankPermutation(xSize, ySize, order)
+         else:
+            perm = pointsToHilbert(np.arange(xSize)[np.newaxis, :], 
+                                   np.arange(ySize)[:, np.newaxis], 
+                                   order).ravel()
+         if perm.max() < 2**32:
+            perm = perm.astype(np.uint32)
+         self._add(key, perm)
+      return perm
+   
+   # ...........................
+   def _add(self, key, perm):
+      """
+      @summary: Adds a permutation and evicts least recently used ones until 
+                   the cache fits within its limit
+      """
+      with self._lock:
+         if self._perms.has_key(key):
+            self.nBytes -= self._perms.pop(key).nbytes
+         self._perms[key] = perm
+         self.nBytes += perm.nbytes
+         while self.nBytes > self.maxBytes and len(self._perms) > 1:
+            _, oldPerm = self._perms.popitem(last=False)
+            self.nBytes -= oldPerm.nbytes
+   
+   # ...........................
+   def clear(self):
+      """
+      @summary: Removes all of the cached permutations
       """
-      @summary: Writes out the compressed grid
+      with self._lock:
+         self._perms.clear()
+         self.nBytes = 0
+   
+   # ...........................
+   def save(self, xSize, ySize, fn, compact=False):
+      """
+      @summary: Saves the permutation for a grid size to a .npy file so that
+                   it can be loaded instead of computed by another process
+      @param xSize: The number of columns in the grid
+      @param ySize: The number of rows in the grid
       @param fn: The filename to write to
+      @param compact: (optional) Save the compact permutation (see get)
       """
-      with open(fn, 'wb') as f:
-         # Write method
-         f.write(struct.pack('<B', self.METHOD))
-         # Write version
-         f.write(struct.pack('<f', self.VERSION))
-         
-         # Write x size and y size
-         f.write(struct.pack('<l', self.xSize))
-         f.write(struct.pack('<l', self.ySize))
-         
-         # Find all classes
-         clDict = {}
-         for cl, num in self.cmpData:
-            if clDict.has_key(cl):
-               clDict[cl] += 1
-            else:
-               clDict[cl] = 1
-         
-         sortedClasses = sorted(list(clDict.viewitems()), key=lambda k: k[1], reverse=True)
-         
-         #   Assign them ids
-         clIds = {}
-         i = 0
-         for cl, num in sortedClasses:
-            i += 1
-            clIds[cl] = i
-
-         #   Make sure that there are less than 256
-         #      if not, break some of them down
-         
-         
-         # Write data
-         for cl, num in self.cmpData:
-            # Write out class identifier
-            f.write(struct.pack('<B', clIds[cl]))
-            
-            # Bit twidding based on run-length, if over threshold, we need to 
-            #   write it out with more bytes.  We need to indicate this though
-            #   so that it can be handled on read
-            if num < 256:
-               f.write(struct.pack('<B', num))
-            elif num < 65536:
-               # Write indicator to bump up size
-               f.write(struct.pack('<B', 0))
-               # Write number
-               f.write(struct.pack('<H', num))
-            else:
-               # Write indicator to bump up twice
-               f.write(struct.pack('<B', 0))
-               f.write(struct.pack('<H', 0))
-               # Write number
-               f.write(struct.pack('<L', num))
-         
-         # Write separator
-         f.write(struct.pack('<B', 0))
-         
-         # Write out all classes
-         for k in clIds.keys():
-            # Write id
-            f.write(struct.pack('<B', clIds[k]))
-            # Write number of items in key
-            f.write(struct.pack('<B', len(list(k))))
-            # Write items
-            for i in list(k):
-               f.write(struct.pack('<B', i))
+      np.save(fn, self.get(xSize, ySize, compact=compact).reshape(ySize, 
+                                                                   xSize))
+   
+   # ...........................
+   def load(self, fn, compact=False, useMmap=False):
+      """
+      @summary: Loads a permutation saved with save.  The grid size is taken 
+                   from the shape of the saved array
+      @param fn: The filename to read from
+      @param compact: (optional) The file holds a compact permutation
+      @param useMmap: (optional) Memory map the file rather than reading it
+      """
+      perm = np.load(fn, mmap_mode='r' if useMmap else None)
+      ySize, xSize = perm.shape
+      self._add((xSize, ySize, compact), perm.ravel())
 
 # .............................................................................
 hilbertMap = { 
@@ -298,6 +273,107 @@ hilbertMap = {
                    } 
               }
 
+# .............................................................................
+def findOrder(xSize, ySize):
+   """
+   @summary: Finds the order of the Hilbert curve needed to cover a grid
+   @param xSize: The number of columns in the grid
+   @param ySize: The number of rows in the grid
+   """
+   order = 0
+   while 2**order < max([xSize, ySize]):
+      order += 1
+   return order
+
+# .............................................................................
+# The lookup tables handle one byte of each coordinate (and so 16 bits of the
+#    curve position) at a time.  They are built from hilbertMap when first used
+HILBERT_STATES = ['a', 'b', 'c', 'd']
+_hilbertTables = {}
+
+# .............................................................................
+def _getHilbertTables():
+   """
+   @summary: Returns the byte-wise lookup tables for converting between points
+                and Hilbert curve positions.  The point table is indexed by 
+                (state << 16 | x byte << 8 | y byte) and holds 
+                (position word << 2 | next state).  The position table is 
+                indexed by (state << 16 | position word) and holds 
+                (x byte << 10 | y byte << 2 | next state)
+   """
+   if not _hilbertTables:
+      # Single bit tables built from hilbertMap
+      quadPos, quadNext = _getQuadrantTables()
+      invX = np.zeros((4, 4), dtype=np.int64)
+      invY = np.zeros((4, 4), dtype=np.int64)
+      invNext = np.zeros((4, 4), dtype=np.int64)
+      for s in xrange(4):
+         for qx in xrange(2):
+            for qy in xrange(2):
+               qPos = quadPos[s, qx, qy]
+               invX[s, qPos] = qx
+               invY[s, qPos] = qy
+               invNext[s, qPos] = quadNext[s, qx, qy]
+      
+      idx = np.arange(4 * 2**16, dtype=np.int64)
+      
+      # Point to position
+      state = idx >> 16
+      xByte = (idx >> 8) & 0xFF
+      yByte = idx & 0xFF
+      pos = np.zeros_like(idx)
+      for i in xrange(7, -1, -1):
+         qx = (xByte >> i) & 1
+         qy = (yByte >> i) & 1
+         pos = (pos << 2) | quadPos[state, qx, qy]
+         state = quadNext[state, qx, qy]
+      _hilbertTables['point'] = ((pos << 2) | state).astype(np.uint32)
+      
+      # Position to point
+      state = idx >> 16
+      word = idx & 0xFFFF
+      xByte = np.zeros_like(idx)
+      yByte = np.zeros_like(idx)
+      for i in xrange(7, -1, -1):
+         q = (word >> (2 * i)) & 3
+         xByte = (xByte << 1) | invX[state, q]
+         yByte = (yByte << 1) | invY[state, q]
+         state = invNext[state, q]
+      _hilbertTables['position'] = (
+                  (xByte << 10) | (yByte << 2) | state).astype(np.uint32)
+   return _hilbertTables['point'], _hilbertTables['position']
+
+# .............................................................................
+def _getQuadrantTables():
+   """
+   @summary: Returns hilbertMap as arrays indexed by [state, x bit, y bit].  
+                The first holds the position of the quadrant along the curve 
+                and the second holds the state used inside of the quadrant
+   """
+   quadPos = np.zeros((4, 2, 2), dtype=np.int64)
+   quadNext = np.zeros((4, 2, 2), dtype=np.int64)
+   for s, square in enumerate(HILBERT_STATES):
+      for (qx, qy), (qPos, nextSquare) in hilbertMap[square].iteritems():
+         quadPos[s, qx, qy] = qPos
+         quadNext[s, qx, qy] = HILBERT_STATES.index(nextSquare)
+   return quadPos, quadNext
+
+# .............................................................................
+def _startState(order):
+   """
+   @summary: Returns the starting state and number of bytes to process for a 
+                curve of the specified order.  The coordinates are treated as
+                if they had extra leading zero bits to fill out whole bytes.
+                Two zero bits starting in state 'a' lead back to 'a' at 
+                position zero, so an odd number of extra bits starts in 'd'
+   @param order: The order of the Hilbert curve
+   """
+   nBytes = (order + 7) / 8
+   if (8 * nBytes - order) % 2 == 0:
+      return 0, nBytes
+   else:
+      return HILBERT_STATES.index('d'), nBytes
+
 # .............................................................................
 def pointToHilbert(x, y, order):
    """
@@ -307,16 +383,191 @@ def pointToHilbert(x, y, order):
    @param y: The y coordinate
    @param order: The order of the grid indexed by a Hilbert curve
    """ 
-   current_square = 'a' 
-   position = 0 
-   for i in range(order - 1, -1, -1): 
-      position <<= 2 
-      quad_x = 1 if x & (1 << i) else 0 
-      quad_y = 1 if y & (1 << i) else 0 
-      quad_position, current_square = hilbertMap[current_square][(quad_x, quad_y)] 
-      position |= quad_position 
+   pointTable = _getHilbertTables()[0]
+   state, nBytes = _startState(order)
+   position = 0
+   for i in xrange(8 * (nBytes - 1), -1, -8):
+      v = pointTable.item((state << 16) | (((x >> i) & 0xFF) << 8) | 
+                                           ((y >> i) & 0xFF))
+      position = (position << 16) | (v >> 2)
+      state = v & 3
    return position
 
+# .............................................................................
+def hilbertToPoint(position, order):
+   """
+   @summary: Converts a linear array index along a Hilbert space filling curve
+                to an x,y coordinate pair.  This is the inverse of 
+                pointToHilbert
+   @param position: The position along the curve
+   @param order: The order of the grid indexed by a Hilbert curve
+   @return: An (x, y) tuple
+   """
+   positionTable = _getHilbertTables()[1]
+   state, nBytes = _startState(order)
+   x = y = 0
+   for i in xrange(16 * (nBytes - 1), -1, -16):
+      v = positionTable.item((state << 16) | ((position >> i) & 0xFFFF))
+      x = (x << 8) | (v >> 10)
+      y = (y << 8) | ((v >> 2) & 0xFF)
+      state = v & 3
+   return x, y
+
+# .............................................................................
+def hilbertRank(x, y, order, xSize, ySize):
+   """
+   @summary: Returns the number of cells inside of a grid that come before a
+                point along a Hilbert curve.  This is the position of the 
+                point in a linear array that skips the cells outside of the 
+                grid
+   @param x: The x coordinate
+   @param y: The y coordinate
+   @param order: The order of the grid indexed by a Hilbert curve
+   @param xSize: The number of columns in the grid
+   @param ySize: The number of rows in the grid
+   """
+   square = 'a'
+   rank = 0
+   minX = minY = 0
+   for i in xrange(order - 1, -1, -1):
+      half = 1 << i
+      quad = ((x >> i) & 1, (y >> i) & 1)
+      quadPos, nextSquare = hilbertMap[square][quad]
+      
+      # Count the cells inside of the grid in the quadrants visited first
+      for (qx, qy), (pos, _) in hilbertMap[square].iteritems():
+         if pos < quadPos:
+            qMinX = minX + qx * half
+            qMinY = minY + qy * half
+            rank += max(0, min(qMinX + half, xSize) - qMinX) * \
+                    max(0, min(qMinY + half, ySize) - qMinY)
+      
+      minX += quad[0] * half
+      minY += quad[1] * half
+      square = nextSquare
+   return rank
+
+# .............................................................................
+def hilbertRanks(xs, ys, order, xSize, ySize):
+   """
+   @summary: Vectorized version of hilbertRank
+   @param xs: An array of x coordinates
+   @param ys: An array of y coordinates, broadcast against xs
+   @param order: The order of the grid indexed by a Hilbert curve
+   @param xSize: The number of columns in the grid
+   @param ySize: The number of rows in the grid
+   @return: An array of ranks with the broadcast shape of xs and ys
+   """
+   quadPos, quadNext = _getQuadrantTables()
+   quadPos = quadPos.reshape(4, 4)
+   quadNext = quadNext.reshape(4, 4)
+   xs = np.asarray(xs, dtype=np.int64)
+   ys = np.asarray(ys, dtype=np.int64)
+   
+   shape = np.broadcast(xs, ys).shape
+   xs = np.broadcast_to(xs, shape)
+   ys = np.broadcast_to(ys, shape)
+   state = np.zeros(shape, dtype=np.intp)
+   ranks = np.zeros(shape, dtype=np.int64)
+   for i in xrange(order - 1, -1, -1):
+      half = 1 << i
+      quad = ((xs >> i) & 1) * 2 + ((ys >> i) & 1)
+      pos = quadPos[state, quad]
+      
+      # Widths and heights of the parts of the two columns and two rows of 
+      #    quadrants that are inside of the grid
+      minX = (xs >> (i + 1)) << (i + 1)
+      minY = (ys >> (i + 1)) << (i + 1)
+      widths = (np.clip(xSize - minX, 0, half), 
+                np.clip(xSize - minX - half, 0, half))
+      heights = (np.clip(ySize - minY, 0, half), 
+                 np.clip(ySize - minY - half, 0, half))
+      
+      # Count the cells inside of the grid in the quadrants visited first
+      for q in xrange(4):
+         ranks += (quadPos[state, q] < pos) * (widths[q >> 1] * 
+                                               heights[q & 1])
+      state = quadNext[state, quad]
+   return ranks
+
+# .............................................................................
+def pointsToHilbert(xs, ys, order):
+   """
+   @summary: Converts arrays of x and y coordinates to Hilbert curve positions
+   @param xs: An array of x coordinates
+   @param ys: An array of y coordinates, broadcast against xs
+   @param order: The order of the grid indexed by a Hilbert curve
+   @return: An array of positions with the broadcast shape of xs and ys
+   """
+   pointTable = _getHilbertTables()[0]
+   xs = np.asarray(xs, dtype=np.int64)
+   ys = np.asarray(ys, dtype=np.int64)
+   startState, nBytes = _startState(order)
+   
+   shape = np.broadcast(xs, ys).shape
+   state = np.full(shape, startState, dtype=np.int64)
+   positions = np.zeros(shape, dtype=np.int64)
+   for i in xrange(8 * (nBytes - 1), -1, -8):
+      v = pointTable[(state << 16) | (((xs >> i) & 0xFF) << 8) | 
+                                      ((ys >> i) & 0xFF)]
+      positions = (positions << 16) | (v >> 2)
+      state = v & 3
+   return positions
+
+# .............................................................................
+def hilbertToPoints(positions, order):
+   """
+   @summary: Converts an array of Hilbert curve positions to x and y 
+                coordinates
+   @param positions: An array of positions along the curve
+   @param order: The order of the grid indexed by a Hilbert curve
+   @return: An array of x coordinates and an array of y coordinates
+   """
+   positionTable = _getHilbertTables()[1]
+   positions = np.asarray(positions, dtype=np.int64)
+   startState, nBytes = _startState(order)
+   
+   state = np.full(positions.shape, startState, dtype=np.int64)
+   xs = np.zeros(positions.shape, dtype=np.int64)
+   ys = np.zeros(positions.shape, dtype=np.int64)
+   for i in xrange(16 * (nBytes - 1), -1, -16):
+      v = positionTable[(state << 16) | ((positions >> i) & 0xFFFF)]
+      xs = (xs << 8) | (v >> 10)
+      ys = (ys << 8) | ((v >> 2) & 0xFF)
+      state = v & 3
+   return xs, ys
+
+# .............................................................................
+def hilbertRankPermutation(xSize, ySize, order):
+   """
+   @summary: Returns the rank along a Hilbert curve of each cell of a grid, 
+                in row-major order, counting only the cells inside of the 
+                grid (see hilbertRank).  The curve is walked in order, so the
+                ranks are just a count of the cells found, without sorting. 
+                Only the blocks of the curve that overlap the grid are walked
+   @param xSize: The number of columns in the grid
+   @param ySize: The number of rows in the grid
+   @param order: The order of the grid indexed by a Hilbert curve
+   """
+   # Each run of 4**blockOrder positions fills one aligned square block
+   blockOrder = order / 2
+   blockSize = 4**blockOrder
+   starts = np.arange(4**(order - blockOrder), dtype=np.int64) * blockSize
+   blockXs, blockYs = hilbertToPoints(starts, order)
+   overlaps = ((blockXs >> blockOrder) << blockOrder < xSize) & \
+              ((blockYs >> blockOrder) << blockOrder < ySize)
+   positions = (starts[overlaps][:, np.newaxis] + 
+                np.arange(blockSize, dtype=np.int64)).ravel()
+   
+   xs, ys = hilbertToPoints(positions, order)
+   inside = (xs < xSize) & (ys < ySize)
+   ranks = np.empty(xSize * ySize, dtype=np.int64)
+   ranks[ys[inside] * xSize + xs[inside]] = np.arange(xSize * ySize)
+   return ranks
+
+# .............................................................................
+# Process-wide cache shared by all Hilbert compressed grids
+PERMUTATION_CACHE = HilbertPermutationCache()
 
 # .............................................................................
 if __name__ == "__main__":
@@ -339,4 +590,19 @@ if __name__ == "__main__":
    
    print cmp.query(1, 2)
    
-   print cmp.decompress().data
\ No newline at end of file
+   print cmp.decompress().data
+   
+   # The curve positions and points should convert back and forth
+   for order in xrange(6):
+      positions = np.arange(4**order)
+      xs, ys = hilbertToPoints(positions, order)
+      assert (pointsToHilbert(xs, ys, order) == positions).all()
+      assert [hilbertToPoint(p, order) for p in positions] == zip(xs, ys)
+   
+   # Walking the curve should rank the cells the same as counting them
+   for xSize, ySize in [(6, 5), (1, 9), (17, 3)]:
+      order = findOrder(xSize, ySize)
+      assert (hilbertRankPermutation(xSize, ySize, order) == 
+              hilbertRanks(np.arange(xSize)[np.newaxis, :], 
+                           np.arange(ySize)[:, np.newaxis], order, xSize, 
+                           ySize).ravel()).all()
@@ -0,0 +1,208 @@
+"""
+@summary: This module contains a class for compressing a grid using a Morton 
+             (Z-order) space filling curve.
+@author: CJ Grady
+@version: 2.0
+@status: beta
+
+@license: gpl2
+@copyright: Copyright (C) 2014, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+"""
+import numpy as np
+
+from matrix.matrix import Grid
+from methods.rle.hilbert import findOrder
+from methods.rle.rleBase import _RLECompressedGrid, decodeRuns, encodeRuns
+
+# .............................................................................
+class MortonRLECompressedGrid(_RLECompressedGrid):
+   """
+   @summary: This class compresses a grid using a Morton (Z-order) space 
+                filling curve.  The curve visits the quadrants of each block 
+                in the same order as the quadtree (upper left, upper right, 
+                lower left, lower right) so runs line up with quadtree blocks
+   """
+   METHOD = 7
+   VERSION = 2.0
+   RUN_WIDTH = 4
+   # ...........................
+   def _initialize(self):
+      self.order = 0
+   
+   # ...........................
+   def compress(self, grid):
+      """
+      @summary: Compresses a Grid into a MortonRLECompressedGrid
+      @param grid: The Grid object to compress
+      """
+      self.xSize = grid.xSize
+      self.ySize = grid.ySize
+
+      # Determine order
+      self.order = findOrder(self.xSize, self.ySize)
+
+      # Place each cell at its position along the curve
+      gridArray = grid.toArray()
+      lArray = np.zeros(4**self.order, dtype=gridArray.dtype)
+      lArray[self._positions()] = gridArray.ravel()
+
+      # Compress by fours
+      self._setRuns(encodeRuns(lArray, self.RUN_WIDTH))
+
+   # ...........................
+   def decompress(self):
+      """
+      @summary: Decompresses the compressed grid into a Grid object
+      """
+      lArray = decodeRuns(*self._getRuns())
+      data = lArray[self._positions()].reshape(self.ySize, self.xSize)
+      return Grid(griddedData=data)
+   
+   # ...........................
+   def _positions(self):
+      """
+      @summary: Returns the position along the curve of each cell of the grid,
+                   in row-major order
+      """
+      return pointsToMorton(np.arange(self.xSize)[np.newaxis, :], 
+                            np.arange(self.ySize)[:, np.newaxis]).ravel()
+   
+   # ...........................
+   def _linearIndex(self, x, y):
+      """
+      @summary: Returns the position of a cell in the linear array
+      """
+      return pointToMorton(x, y)
+   
+   # ...........................
+   def _linearIndices(self, xs, ys):
+      """
+      @summary: Returns the positions of many cells in the linear array
+      """
+      return pointsToMorton(xs, ys)
+   
+   # ...........................
+   def _setSize(self, xSize, ySize):
+      """
+      @summary: Sets the dimensions of the grid and the order of the curve
+      """
+      _RLECompressedGrid._setSize(self, xSize, ySize)
+      self.order = findOrder(self.xSize, self.ySize)
+
+   # ...........................
+   def _linearLength(self):
+      """
+      @summary: Returns the number of cells in the linear array
+      """
+      return 4**self.order
+
+# .............................................................................
+def _spreadBits(v):
+   """
+   @summary: Spreads the low 31 bits of an integer (or integer array) out so
+                that there is a zero bit between each of them
+   """
+   v = v & 0x7FFFFFFF
+   v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+   v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+   v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+   v = (v | (v << 2)) & 0x3333333333333333
+   v = (v | (v << 1)) & 0x5555555555555555
+   return v
+
+# .............................................................................
+def _compactBits(v):
+   """
+   @summary: Inverse of _spreadBits, collects every other bit of an integer 
+                (or integer array)
+   """
+   v = v & 0x5555555555555555
+   v = (v | (v >> 1)) & 0x3333333333333333
+   v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F
+   v = (v | (v >> 4)) & 0x00FF00FF00FF00FF
+   v = (v | (v >> 8)) & 0x0000FFFF0000FFFF
+   v = (v | (v >> 16)) & 0x7FFFFFFF
+   return v
+
+# .............................................................................
+def pointToMorton(x, y):
+   """
+   @summary: Converts an x,y coordinate pair to a position along a Morton 
+                curve by interleaving their bits.  x bits are stored in the 
+                even bits and y bits in the odd bits
+   @param x: The x coordinate
+   @param y: The y coordinate
+   """
+   return _spreadBits(x) | (_spreadBits(y) << 1)
+
+# .............................................................................
+def mortonToPoint(position):
+   """
+   @summary: Converts a position along a Morton curve to an x,y coordinate 
+                pair
+   @param position: The position along the curve
+   @return: An (x, y) tuple
+   """
+   return _compactBits(position), _compactBits(position >> 1)
+
+# .............................................................................
+def pointsToMorton(xs, ys):
+   """
+   @summary: Converts arrays of x and y coordinates to Morton curve positions
+   @param xs: An array of x coordinates
+   @param ys: An array of y coordinates, broadcast against xs
+   """
+   return pointToMorton(np.asarray(xs, dtype=np.int64), 
+                        np.asarray(ys, dtype=np.int64))
+
+# .............................................................................
+def mortonToPoints(positions):
+   """
+   @summary: Converts an array of Morton curve positions to x and y 
+                coordinates
+   @param positions: An array of positions along the curve
+   @return: An array of x coordinates and an array of y coordinates
+   """
+   return mortonToPoint(np.asarray(positions, dtype=np.int64))
+
+# .............................................................................
+if __name__ == "__main__":
+   data = [
+           [0, 0, 1, 0, 1, 1],
+           [1, 2, 3, 2, 1, 0],
+           [0, 3, 3, 2, 0, 0],
+           [1, 3, 3, 1, 1, 0],
+           [1, 3, 1, 1, 1, 1]
+          ]
+   
+   mtx = Grid(griddedData=data)
+   cmp = MortonRLECompressedGrid(grid=mtx)
+
+   cmp.write('mortonTest.bin')
+   
+   cmp2 = MortonRLECompressedGrid()
+   cmp2.read('mortonTest.bin')
+   
+   
+   print cmp2.query(1, 2)
+   
+   print cmp.decompress().data
@@ -27,25 +27,20 @@
           Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
           02110-1301, USA.
 """
-import struct
+import numpy as np
 
-from matrix.matrix import _CompressedGrid, Grid
+from matrix.matrix import Grid
+from methods.rle.rleBase import _RLECompressedGrid, decodeRuns, encodeRuns
 
 # .............................................................................
-class NormalRLECompressedGrid(_CompressedGrid):
+class NormalRLECompressedGrid(_RLECompressedGrid):
    """
    @summary: This class compresses a grid using left to right run length 
                 encoding
    """
    METHOD = 1
    VERSION = 2.0
-   # ...........................
-   def __init__(self, grid=None):
-      if grid is not None:
-         self.compress(grid)
-      else:
-         self.lyrs = []
-   
+   RUN_WIDTH = 2
    # ...........................
    def compress(self, grid):
       """
@@ -55,196 +50,33 @@ class NormalRLECompressedGrid(_CompressedGrid):
       self.xSize = grid.xSize
       self.ySize = grid.ySize
       
-      lArray = []
-      for row in grid.data:
-         lArray.extend(row)
-      
-      self.cmpData = []
+      lArray = grid.toArray().ravel()
       
       # Compress by twos
-      cur = (lArray[0], lArray[1])
-      num = 1
-      for i in xrange(2, len(lArray), 2):
-         try:
-            if cur == (lArray[i], lArray[i+1]):
-               num += 1
-            else:
-               self.cmpData.append((cur, num))
-               cur = (lArray[i], lArray[i+1])
-               num = 1
-         except IndexError:
-            # This happens if there is an odd number of items
-            self.cmpData.append((cur, num))
-            cur = (lArray[-1])
-            num = 1
-      self.cmpData.append((cur, num))
+      self._setRuns(encodeRuns(lArray, self.RUN_WIDTH))
 
    # ...........................
    def decompress(self):
       """
       @summary: Decompresses the compressed grid into a Grid object
       """
-      data = []
-      for y in xrange(self.ySize):
-         row = []
-         for x in xrange(self.xSize):
-            row.append(0)
-         data.append(row)
-      
-      lArray = []
-      for cur, num in self.cmpData:
-         lArray.extend(num*list(cur))
-         
-      x = 0
-      y = 0
-      for i in lArray:
-         data[y][x] = i
-         x += 1
-         if x == self.xSize:
-            x = 0
-            y += 1
-      
-      return Grid(griddedData = data)
+      lArray = decodeRuns(*self._getRuns())
+      return Grid(griddedData=lArray.reshape(self.ySize, self.xSize))
    
    # ...........................
-   def query(self, x, y):
+   def _linearIndex(self, x, y):
       """
-      @summary: Queries the compressed grid to find the value at the specified 
-                   coordinates
-      @param x: The x (horizontal) coordinate, starts from the left, zero-based
-      @param y: The y (vertical) coordinate, starts at the top, zero-based
+      @summary: Returns the position of a cell in the linear array
       """
-      idx = y * self.xSize + x
-      ret = None
-      
-      pos = 0
-      for cur, num in self.cmpData:
-         pos = pos + num * len(cur)
-         if pos > idx:
-            tmp = list(cur)
-            biggerList = num * tmp
-            retIdx = idx - pos
-            ret = biggerList[retIdx]
-            break
-            #ret = (num * list(cur))[idx - pos]
-      return ret
+      return y * self.xSize + x
    
    # ...........................
-   def read(self, fn):
+   def _linearIndices(self, xs, ys):
       """
-      @summary: Reads in the compressed grid from a file
-      @param fn: The filename to read from
+      @summary: Returns the positions of many cells in the linear array
       """
-      with open(fn, 'rb') as f:
-         method = struct.unpack('<B', f.read(1))[0]
-         version = struct.unpack('<f', f.read(4))[0]
-         self.xSize = struct.unpack('<l', f.read(4))[0]
-         self.ySize = struct.unpack('<l', f.read(4))[0]
-
-         tmpData = []
-         
-         # Read all data and compile list with keys
-         tmp = f.read(1)
-         while struct.unpack('<B', tmp)[0] != 0:
-            cl = struct.unpack('<B', tmp)[0]
-            num = struct.unpack('<B', f.read(1))[0]
-            if num == 0:
-               num = struct.unpack('<H', f.read(2))[0]
-               if num == 0:
-                  num = struct.unpack('<L', f.read(4))[0]
-            tmpData.append((cl, num))
-            tmp = f.read(1)
-         
-         # Read classes
-         clDict = {}
-         tmp = f.read(1)
-         while tmp != "":
-            clId = struct.unpack('<B', tmp)[0]
-            nCats = struct.unpack('<B', f.read(1))[0]
-            val = []
-            for i in xrange(nCats):
-               nVal = struct.unpack('<B', f.read(1))[0]
-               val.append(nVal)
-            clDict[clId] = val
-            tmp = f.read(1)
-         
-         # Translate keys into classes
-         self.cmpData = []
-         
-         for k, num in tmpData:
-            self.cmpData.append((clDict[k], num))
-
-   # ...........................
-   def write(self, fn):
-      """
-      @summary: Writes out the compressed grid
-      @param fn: The filename to write to
-      """
-      with open(fn, 'wb') as f:
-         # Write method
-         f.write(struct.pack('<B', self.METHOD))
-         # Write version
-         f.write(struct.pack('<f', self.VERSION))
-         
-         # Write x size and y size
-         f.write(struct.pack('<l', self.xSize))
-         f.write(struct.pack('<l', self.ySize))
-         
-         # Find all classes
-         clDict = {}
-         for cl, num in self.cmpData:
-            if clDict.has_key(cl):
-               clDict[cl] += 1
-            else:
-               clDict[cl] = 1
-         
-         sortedClasses = sorted(list(clDict.viewitems()), key=lambda k: k[1], reverse=True)
-         
-         #   Assign them ids
-         clIds = {}
-         i = 0
-         for cl, num in sortedClasses:
-            i += 1
-            clIds[cl] = i
-
-         #   Make sure that there are less than 256
-         #      if not, break some of them down
-         
-         
-         # Write data
-         for cl, num in self.cmpData:
-            # Write out class identifier
-            f.write(struct.pack('<B', clIds[cl]))
-            
-            # Bit twidding based on run-length, if over threshold, we need to 
-            #   write it out with more bytes.  We need to indicate this though
-            #   so that it can be handled on read
-            if num < 256:
-               f.write(struct.pack('<B', num))
-            elif num < 65536:
-               # Write indicator to bump up size
-               f.write(struct.pack('<B', 0))
-               # Write number
-               f.write(struct.pack('<H', num))
-            else:
-               # Write indicator to bump up twice
-               f.write(struct.pack('<B', 0))
-               f.write(struct.pack('<H', 0))
-               # Write number
-               f.write(struct.pack('<L', num))
-         
-         # Write separator
-         f.write(struct.pack('<B', 0))
-         
-         # Write out all classes
-         for k in clIds.keys():
-            # Write id
-            f.write(struct.pack('<B', clIds[k]))
-            # Write number of items in key
-            f.write(struct.pack('<B', len(list(k))))
-            # Write items
-            for i in list(k):
-               f.write(struct.pack('<B', i))
+      return np.asarray(ys, dtype=np.int64) * self.xSize + \
+             np.asarray(xs, dtype=np.int64)
 
 # .............................................................................
 if __name__ == "__main__":
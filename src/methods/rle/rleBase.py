@@ -0,0 +1,631 @@
+"""
+@summary: This module contains a base class for grids compressed by run length
+             encoding a linear ordering of their cells, along with the
+             functions used to encode runs and to read and write them
+@author: CJ Grady
+@version: 2.0
+@status: beta
+
+@license: gpl2
+@copyright: Copyright (C) 2014, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+"""
+import numpy as np
+import struct
+
+from matrix.matrix import _CompressedGrid, countValues, findDtype
+
+# Header for run length encoded files: method, version, x size, y size
+RLE_HEADER = struct.Struct('<Bfll')
+
+# .............................................................................
+class _RLECompressedGrid(_CompressedGrid):
+   """
+   @summary: Base class for run length encoded grids.  Sub classes define how
+                the cells are ordered into a linear array and how many cells
+                are grouped together in each run (RUN_WIDTH)
+   """
+   RUN_WIDTH = None
+   # ...........................
+   def __init__(self, grid=None):
+      self._cmpData = None
+      self._runs = None
+      self._offsets = None
+      self.lyrs = []
+      self._initialize()
+      if grid is not None:
+         self.compress(grid)
+
+   # ...........................
+   def _initialize(self):
+      """
+      @summary: Use this method in sub-classes to initialize any variables
+      """
+      pass
+
+   # ...........................
+   def _getCmpData(self):
+      """
+      @summary: Returns the runs as a list of (tuple of values, number of
+                   repetitions) pairs.  The list is only built when requested
+                   if the runs are held as arrays
+      """
+      if self._cmpData is None and self._runs is not None:
+         self._cmpData = runsToList(*self._runs)
+      return self._cmpData
+
+   # ...........................
+   def _setCmpData(self, cmpData):
+      self._cmpData = cmpData
+      self._runs = None
+      self._offsets = None
+
+   cmpData = property(_getCmpData, _setCmpData)
+
+   # ...........................
+   def _getRuns(self):
+      """
+      @summary: Returns the runs as a (values, counts, tail) tuple of arrays
+                   (see encodeRuns)
+      """
+      if self._runs is None:
+         self._runs = listToRuns(self._cmpData)
+      return self._runs
+
+   # ...........................
+   def _setRuns(self, runs):
+      """
+      @summary: Sets the runs from a (values, counts, tail) tuple of arrays
+      """
+      self.cmpData = None
+      self._runs = runs
+
+   # ...........................
+   def _setSize(self, xSize, ySize):
+      """
+      @summary: Sets the dimensions of the grid when the runs come from a file
+                   rather than from compressing a grid
+      """
+      self.xSize = xSize
+      self.ySize = ySize
+
+   # ...........................
+   def _linearLength(self):
+      """
+      @summary: Returns the number of cells in the linear array
+      """
+      return self.xSize * self.ySize
+
+   # ...........................
+   def _linearIndex(self, x, y):
+      """
+      @summary: Returns the position of a cell in the linear array
+      """
+      raise Exception, "_linearIndex must be implemented in sub class"
+
+   # ...........................
+   def _linearIndices(self, xs, ys):
+      """
+      @summary: Returns the positions of many cells in the linear array
+      @param xs: An array of x coordinates
+      @param ys: An array of y coordinates, broadcast against xs
+      """
+      raise Exception, "_linearIndices must be implemented in sub class"
+
+   # ...........................
+   def query(self, x, y):
+      """
+      @summary: Queries the compressed grid to find the value at the specified
+                   coordinates
+      @param x: The x (horizontal) coordinate, starts from the left, zero-based
+      @param y: The y (vertical) coordinate, starts at the top, zero-based
+      """
+      idx = self._linearIndex(x, y)
+
+      if self._offsets is None:
+         self._buildOffsets()
+
+      # Find the run containing the cell
+      i = int(np.searchsorted(self._offsets, idx, side='right'))
+      if i >= len(self._offsets):
+         return None
+      start = int(self._offsets[i-1]) if i > 0 else 0
+      vals, nums, tail = self._getRuns()
+      if i == len(nums):
+         cur = tail[0]
+         return cur[(idx - start) % len(cur)]
+      return vals.item(i, (idx - start) % vals.shape[1])
+
+   # ...........................
+   def queryWindow(self, x0, y0, x1, y1):
+      """
+      @summary: Queries the compressed grid for all of the values in a window.
+                   Only the runs that hold cells of the window are looked at
+      @param x0: The left edge of the window (inclusive)
+      @param y0: The top edge of the window (inclusive)
+      @param x1: The right edge of the window (exclusive)
+      @param y1: The bottom edge of the window (exclusive)
+      @return: A 2-D NumPy array with y1-y0 rows and x1-x0 columns
+      """
+      self._checkWindow(x0, y0, x1, y1)
+      idx = self._linearIndices(np.arange(x0, x1)[np.newaxis, :],
+                                np.arange(y0, y1)[:, np.newaxis])
+      return self._lookup(idx.ravel()).reshape(y1 - y0, x1 - x0)
+
+   # ...........................
+   def queryMany(self, xs, ys):
+      """
+      @summary: Queries the compressed grid for the values at many points.  
+                   The points are sorted by their position in the linear 
+                   array so that the runs are visited in order
+      @param xs: An array of x coordinates
+      @param ys: An array of y coordinates, broadcast against xs
+      @return: A NumPy array of values with the broadcast shape of xs and ys
+      """
+      xs, ys = self._checkPoints(xs, ys)
+      idx = self._linearIndices(xs, ys).ravel()
+      order = np.argsort(idx)
+      ret = np.empty(idx.shape, dtype=self._getRuns()[0].dtype)
+      ret[order] = self._lookup(idx[order])
+      return ret.reshape(xs.shape)
+
+   # ...........................
+   def classCounts(self, window=None):
+      """
+      @summary: Counts the cells of each class from the run lengths.  Counts 
+                   for a window are found from the cells of the window
+      @param window: (optional) An (x0, y0, x1, y1) window to count the cells
+                        of instead of the whole grid (see queryWindow)
+      @return: A dictionary of class to number of cells
+      """
+      if window is not None:
+         return _CompressedGrid.classCounts(self, window=window)
+      
+      # Each run adds its length to every value of its group
+      vals, nums, tail = self._getRuns()
+      values = [vals.ravel()]
+      weights = [np.repeat(nums, vals.shape[1])]
+      if tail is not None:
+         cur, num = tail
+         values.append(np.array(cur, dtype=vals.dtype))
+         weights.append(np.repeat(num, len(cur)))
+      counts = countValues(np.concatenate(values), np.concatenate(weights))
+      
+      # Curves longer than the grid are padded with zeros
+      numPadded = self._linearLength() - self.xSize * self.ySize
+      if numPadded > 0:
+         counts[0] -= numPadded
+         if counts[0] == 0:
+            del counts[0]
+      return counts
+
+   # ...........................
+   def _lookup(self, idx):
+      """
+      @summary: Finds the values at many positions of the linear array
+      @param idx: An array of positions in the linear array
+      """
+      if self._offsets is None:
+         self._buildOffsets()
+
+      vals, nums, tail = self._getRuns()
+      idx = np.asarray(idx, dtype=np.int64)
+
+      # Find the run containing each cell and the position inside of it
+      i = np.searchsorted(self._offsets, idx, side='right')
+      starts = np.where(i > 0, self._offsets[i-1], 0)
+      inRuns = i < len(nums)
+      
+      ret = np.empty(idx.shape, dtype=vals.dtype)
+      ret[inRuns] = vals[i[inRuns], 
+                         (idx[inRuns] - starts[inRuns]) % vals.shape[1]]
+      if tail is not None:
+         cur = np.array(tail[0], dtype=vals.dtype)
+         inTail = ~inRuns
+         ret[inTail] = cur[(idx[inTail] - starts[inTail]) % len(cur)]
+      return ret
+
+   # ...........................
+   def _buildOffsets(self):
+      """
+      @summary: Builds the run offset index.  Each entry is the linear index of
+                   the first cell after the corresponding run
+      """
+      vals, nums, tail = self._getRuns()
+      offsets = np.cumsum(nums * vals.shape[1])
+      if tail is not None:
+         cur, num = tail
+         offsets = np.append(offsets, 
+                     (offsets[-1] if len(offsets) else 0) + num * len(cur))
+      self._offsets = offsets.astype(np.int64)
+
+   # ...........................
+   def read(self, fn):
+      """
+      @summary: Reads in the compressed grid from a file
+      @param fn: The filename to read from
+      """
+      with open(fn, 'rb') as f:
+         buf = f.read()
+
+      method, version, xSize, ySize = RLE_HEADER.unpack_from(buf)
+      self._setSize(xSize, ySize)
+
+      runIds, counts, pos = unpackRuns(buf, RLE_HEADER.size)
+      clDict = unpackClasses(buf, pos)
+
+      self._setRuns(idsToRuns(runIds, counts, clDict))
+
+   # ...........................
+   def write(self, fn):
+      """
+      @summary: Writes out the compressed grid
+      @param fn: The filename to write to
+      """
+      clIds, runIds, counts = assignClassIds(*self._getRuns())
+
+      with open(fn, 'wb') as f:
+         f.write(''.join([
+                     RLE_HEADER.pack(self.METHOD, self.VERSION,
+                                     self.xSize, self.ySize),
+                     packRuns(runIds, counts),
+                     # Write separator
+                     struct.pack('<B', 0),
+                     packClasses(clIds)
+                    ]))
+
+# .............................................................................
+def encodeRuns(lArray, groupSize):
+   """
+   @summary: Run-length encodes a linear array in groups of values
+   @param lArray: A 1-D NumPy array (or list) of cell values
+   @param groupSize: The number of consecutive values in each run tuple.  If
+                        the length of the array is not a multiple of this, the
+                        remaining values are stored as a final, shorter run
+   @return: A (values, counts, tail) tuple.  values is a 2-D array with the
+               group of values for each run, counts is an array with the
+               number of repetitions of each run, and tail is either None or
+               a (tuple of values, number of repetitions) pair for the
+               shorter, final run
+   """
+   lArray = np.asarray(lArray)
+   nGroups = len(lArray) / groupSize
+   groups = lArray[:nGroups * groupSize].reshape(nGroups, groupSize)
+
+   if nGroups > 0:
+      # Find the first group of every run
+      starts = np.concatenate(([0],
+                     np.flatnonzero(_groupChanges(groups)) + 1))
+      counts = np.diff(np.append(starts, nGroups))
+      vals = groups[starts]
+   else:
+      counts = np.zeros(0, dtype=np.int64)
+      vals = groups
+
+   tail = None
+   if len(lArray) > nGroups * groupSize:
+      tail = (tuple(lArray[nGroups * groupSize:].tolist()), 1)
+   return vals, counts.astype(np.int64), tail
+
+# .............................................................................
+def encodeRowRuns(rows, groupSize):
+   """
+   @summary: Run-length encodes each row of a 2-D array separately, in groups 
+                of values.  Runs do not continue from one row to the next
+   @param rows: A 2-D NumPy array with one linear array per row
+   @param groupSize: The number of consecutive values in each run tuple.  The
+                        length of the rows must be a multiple of this
+   @return: A (values, counts, bounds) tuple.  values and counts hold the 
+               runs of all of the rows (see encodeRuns) and the runs of row 
+               i are from bounds[i] up to bounds[i+1]
+   """
+   rows = np.asarray(rows)
+   groupsPerRow = rows.shape[1] / groupSize
+   groups = rows.reshape(-1, groupSize)
+
+   # A run starts where the group changes or where a row starts
+   isStart = np.ones(len(groups), dtype=np.bool_)
+   if len(groups) > 1:
+      isStart[1:] = _groupChanges(groups)
+   isStart[::groupsPerRow] = True
+   starts = np.flatnonzero(isStart)
+
+   counts = np.diff(np.append(starts, len(groups))).astype(np.int64)
+   bounds = np.searchsorted(starts, 
+                            np.arange(len(rows) + 1) * groupsPerRow)
+   return groups[starts], counts, bounds
+
+# .............................................................................
+def decodeRuns(vals, counts, tail):
+   """
+   @summary: Expands run-length encoded data into a linear NumPy array
+   @param vals: A 2-D array with the group of values for each run
+   @param counts: An array with the number of repetitions of each run
+   @param tail: None or a (tuple of values, number of repetitions) pair for a
+                   shorter, final run
+   """
+   lArray = np.repeat(vals, counts, axis=0).ravel()
+   if tail is not None:
+      cur, num = tail
+      lArray = np.append(lArray, num * list(cur))
+   return lArray
+
+# .............................................................................
+def runsToList(vals, counts, tail):
+   """
+   @summary: Converts runs held as arrays into a list of (tuple of values,
+                number of repetitions) pairs
+   """
+   cmpData = zip([tuple(v) for v in vals.tolist()], counts.tolist())
+   if tail is not None:
+      cmpData.append(tail)
+   return cmpData
+
+# .............................................................................
+def listToRuns(cmpData):
+   """
+   @summary: Converts a list of (tuple of values, number of repetitions) pairs
+                into a (values, counts, tail) tuple of arrays
+   """
+   tail = None
+   if len(cmpData) > 1 and len(cmpData[-1][0]) != len(cmpData[0][0]):
+      tail = (tuple(cmpData[-1][0]), cmpData[-1][1])
+      cmpData = cmpData[:-1]
+
+   vals = np.array([cur for cur, _ in cmpData]).reshape(len(cmpData), -1)
+   if vals.size > 0:
+      vals = vals.astype(findDtype(vals.min(), vals.max()))
+   counts = np.array([num for _, num in cmpData], dtype=np.int64)
+   return vals, counts, tail
+
+# .............................................................................
+def assignClassIds(vals, counts, tail):
+   """
+   @summary: Assigns a one byte identifier to each distinct run tuple.  The
+                most frequent tuples get the lowest identifiers
+   @param vals: A 2-D array with the group of values for each run
+   @param counts: An array with the number of repetitions of each run
+   @param tail: None or a (tuple of values, number of repetitions) pair for a
+                   shorter, final run
+   @return: A dictionary of tuple to identifier, an array with the identifier
+               of every run and an array with the number of repetitions of
+               every run (including the tail)
+   """
+   keys = _groupKeys(vals)
+   uniq, first, inverse, numRuns = np.unique(keys, return_index=True,
+                                             return_inverse=True,
+                                             return_counts=True)
+   uniqVals = [tuple(vals[i].tolist()) for i in first.tolist()]
+
+   # Add the classes in the order they first appear so that the ordering of
+   #    classes with the same frequency is repeatable
+   clDict = {}
+   for u in np.argsort(first, kind='mergesort').tolist():
+      clDict[uniqVals[u]] = int(numRuns[u])
+   if tail is not None:
+      clDict[tail[0]] = clDict.get(tail[0], 0) + 1
+
+   sortedClasses = sorted(list(clDict.viewitems()), key=lambda k: k[1],
+                          reverse=True)
+
+   #   Assign them ids
+   clIds = {}
+   i = 0
+   for cl, num in sortedClasses:
+      i += 1
+      clIds[cl] = i
+
+   #   Zero is reserved for the separator
+   if len(clIds) > 255:
+      raise Exception, "Too many distinct runs (%s) to store" % len(clIds)
+
+   runIds = np.array([clIds[v] for v in uniqVals], dtype=np.uint8)[inverse]
+   if tail is not None:
+      runIds = np.append(runIds, np.uint8(clIds[tail[0]]))
+      counts = np.append(counts, tail[1])
+   return clIds, runIds, counts
+
+# .............................................................................
+def packRuns(runIds, counts):
+   """
+   @summary: Packs runs into a string of bytes.  Each run is written as a one
+                byte class identifier followed by the number of repetitions.
+                The number of repetitions uses one byte if it is less than
+                256.  Otherwise a zero byte is written and it is bumped up to
+                two bytes, and if it is still too big, two more zero bytes
+                are written and it is stored with four bytes
+   @param runIds: An array of class identifiers for each run
+   @param counts: An array with the number of repetitions of each run
+   """
+   counts = np.asarray(counts, dtype=np.int64)
+   sizes = packedRunSizes(counts)
+   starts = np.cumsum(sizes) - sizes
+
+   buf = np.zeros(sizes.sum(), dtype=np.uint8)
+   buf[starts] = runIds
+
+   small = counts < 256
+   buf[starts[small] + 1] = counts[small]
+
+   medium = (sizes == 4)
+   buf[starts[medium] + 2] = counts[medium] & 0xFF
+   buf[starts[medium] + 3] = counts[medium] >> 8
+
+   large = (sizes == 8)
+   for b in xrange(4):
+      buf[starts[large] + 4 + b] = (counts[large] >> (8 * b)) & 0xFF
+
+   return buf.tobytes()
+
+# .............................................................................
+def packedRunSizes(counts):
+   """
+   @summary: Returns the number of bytes that packRuns uses for each run
+   @param counts: An array with the number of repetitions of each run
+   """
+   counts = np.asarray(counts, dtype=np.int64)
+   return np.where(counts < 256, 2, np.where(counts < 65536, 4, 8))
+
+# .............................................................................
+def unpackRuns(buf, pos):
+   """
+   @summary: Unpacks runs written by packRuns up to the zero separator byte
+   @param buf: A string (or buffer) holding the packed runs
+   @param pos: The offset of the first run in the buffer
+   @return: An array of class identifiers, an array with the number of
+               repetitions of each run and the offset following the separator
+   @note: Every run takes an even number of bytes so the runs are viewed as
+             two byte words.  Only the words with a zero byte, the runs with
+             wider repetition counts and the separator, need to be looked at
+             one at a time
+   """
+   stream = np.frombuffer(buf, dtype=np.uint8, offset=pos)
+   if len(stream) % 2:
+      stream = np.append(stream, np.uint8(0))
+   words = stream.reshape(-1, 2)
+   ids = words[:, 0]
+   nums = words[:, 1]
+
+   wide = []
+   sepWord = None
+   skipUntil = 0
+   for w in np.flatnonzero((ids == 0) | (nums == 0)).tolist():
+      if w < skipUntil:
+         # Part of a wider repetition count
+         continue
+      if ids[w] == 0:
+         sepWord = w
+         break
+      num = struct.unpack_from('<H', buf, pos + 2 * w + 2)[0]
+      if num != 0:
+         wide.append((w, 2, num))
+      else:
+         num = struct.unpack_from('<L', buf, pos + 2 * w + 4)[0]
+         wide.append((w, 4, num))
+      skipUntil = w + wide[-1][1]
+
+   if sepWord is None:
+      raise Exception, "Separator not found after runs"
+
+   isRun = np.ones(sepWord, dtype=np.bool_)
+   for w, nWords, _ in wide:
+      isRun[w+1:w+nWords] = False
+   runWords = np.flatnonzero(isRun)
+
+   runIds = ids[runWords]
+   counts = nums[runWords].astype(np.int64)
+   if wide:
+      counts[np.searchsorted(runWords, [w for w, _, _ in wide])] = [
+                                                    num for _, _, num in wide]
+   return runIds, counts, pos + 2 * sepWord + 1
+
+# .............................................................................
+def packClasses(clIds):
+   """
+   @summary: Packs the class dictionary into a string of bytes.  Each class
+                is written as its identifier, the number of values in it, and
+                then the values
+   @param clIds: A dictionary of tuple to class identifier
+   """
+   parts = []
+   for k in clIds.keys():
+      parts.append(struct.pack('<BB%sB' % len(k), clIds[k], len(k), *k))
+   return ''.join(parts)
+
+# .............................................................................
+def unpackClasses(buf, pos, end=None):
+   """
+   @summary: Unpacks a class dictionary written by packClasses
+   @param buf: A string (or buffer) holding the packed classes
+   @param pos: The offset of the first class in the buffer
+   @param end: (optional) The offset where the classes end, defaults to the
+                  end of the buffer
+   @return: A dictionary of class identifier to tuple
+   """
+   if end is None:
+      end = len(buf)
+   clDict = {}
+   while pos < end:
+      clId, nCats = struct.unpack_from('<BB', buf, pos)
+      clDict[clId] = struct.unpack_from('<%sB' % nCats, buf, pos + 2)
+      pos += 2 + nCats
+   return clDict
+
+# .............................................................................
+def idsToRuns(runIds, counts, clDict):
+   """
+   @summary: Translates class identifiers into a (values, counts, tail) tuple
+                of run arrays
+   @param runIds: An array of class identifiers for each run
+   @param counts: An array with the number of repetitions of each run
+   @param clDict: A dictionary of class identifier to tuple
+   """
+   tail = None
+   width = len(clDict[runIds[0]]) if len(runIds) > 0 else 0
+   if len(runIds) > 1 and len(clDict[runIds[-1]]) != width:
+      tail = (clDict[runIds[-1]], int(counts[-1]))
+      runIds = runIds[:-1]
+      counts = counts[:-1]
+
+   maxV = max([max(v) for v in clDict.values() if len(v) > 0] + [0])
+   table = np.zeros((256, width), dtype=findDtype(0, maxV))
+   for clId, v in clDict.iteritems():
+      if len(v) == width:
+         table[clId] = v
+   return table[runIds], counts, tail
+
+# .............................................................................
+def countDistinctGroups(groups):
+   """
+   @summary: Returns the number of distinct groups of values (rows) in a 2-D 
+                array, which is the number of classes needed to write them
+   @param groups: A 2-D array with one group of values per row
+   """
+   if len(groups) == 0:
+      return 0
+   return len(np.unique(_groupKeys(groups)))
+
+# .............................................................................
+def _groupKeys(groups):
+   """
+   @summary: Returns a 1-D array with a single, comparable key for each group
+                of values (row) in a 2-D array
+   """
+   groups = np.ascontiguousarray(groups)
+   groupBytes = groups.dtype.itemsize * groups.shape[1]
+   if groups.dtype.kind in 'ui' and groupBytes in (1, 2, 4, 8):
+      # Pack each group into a single unsigned integer
+      return groups.view('u%s' % groupBytes).ravel()
+   else:
+      return groups.view(np.dtype((np.void, groupBytes))).ravel()
+
+# .............................................................................
+def _groupChanges(groups):
+   """
+   @summary: Returns a boolean array indicating where each group of values
+                differs from the previous group
+   @param groups: A 2-D array with one group of values per row
+   """
+   keys = _groupKeys(groups)
+   if keys.dtype.kind == 'u':
+      return np.diff(keys) != 0
+   else:
+      return np.any(groups[1:] != groups[:-1], axis=1)
@@ -0,0 +1,587 @@
+"""
+@summary: Module containing an array-backed S-Tree.  The structure of the 
+             tree is a bit string of leaf flags in level order and the leaf 
+             values are a separate bit-packed array
+@author: CJ Grady
+@version: 1.0
+@status: beta
+
+@license: gpl2
+@copyright: Copyright (C) 2014, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+"""
+import array
+import numpy as np
+import sys
+
+from matrix.matrix import countValues, Grid, _CompressedGrid, findDtype
+from methods.trees.sTree import streeSplits
+from methods.trees.treeBase import fillBlocks, isPackedTree, PackedTree, \
+                                   TREE_HEADER, valueBits
+
+# The number of one bits in each byte value
+POPCOUNT = np.array([bin(i).count('1') for i in xrange(256)], dtype=np.uint8)
+
+# The rank directory counts the leaves before every 64 bit word of the flags, 
+#    as a 32 bit count for every superblock of four words and an 8 bit count
+#    from the start of the superblock for each word
+WORDS_PER_SUPERBLOCK = 4
+
+# The skip index holds the node covering each block at one depth, so that 
+#    point queries start there instead of at the root.  The depth is the 
+#    deepest one with no more than one block for this many nodes
+NODES_PER_SKIP = 16
+
+# .............................................................................
+class CompactSTreeCompressedGrid(_CompressedGrid):
+   """
+   @summary: This class compresses a grid using the same S-Tree as 
+                STreeCompressedGrid, without any dictionary nodes.  The nodes
+                are stored in level order as a bit string of leaf flags (1 
+                for a leaf) and the leaf values are stored in the same order
+                as bit-packed indices into a class table.  The two children 
+                of the k-th internal node are nodes 2k+1 and 2k+2, and the 
+                value of a leaf is found from the number of leaves before it,
+                so a small rank directory over the flags lets queries jump 
+                straight to the next level instead of walking subtrees.  A 
+                skip index of the nodes at one depth lets point queries 
+                start part of the way down the tree
+   """
+   METHOD = 10
+   VERSION = 1.0
+   
+   # ...........................
+   def __init__(self, grid=None):
+      if grid is not None:
+         self.compress(grid)
+      else:
+         self.xSize = None
+         self.ySize = None
+         self.xOrder = self.yOrder = self.order = 0
+         self.splits = []
+         self.widths = [1]
+         self.heights = [1]
+         self.numNodes = self.numLeaves = 0
+         self.classes = np.zeros(0, dtype=np.int64)
+         self.nBits = 0
+         self.valueBytes = np.zeros(0, dtype=np.uint8)
+         self._setFlags(np.zeros(0, dtype=np.uint8))
+   
+   # ...........................
+   def compress(self, mtx):
+      self.xSize = mtx.xSize
+      self.ySize = mtx.ySize
+      
+      # Determine orders
+      self._findOrders()
+      
+      paddedMtx = mtx.toPaddedArray(2**self.xOrder, 2**self.yOrder)
+      
+      flags, values = compactSTreeCompress(paddedMtx, self.xOrder, 
+                                           self.yOrder)
+      self.classes, ids = np.unique(values, return_inverse=True)
+      self.classes = self.classes.astype(findDtype(self.classes.min(), 
+                                                   self.classes.max()))
+      self.nBits = valueBits(len(self.classes))
+      self.numLeaves = len(values)
+      
+      # Take the low nBits of each big-endian identifier
+      idBits = np.unpackbits(ids.astype('>u4').view(np.uint8).reshape(-1, 4),
+                             axis=1)[:, 32 - self.nBits:]
+      self.valueBytes = np.packbits(idBits.ravel())
+      self._setFlags(flags)
+   
+   # ...........................
+   def _findOrders(self):
+      """
+      @summary: Finds the orders of the padded grid from its size, along with 
+                   the split direction and block size at each depth
+      """
+      self.xOrder = self.yOrder = 0
+      
+      while 2**self.xOrder < self.xSize:
+         self.xOrder += 1
+         
+      while 2**self.yOrder < self.ySize:
+         self.yOrder += 1
+      
+      self.order = 0
+      while 2**self.order < max([self.xSize, self.ySize]):
+         self.order += 1
+      
+      self.splits = streeSplits(self.xOrder, self.yOrder)
+      self.widths = [2**self.xOrder]
+      self.heights = [2**self.yOrder]
+      for splitX in self.splits:
+         if splitX:
+            self.widths.append(self.widths[-1] / 2)
+            self.heights.append(self.heights[-1])
+         else:
+            self.widths.append(self.widths[-1])
+            self.heights.append(self.heights[-1] / 2)
+   
+   # ...........................
+   def _setFlags(self, flags):
+      """
+      @summary: Packs the leaf flags into 64 bit words and builds the rank 
+                   directory and the skip index
+      @param flags: An array with the leaf flag of each node in level order
+      """
+      self.numNodes = len(flags)
+      numWords = (self.numNodes + 63) / 64
+      bits = np.zeros(64 * numWords, dtype=np.uint8)
+      bits[:self.numNodes] = flags
+      
+      # The words share their memory with the bytes
+      self.flagBytes = np.packbits(bits)
+      self.flagWords = self.flagBytes.view('>u8')
+      
+      wordRanks = np.zeros(numWords, dtype=np.int64)
+      np.cumsum(bits.reshape(numWords, 64).sum(axis=1)[:-1], 
+                out=wordRanks[1:])
+      self.superRanks = wordRanks[::WORDS_PER_SUPERBLOCK].astype(np.uint32)
+      self.wordRanks = (wordRanks - np.repeat(self.superRanks, 
+               WORDS_PER_SUPERBLOCK)[:numWords]).astype(np.uint8)
+      self._setSkipIndex()
+      
+      # Point queries read one value at a time, which is much faster from 
+      #    plain Python sequences than from NumPy arrays.  They use 32 bit 
+      #    words, which stay plain integers instead of longs, each with the 
+      #    number of leaves before it
+      halfWords = self.flagBytes.view('>u4')
+      halfRanks = np.zeros(len(halfWords), dtype=np.int64)
+      np.cumsum(bits.reshape(-1, 32).sum(axis=1)[:-1], out=halfRanks[1:])
+      self._wordList = array.array('I', halfWords.tolist())
+      self._rankList = array.array('i', halfRanks.tolist())
+      self._valueList = bytearray(self.valueBytes.tobytes())
+      self._classList = self.classes.tolist()
+      
+      # Blocks of the skip index inside of a leaf hold the complement of its
+      #    class index, so most queries on blocky grids never walk the tree
+      skip = self.skipIndex.ravel().astype(np.int64)
+      if len(skip) > 0:
+         isLeaf = self._flags(skip) == 1
+         skip[isLeaf] = ~self._leafIds(self._rank(skip[isLeaf]))
+      self._skipList = array.array('i', skip.tolist())
+      
+      # The branch taken at each split below the skip depth is one bit of a
+      #    path, the first split in the highest bit.  Each coordinate adds 
+      #    its own bits, so the path of a cell is the sum of two lookups
+      numSteps = len(self.splits) - self.skipDepth
+      xOrder = self.xOrder - self.splits[:self.skipDepth].count(True)
+      yOrder = self.yOrder - self.splits[:self.skipDepth].count(False)
+      xPaths = np.zeros(2**self.xOrder, dtype=np.int64)
+      yPaths = np.zeros(2**self.yOrder, dtype=np.int64)
+      for i, splitX in enumerate(self.splits[self.skipDepth:]):
+         if splitX:
+            xOrder -= 1
+            xPaths |= ((np.arange(len(xPaths)) >> xOrder) & 1) << \
+                                                         (numSteps - 1 - i)
+         else:
+            yOrder -= 1
+            yPaths |= ((np.arange(len(yPaths)) >> yOrder) & 1) << \
+                                                         (numSteps - 1 - i)
+      self._xPaths = array.array('l', xPaths.tolist())
+      self._yPaths = array.array('l', yPaths.tolist())
+      
+      # The nodes at the last depth are all leaves, so the last shift is only
+      #    there to check the flag
+      self._shifts = range(numSteps - 1, -1, -1) + [0]
+   
+   # ...........................
+   def _setSkipIndex(self):
+      """
+      @summary: Builds the skip index, with the position of the node covering
+                   each block at the skip depth.  Blocks inside of a leaf 
+                   higher up in the tree get the position of that leaf
+      """
+      self.skipDepth = 0
+      while self.skipDepth < len(self.splits) and \
+                  2**(self.skipDepth + 1) * NODES_PER_SKIP <= self.numNodes:
+         self.skipDepth += 1
+      w = self.widths[self.skipDepth]
+      h = self.heights[self.skipDepth]
+      
+      if self.numNodes == 0:
+         self.skipIndex = np.zeros((0, 0), dtype=np.uint32)
+         return
+      pos, minXs, minYs, maxXs, maxYs = self._walk(0, 0, 2**self.xOrder, 
+                                                   2**self.yOrder, 
+                                                   self.skipDepth)
+      self.skipIndex = fillBlocks(2**self.xOrder / w, 2**self.yOrder / h, 
+                                  minXs / w, minYs / h, (maxXs - minXs) / w, 
+                                  (maxYs - minYs) / h, pos).astype(np.uint32)
+   
+   # ...........................
+   def memorySize(self):
+      """
+      @summary: Returns the number of bytes of the arrays that hold the 
+                   compressed grid, including the rank directory and skip 
+                   index, and of the Python copies used by point queries
+      """
+      return self.flagBytes.nbytes + self.superRanks.nbytes + \
+             self.wordRanks.nbytes + self.skipIndex.nbytes + \
+             self.valueBytes.nbytes + self.classes.nbytes + \
+             sys.getsizeof(self._wordList) + \
+             sys.getsizeof(self._rankList) + sys.getsizeof(self._skipList) + \
+             sys.getsizeof(self._valueList) + \
+             sys.getsizeof(self._classList) + sys.getsizeof(self._xPaths) + \
+             sys.getsizeof(self._yPaths)
+   
+   # ...........................
+   def decompress(self):
+      return Grid(griddedData=self._fillWindow(0, 0, self.xSize, self.ySize))
+   
+   # ...........................
+   def query(self, x, y):
+      """
+      @summary: Queries the compressed grid to find the value at the specified
+                   coordinates.  The walk starts from the skip index and 
+                   each level below it costs one rank lookup
+      @param x: The x (horizontal) coordinate, starts from the left, zero-based
+      @param y: The y (vertical) coordinate, starts at the top, zero-based
+      """
+      w = self.widths[self.skipDepth]
+      h = self.heights[self.skipDepth]
+      pos = self._skipList[(y / h) * (2**self.xOrder / w) + x / w]
+      if pos < 0:
+         return self._classList[~pos]
+      path = self._xPaths[x] + self._yPaths[y]
+      
+      # Look up the lists once, this loop is the whole query
+      words = self._wordList
+      ranks = self._rankList
+      for shift in self._shifts:
+         # The bits of the word up to the node end with its own flag and 
+         #    give the leaves before it within the word
+         i = pos >> 5
+         prefix = words[i] >> (31 - (pos & 31))
+         if prefix & 1:
+            return self._classList[self._leafId(ranks[i] + 
+                                                bin(prefix).count('1') - 1)]
+         
+         # Jump to the first child, the second comes right after it
+         pos = 2 * (pos - ranks[i] - bin(prefix).count('1')) + 1 + \
+               ((path >> shift) & 1)
+   
+   # ...........................
+   def queryWindow(self, x0, y0, x1, y1):
+      """
+      @summary: Queries the compressed grid for all of the values in a window.
+                   Only the nodes that intersect the window are visited
+      @param x0: The left edge of the window (inclusive)
+      @param y0: The top edge of the window (inclusive)
+      @param x1: The right edge of the window (exclusive)
+      @param y1: The bottom edge of the window (exclusive)
+      @return: A 2-D NumPy array with y1-y0 rows and x1-x0 columns
+      """
+      self._checkWindow(x0, y0, x1, y1)
+      return self._fillWindow(x0, y0, x1, y1)
+   
+   # ...........................
+   def queryMany(self, xs, ys):
+      """
+      @summary: Queries the compressed grid for the values at many points.  
+                   All of the points start from the skip index and move 
+                   down one level at a time
+      @param xs: An array of x coordinates
+      @param ys: An array of y coordinates, broadcast against xs
+      @return: A NumPy array of values with the broadcast shape of xs and ys
+      """
+      xs, ys = self._checkPoints(xs, ys)
+      shape = xs.shape
+      xs = xs.ravel()
+      ys = ys.ravel()
+      w = self.widths[self.skipDepth]
+      h = self.heights[self.skipDepth]
+      pos = self.skipIndex[ys / h, xs / w].astype(np.int64)
+      xOrder = self.xOrder - self.splits[:self.skipDepth].count(True)
+      yOrder = self.yOrder - self.splits[:self.skipDepth].count(False)
+      
+      # The points that have not reached a leaf
+      active = np.arange(len(xs))
+      for splitX in self.splits[self.skipDepth:]:
+         active = active[self._flags(pos[active]) == 0]
+         if len(active) == 0:
+            break
+         # Move to the first child, or the second if the next bit is set
+         p = pos[active]
+         p = 2 * (p - self._rank(p)) + 1
+         if splitX:
+            xOrder -= 1
+            p += (xs[active] >> xOrder) & 1
+         else:
+            yOrder -= 1
+            p += (ys[active] >> yOrder) & 1
+         pos[active] = p
+      
+      return self.classes[self._leafIds(self._rank(pos))].reshape(shape)
+   
+   # ...........................
+   def classCounts(self, window=None):
+      """
+      @summary: Counts the cells of each class from the sizes of the leaves
+      @param window: (optional) An (x0, y0, x1, y1) window to count the cells
+                        of instead of the whole grid (see queryWindow)
+      @return: A dictionary of class to number of cells
+      """
+      if window is None:
+         window = (0, 0, self.xSize, self.ySize)
+      self._checkWindow(*window)
+      x0, y0, x1, y1 = window
+      if x0 >= x1 or y0 >= y1:
+         return {}
+      
+      pos, minXs, minYs, maxXs, maxYs = self._walk(x0, y0, x1, y1, 
+                                                   len(self.splits))
+      values = self.classes[self._leafIds(self._rank(pos))]
+      return countValues(values, (maxXs - minXs) * (maxYs - minYs))
+   
+   # ...........................
+   def _fillWindow(self, x0, y0, x1, y1):
+      """
+      @summary: Fills in a window from the leaves that intersect it
+      @return: A 2-D NumPy array with y1-y0 rows and x1-x0 columns
+      """
+      if x0 >= x1 or y0 >= y1:
+         return np.zeros((y1 - y0, x1 - x0), dtype=self.classes.dtype)
+      
+      pos, minXs, minYs, maxXs, maxYs = self._walk(x0, y0, x1, y1, 
+                                                   len(self.splits))
+      values = self.classes[self._leafIds(self._rank(pos))]
+      return fillBlocks(x1 - x0, y1 - y0, minXs - x0, minYs - y0, 
+                        maxXs - minXs, maxYs - minYs, values)
+   
+   # ...........................
+   def _walk(self, x0, y0, x1, y1, maxDepth):
+      """
+      @summary: Walks the nodes that intersect a window one level at a time
+      @param x0: The left edge of the window (inclusive)
+      @param y0: The top edge of the window (inclusive)
+      @param x1: The right edge of the window (exclusive)
+      @param y1: The bottom edge of the window (exclusive)
+      @param maxDepth: The depth to stop at
+      @return: Arrays with the position of each leaf above maxDepth and each
+                  node at maxDepth, and the left, top, right and bottom edges
+                  of the part of the window that they cover
+      """
+      found = []
+      
+      pos = np.zeros(1, dtype=np.int64)
+      bxs = np.zeros(1, dtype=np.int64)
+      bys = np.zeros(1, dtype=np.int64)
+      for depth in xrange(maxDepth + 1):
+         w = self.widths[depth]
+         h = self.heights[depth]
+         
+         # Drop the nodes outside of the window
+         keep = (bxs * w < x1) & ((bxs + 1) * w > x0) & \
+                (bys * h < y1) & ((bys + 1) * h > y0)
+         pos = pos[keep]
+         bxs = bxs[keep]
+         bys = bys[keep]
+         if len(pos) == 0:
+            break
+         
+         if depth == maxDepth:
+            isLeaf = np.ones(len(pos), dtype=bool)
+         else:
+            isLeaf = self._flags(pos) == 1
+         found.append((pos[isLeaf], 
+                       np.maximum(bxs[isLeaf] * w, x0), 
+                       np.maximum(bys[isLeaf] * h, y0), 
+                       np.minimum((bxs[isLeaf] + 1) * w, x1), 
+                       np.minimum((bys[isLeaf] + 1) * h, y1)))
+         
+         # The children of the internal nodes make up the next level
+         pos = pos[~isLeaf]
+         pos = np.repeat(2 * (pos - self._rank(pos)) + 1, 2)
+         pos[1::2] += 1
+         bxs = bxs[~isLeaf]
+         bys = bys[~isLeaf]
+         if depth < len(self.splits) and self.splits[depth]:
+            bxs = np.repeat(2 * bxs, 2)
+            bxs[1::2] += 1
+            bys = np.repeat(bys, 2)
+         else:
+            bys = np.repeat(2 * bys, 2)
+            bys[1::2] += 1
+            bxs = np.repeat(bxs, 2)
+      
+      return [np.concatenate(arrs) for arrs in zip(*found)]
+   
+   # ...........................
+   def _rank(self, pos):
+      """
+      @summary: Returns the number of leaves before each node of an array
+      """
+      words = pos >> 6
+      
+      # Keep the bits of each word before the node.  Shifting by 64 is not 
+      #    defined, so shift twice
+      partial = (self.flagWords[words] >> 
+                 (63 - (pos & 63)).astype(np.uint64)) >> np.uint64(1)
+      partialCounts = POPCOUNT[partial.astype('>u8').view(np.uint8)].reshape(
+                                          -1, 8).sum(axis=1, dtype=np.int64)
+      return self.superRanks[words / WORDS_PER_SUPERBLOCK].astype(np.int64) + \
+             self.wordRanks[words] + partialCounts
+   
+   # ...........................
+   def _flags(self, pos):
+      """
+      @summary: Returns the leaf flags of each node of an array
+      """
+      return (self.flagBytes[pos >> 3] >> (7 - (pos & 7)).astype(np.uint8)) & 1
+   
+   # ...........................
+   def _leafId(self, leaf):
+      """
+      @summary: Returns the class index of a leaf
+      """
+      if self.nBits == 0:
+         return 0
+      first = leaf * self.nBits
+      last = first + self.nBits
+      bits = 0
+      for i in xrange(first >> 3, ((last - 1) >> 3) + 1):
+         bits = (bits << 8) | self._valueList[i]
+      return (bits >> (8 * (((last - 1) >> 3) + 1) - last)) & \
+             ((1 << self.nBits) - 1)
+   
+   # ...........................
+   def _leafIds(self, leaves):
+      """
+      @summary: Returns the class index of each leaf of an array
+      """
+      ids = np.zeros(len(leaves), dtype=np.int64)
+      for i in xrange(self.nBits):
+         bit = leaves * self.nBits + i
+         ids = (ids << 1) | ((self.valueBytes[bit >> 3] >> 
+                              (7 - (bit & 7)).astype(np.uint8)) & 1)
+      return ids
+   
+   # ...........................
+   def read(self, filename):
+      with open(filename, 'rb') as f:
+         buf = f.read()
+      
+      # S-tree files share the header but store their nodes in pre-order
+      if not isPackedTree(buf, self.METHOD, self.VERSION):
+         raise Exception, "%s is not a compact S-tree file" % filename
+      
+      packed = PackedTree(buf, 2)
+      self.xSize = packed.xSize
+      self.ySize = packed.ySize
+      self._findOrders()
+      
+      self.classes = np.array(packed.classes)
+      self.classes = self.classes.astype(findDtype(self.classes.min(), 
+                                                   self.classes.max()))
+      self.nBits = packed.nBits
+      self.numLeaves = packed.numLeaves
+      self.valueBytes = np.frombuffer(buf, dtype=np.uint8, 
+                                      count=(self.numLeaves * self.nBits + 7) / 8,
+                                      offset=packed.valuesPos).copy()
+      self._setFlags(packed.flags(0, packed.numNodes))
+   
+   # ...........................
+   def write(self, filename):
+      classes = self.classes.astype(np.int64).tolist()
+      with open(filename, 'wb') as f:
+         f.write(''.join([
+                     TREE_HEADER.pack(self.METHOD, self.VERSION, self.xSize, 
+                                      self.ySize, self.numNodes, 
+                                      self.numLeaves, len(classes), 0),
+                     np.array(classes, dtype='<i4').tobytes(),
+                     self.flagBytes[:(self.numNodes + 7) / 8].tobytes(),
+                     self.valueBytes.tobytes()
+                    ]))
+
+# .............................................................................
+def findUniformSTreeBlocks(mtx, xOrder, yOrder):
+   """
+   @summary: Finds the uniform s-tree blocks of a matrix at every depth.  The
+                blocks are checked from the bottom up, merging two uniform 
+                blocks with the same value at a time, so no sub-matrices are 
+                copied
+   @param mtx: 2-D NumPy array with 2**yOrder rows and 2**xOrder columns
+   @param xOrder: 2**xOrder elements in each row
+   @param yOrder: 2**yOrder rows
+   @return: A list of boolean arrays, one per depth, marking the uniform 
+               blocks, and a list of arrays with the value of the first cell
+               of each block.  Each array has a row for each row of blocks
+   """
+   mtx = np.asarray(mtx)
+   uniform = [np.ones(mtx.shape, dtype=bool)]
+   blockVals = [mtx]
+   for splitX in reversed(streeSplits(xOrder, yOrder)):
+      if splitX:
+         first = (slice(None), slice(0, None, 2))
+         second = (slice(None), slice(1, None, 2))
+      else:
+         first = (slice(0, None, 2), slice(None))
+         second = (slice(1, None, 2), slice(None))
+      vals = blockVals[-1]
+      same = uniform[-1]
+      uniform.append((vals[first] == vals[second]) & same[first] & 
+                     same[second])
+      blockVals.append(vals[first])
+   uniform.reverse()
+   blockVals.reverse()
+   return uniform, blockVals
+
+# .............................................................................
+def compactSTreeCompress(mtx, xOrder, yOrder):
+   """
+   @summary: Finds the nodes of the s-tree of a matrix in level order.  The 
+                leaves are the same as those of streeCompress
+   @param mtx: 2-D NumPy array with 2**yOrder rows and 2**xOrder columns
+   @param xOrder: 2**xOrder elements in each row
+   @param yOrder: 2**yOrder rows
+   @return: An array with the leaf flag of each node and an array with the 
+               value of each leaf, both in level order
+   """
+   uniform, blockVals = findUniformSTreeBlocks(mtx, xOrder, yOrder)
+   splits = streeSplits(xOrder, yOrder)
+   
+   flags = []
+   values = []
+   bxs = np.zeros(1, dtype=np.int64)
+   bys = np.zeros(1, dtype=np.int64)
+   for depth in xrange(len(splits) + 1):
+      isLeaf = uniform[depth][bys, bxs]
+      flags.append(isLeaf.astype(np.uint8))
+      values.append(blockVals[depth][bys[isLeaf], bxs[isLeaf]])
+      
+      # The children of the internal nodes make up the next level
+      bxs = bxs[~isLeaf]
+      bys = bys[~isLeaf]
+      if len(bxs) == 0:
+         break
+      if splits[depth]:
+         bxs = np.repeat(2 * bxs, 2)
+         bxs[1::2] += 1
+         bys = np.repeat(bys, 2)
+      else:
+         bys = np.repeat(2 * bys, 2)
+         bys[1::2] += 1
+         bxs = np.repeat(bxs, 2)
+   return np.concatenate(flags), np.concatenate(values).astype(np.int64)
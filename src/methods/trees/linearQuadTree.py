@@ -0,0 +1,284 @@
+"""
+@summary: Module containing a pointer-free (linear) quadtree.  The leaves of 
+             the quadtree are stored in flat arrays sorted by the Morton code
+             of their first cell
+@author: CJ Grady
+@version: 2.0
+@status: beta
+
+@license: gpl2
+@copyright: Copyright (C) 2014, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+"""
+import numpy as np
+import struct
+
+from matrix.matrix import countValues, Grid, _CompressedGrid, findDtype
+from methods.rle.hilbert import findOrder
+from methods.rle.morton import mortonToPoints, pointToMorton, \
+                               pointsToMorton
+
+# Header for linear quadtree files: method, version, x size, y size, leaf 
+#    value data type, number of leaves
+LINEAR_QUADTREE_HEADER = struct.Struct('<Bfll3sL')
+
+# .............................................................................
+class LinearQuadtreeCompressedGrid(_CompressedGrid):
+   """
+   @summary: This class compresses a grid using a linear quadtree.  Instead of
+                nested dictionaries, the leaves are held in three arrays in 
+                Morton (Z) order: the Morton code of the first cell of each 
+                leaf, the level of each leaf (a leaf covers 4**level cells) 
+                and the value of each leaf.  Point queries are a binary 
+                search of the leaf starts
+   """
+   METHOD = 8
+   VERSION = 2.0
+   
+   # ...........................
+   def __init__(self, grid=None):
+      if grid is not None:
+         self.compress(grid)
+      else:
+         self.starts = np.zeros(0, dtype=np.int64)
+         self.levels = np.zeros(0, dtype=np.uint8)
+         self.values = np.zeros(0, dtype=np.uint8)
+         self.xSize = None
+         self.ySize = None
+         self.order = 0
+       
+   # ...........................
+   def compress(self, mtx):
+      self.xSize = mtx.xSize
+      self.ySize = mtx.ySize
+      
+      # Determine order
+      self.order = findOrder(self.xSize, self.ySize)
+      
+      sqMtx = mtx.toPaddedArray(2**self.order, 2**self.order)
+      
+      self.levels, self.values = linearQuadtreeCompress(sqMtx)
+      self.starts = findLeafStarts(self.levels)
+   
+   # ...........................
+   def decompress(self):
+      # Expand the leaves along the Morton curve and gather the grid cells
+      lArray = np.repeat(self.values, 
+                         np.left_shift(1, 2 * self.levels.astype(np.int64)))
+      data = lArray[pointsToMorton(np.arange(self.xSize)[np.newaxis, :],
+                                   np.arange(self.ySize)[:, np.newaxis])]
+      return Grid(griddedData=data)
+   
+   # ...........................
+   def query(self, x, y):
+      i = int(np.searchsorted(self.starts, pointToMorton(x, y), 
+                              side='right')) - 1
+      return int(self.values[i])
+   
+   # ...........................
+   def queryWindow(self, x0, y0, x1, y1):
+      """
+      @summary: Queries the compressed grid for all of the values in a window
+      @param x0: The left edge of the window (inclusive)
+      @param y0: The top edge of the window (inclusive)
+      @param x1: The right edge of the window (exclusive)
+      @param y1: The bottom edge of the window (exclusive)
+      @return: A 2-D NumPy array with y1-y0 rows and x1-x0 columns
+      """
+      self._checkWindow(x0, y0, x1, y1)
+      return self._lookup(pointsToMorton(np.arange(x0, x1)[np.newaxis, :], 
+                                         np.arange(y0, y1)[:, np.newaxis]))
+   
+   # ...........................
+   def queryMany(self, xs, ys):
+      """
+      @summary: Queries the compressed grid for the values at many points
+      @param xs: An array of x coordinates
+      @param ys: An array of y coordinates, broadcast against xs
+      @return: A NumPy array of values with the broadcast shape of xs and ys
+      """
+      xs, ys = self._checkPoints(xs, ys)
+      return self._lookup(pointsToMorton(xs, ys))
+   
+   # ...........................
+   def classCounts(self, window=None):
+      """
+      @summary: Counts the cells of each class from the sizes of the leaves
+      @param window: (optional) An (x0, y0, x1, y1) window to count the cells
+                        of instead of the whole grid (see queryWindow)
+      @return: A dictionary of class to number of cells
+      """
+      if window is None:
+         window = (0, 0, self.xSize, self.ySize)
+      self._checkWindow(*window)
+      x0, y0, x1, y1 = window
+      
+      # Clip the block of each leaf to the window
+      minXs, minYs = mortonToPoints(self.starts)
+      sides = np.left_shift(1, self.levels.astype(np.int64))
+      ws = np.minimum(minXs + sides, x1) - np.maximum(minXs, x0)
+      hs = np.minimum(minYs + sides, y1) - np.maximum(minYs, y0)
+      return countValues(self.values, np.maximum(ws, 0) * np.maximum(hs, 0))
+   
+   # ...........................
+   def _lookup(self, codes):
+      """
+      @summary: Finds the values of the leaves containing many Morton codes
+      """
+      return self.values[np.searchsorted(self.starts, codes, side='right') - 1]
+   
+   # ...........................
+   def read(self, filename):
+      with open(filename, 'rb') as f:
+         buf = f.read()
+      
+      method, version, self.xSize, self.ySize, dtStr, numLeaves = \
+                                 LINEAR_QUADTREE_HEADER.unpack_from(buf)
+      self.order = findOrder(self.xSize, self.ySize)
+      
+      pos = LINEAR_QUADTREE_HEADER.size
+      self.levels = np.frombuffer(buf, dtype=np.uint8, count=numLeaves, 
+                                  offset=pos)
+      self.values = np.frombuffer(buf, dtype=np.dtype(dtStr), count=numLeaves,
+                                  offset=pos + numLeaves)
+      self.starts = findLeafStarts(self.levels)
+   
+   # ...........................
+   def write(self, filename):
+      values = self.values.astype(self.values.dtype.newbyteorder('<'), 
+                                  copy=False)
+      with open(filename, 'wb') as f:
+         f.write(''.join([
+                     LINEAR_QUADTREE_HEADER.pack(self.METHOD, self.VERSION, 
+                                                 self.xSize, self.ySize, 
+                                                 values.dtype.str, 
+                                                 len(values)),
+                     self.levels.astype(np.uint8).tobytes(),
+                     values.tobytes()
+                    ]))
+
+# .............................................................................
+def findUniformBlocks(mtx):
+   """
+   @summary: Finds the uniform quadtree blocks of a matrix at every level.  
+                The blocks are checked from the bottom up, merging four 
+                uniform blocks with the same value at a time, so each cell is 
+                only looked at once and no sub-matrices are copied
+   @param mtx: 2-D NumPy array, assumed to be square with a power of two sides
+   @return: A list of boolean arrays, one per level, marking the uniform blocks
+               in Morton order (None for level zero where every block is 
+               uniform) and a list of arrays with the value of the first cell
+               of each block
+   """
+   mtx = np.asarray(mtx)
+   side = len(mtx)
+   order = findOrder(side, side)
+   
+   # Put the cells in Morton order so each block is a contiguous range
+   lArray = np.empty(side * side, dtype=mtx.dtype)
+   lArray[pointsToMorton(np.arange(side)[np.newaxis, :], 
+                         np.arange(side)[:, np.newaxis]).ravel()] = mtx.ravel()
+   
+   uniform = [None]
+   blockVals = [lArray]
+   for level in xrange(1, order + 1):
+      children = blockVals[-1].reshape(-1, 4)
+      same = (children == children[:, :1]).all(axis=1)
+      if uniform[-1] is not None:
+         same &= uniform[-1].reshape(-1, 4).all(axis=1)
+      uniform.append(same)
+      blockVals.append(children[:, 0])
+   return uniform, blockVals
+
+# .............................................................................
+def linearQuadtreeCompress(mtx):
+   """
+   @summary: Finds the leaves of the quadtree of a matrix.  The leaves are the 
+                same as those of quadtreeCompress
+   @param mtx: 2-D NumPy array, assumed to be square with a power of two sides
+   @return: An array with the level of each leaf and an array with the value
+               of each leaf, both in Morton order
+   """
+   uniform, blockVals = findUniformBlocks(mtx)
+   order = len(uniform) - 1
+   
+   # A block is a leaf if it is uniform but its parent is not
+   leafStarts = []
+   leafLevels = []
+   leafVals = []
+   for level in xrange(order + 1):
+      if level < order:
+         isLeaf = ~np.repeat(uniform[level + 1], 4)
+         if uniform[level] is not None:
+            isLeaf &= uniform[level]
+      else:
+         isLeaf = np.ones(1, dtype=bool) if level == 0 else uniform[level]
+      idx = np.flatnonzero(isLeaf)
+      leafStarts.append(idx << (2 * level))
+      leafLevels.append(np.full(len(idx), level, dtype=np.uint8))
+      leafVals.append(blockVals[level][idx])
+   
+   sortOrder = np.argsort(np.concatenate(leafStarts), kind='mergesort')
+   levels = np.concatenate(leafLevels)[sortOrder]
+   values = np.concatenate(leafVals)[sortOrder]
+   if values.size > 0:
+      values = values.astype(findDtype(values.min(), values.max()))
+   return levels, values
+
+# .............................................................................
+def findLeafStarts(levels):
+   """
+   @summary: Finds the Morton code of the first cell of each leaf from the 
+                leaf levels
+   @param levels: An array with the level of each leaf, in Morton order
+   """
+   sizes = np.left_shift(1, 2 * np.asarray(levels, dtype=np.int64))
+   return np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.int64)
+
+# .............................................................................
+if __name__ == "__main__":
+   data = [
+          [0, 0, 1, 1, 1, 1, 1, 0, 1, 0, 1, 0, 1, 1, 1, 0], 
+          [1, 1, 1, 0, 0, 1, 1, 0, 1, 1, 1, 1, 1, 1, 0, 0], 
+          [1, 1, 1, 1, 1, 1, 0, 0, 1, 0, 1, 1, 0, 0, 0, 0], 
+          [0, 0, 1, 0, 1, 0, 1, 1, 1, 0, 1, 0, 1, 1, 1, 1], 
+          [0, 0, 1, 1, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 1, 1], 
+          [0, 1, 0, 1, 0, 0, 1, 1, 1, 0, 1, 0, 1, 1, 1, 0], 
+          [1, 1, 1, 0, 1, 1, 1, 0, 1, 1, 1, 1, 1, 1, 0, 1], 
+          [0, 1, 1, 0, 1, 1, 0, 1, 1, 1, 1, 0, 0, 1, 0, 1], 
+          [1, 0, 0, 1, 0, 1, 1, 1, 4, 4, 4, 4, 4, 4, 4, 4], 
+          [0, 1, 0, 1, 0, 1, 1, 1, 4, 4, 4, 4, 4, 4, 4, 4], 
+          [0, 1, 1, 1, 1, 1, 1, 0, 4, 4, 4, 4, 4, 4, 4, 4], 
+          [1, 0, 1, 1, 0, 0, 1, 1, 4, 4, 4, 4, 4, 4, 4, 4], 
+          [1, 1, 0, 1, 1, 1, 1, 1, 4, 4, 4, 4, 4, 4, 4, 4], 
+          [0, 0, 0, 1, 1, 1, 1, 0, 4, 4, 4, 4, 4, 4, 4, 4], 
+          [2, 2, 0, 0, 0, 1, 0, 1, 4, 4, 4, 4, 4, 4, 4, 4], 
+          [2, 2, 0, 0, 1, 0, 1, 1, 4, 4, 4, 4, 4, 4, 4, 4]
+         ]
+   mtx = Grid(data)
+   cmpMtx = LinearQuadtreeCompressedGrid(grid=mtx)
+   cmpMtx.write('linearQuadtreeTest.bin')
+   
+   cmpMtx2 = LinearQuadtreeCompressedGrid()
+   cmpMtx2.read('linearQuadtreeTest.bin')
+   
+   print cmpMtx2.query(9, 10)
+   print cmpMtx2.decompress().data
@@ -26,9 +26,19 @@
           Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
           02110-1301, USA.
 """
+from cStringIO import StringIO
+from itertools import chain, repeat
+import mmap
+from operator import itemgetter
+import numpy as np
 import struct
 
-from matrix.matrix import Grid, _CompressedGrid
+from matrix.matrix import countValues, Grid, _CompressedGrid, findDtype
+from methods.rle.morton import pointToMorton, pointsToMorton
+from methods.trees.linearQuadTree import findUniformBlocks
+from methods.trees.treeBase import bytesToStreams, fillBlocks, gcPaused, \
+                                   isPackedTree, packTree, PackedTree, \
+                                   streamsToTree, treeToStreams
 
 # .............................................................................
 class QuadtreeCompressedGrid(_CompressedGrid):
@@ -36,10 +46,13 @@ class QuadtreeCompressedGrid(_CompressedGrid):
    @summary: This class compresses a grid using a quadtree
    """
    METHOD = 3
-   VERSION = 2.0
+   VERSION = 3.0
    
    # ...........................
    def __init__(self, grid=None):
+      self._packed = None
+      self._mmap = None
+      self._subtrees = {}
       if grid is not None:
          self.compress(grid)
       else:
@@ -62,26 +75,32 @@ class QuadtreeCompressedGrid(_CompressedGrid):
       while 2**self.order < max([self.xSize, self.ySize]):
          self.order += 1
       
-      sqMtx = []
-      for row in mtx.data:
-         sqMtx.append(row + (2**self.order - len(row)) * [0])
-      for i in xrange(len(sqMtx), 2**self.order):
-         sqMtx.append(2**self.order * [0])
+      sqMtx = mtx.toPaddedArray(2**self.order, 2**self.order)
       
-      self.data = quadtreeCompress(sqMtx)
+      self.data = quadtreeBuild(sqMtx)
    
    # ...........................
    def decompress(self):
-      data = quadtreeDecompress(self.data, self.xSize)
-      mtx = Grid(griddedData=data)
+      self.loadAll()
+      data = quadtreeDecompress(self.data, 2**self.order)
+      mtx = Grid(griddedData=data[:self.ySize, :self.xSize])
       return mtx
    
    # ...........................
    def query(self, x, y):
-      minX = minY = 0
-      maxX = maxY = self.xSize
-      
-      val = self.data
+      if self.data is None:
+         self._checkOpen()
+         # Start from the index cell containing the point
+         shift = self.order - self._packed.indexDepth
+         minX = (x >> shift) << shift
+         minY = (y >> shift) << shift
+         maxX = minX + 2**shift
+         maxY = minY + 2**shift
+         val = self._getSubtree(pointToMorton(x >> shift, y >> shift))
+      else:
+         minX = minY = 0
+         maxX = maxY = 2**self.order
+         val = self.data
       
       while not isinstance(val, int):
          cmpX = (maxX+minX) / 2
@@ -106,21 +125,219 @@ class QuadtreeCompressedGrid(_CompressedGrid):
       return val
    
    # ...........................
-   def read(self, filename):
-      # TODO
+   def queryWindow(self, x0, y0, x1, y1):
+      """
+      @summary: Queries the compressed grid for all of the values in a window.
+                   Only the subtrees that intersect the window are visited
+      @param x0: The left edge of the window (inclusive)
+      @param y0: The top edge of the window (inclusive)
+      @param x1: The right edge of the window (exclusive)
+      @param y1: The bottom edge of the window (exclusive)
+      @return: A 2-D NumPy array with y1-y0 rows and x1-x0 columns
+      """
+      self._checkWindow(x0, y0, x1, y1)
+      ret = np.zeros((y1 - y0, x1 - x0), dtype=np.int64)
+      if self.data is None:
+         self._checkOpen()
+         # Only decode the index cells that intersect the window
+         shift = self.order - self._packed.indexDepth
+         for cy in xrange(y0 >> shift, ((y1 - 1) >> shift) + 1):
+            for cx in xrange(x0 >> shift, ((x1 - 1) >> shift) + 1):
+               quadtreeQueryWindow(self._getSubtree(pointToMorton(cx, cy)), 
+                                   ret, x0, y0, x1, y1, cx << shift, 
+                                   cy << shift, 2**shift)
+      else:
+         quadtreeQueryWindow(self.data, ret, x0, y0, x1, y1, 0, 0, 
+                             2**self.order)
+      if ret.size > 0:
+         ret = ret.astype(findDtype(ret.min(), ret.max()))
+      return ret
+   
+   # ...........................
+   def queryMany(self, xs, ys):
+      """
+      @summary: Queries the compressed grid for the values at many points.  
+                   The points are sorted into the order that the tree stores
+                   its leaves so that each node is visited at most once
+      @param xs: An array of x coordinates
+      @param ys: An array of y coordinates, broadcast against xs
+      @return: A NumPy array of values with the broadcast shape of xs and ys
+      """
+      xs, ys = self._checkPoints(xs, ys)
+      codes = pointsToMorton(xs, ys).ravel()
+      order = np.argsort(codes)
+      codes = codes[order]
+      
+      vals = np.zeros(codes.shape, dtype=np.int64)
+      if self.data is None:
+         self._checkOpen()
+         # Only decode the index cells that hold points
+         shift = self.order - self._packed.indexDepth
+         cells = codes >> (2 * shift)
+         splits = (np.flatnonzero(np.diff(cells)) + 1).tolist()
+         for lo, hi in zip([0] + splits, splits + [len(codes)]):
+            if lo < hi:
+               cell = int(cells[lo])
+               quadtreeQueryMany(self._getSubtree(cell), codes, vals, lo, hi, 
+                                 cell << (2 * shift), 4**shift)
+      else:
+         quadtreeQueryMany(self.data, codes, vals, 0, len(vals), 0, 
+                           4**self.order)
+      
+      ret = np.empty_like(vals)
+      ret[order] = vals
+      if ret.size > 0:
+         ret = ret.astype(findDtype(ret.min(), ret.max()))
+      return ret.reshape(xs.shape)
+   
+   # ...........................
+   def classCounts(self, window=None):
+      """
+      @summary: Counts the cells of each class from the sizes of the leaves.  
+                   For a lazily read tree, only the index cells that 
+                   intersect a window are decoded.  Counting the whole grid 
+                   decodes the whole tree, without keeping it
+      @param window: (optional) An (x0, y0, x1, y1) window to count the cells
+                        of instead of the whole grid (see queryWindow)
+      @return: A dictionary of class to number of cells
+      """
+      if self.data is not None:
+         tree = self.data
+      elif window is None:
+         self._checkOpen()
+         tree = self._packed.tree(4)
+      else:
+         self._checkWindow(*window)
+         self._checkOpen()
+         x0, y0, x1, y1 = window
+         shift = self.order - self._packed.indexDepth
+         allValues = []
+         allAreas = []
+         for cy in xrange(y0 >> shift, ((y1 - 1) >> shift) + 1):
+            for cx in xrange(x0 >> shift, ((x1 - 1) >> shift) + 1):
+               # The window relative to the index cell
+               values, areas = quadtreeLeafAreas(
+                              self._getSubtree(pointToMorton(cx, cy)), 
+                              (x0 - (cx << shift), y0 - (cy << shift), 
+                               x1 - (cx << shift), y1 - (cy << shift)), 
+                              2**shift)
+               allValues.append(values)
+               allAreas.append(areas)
+         if not allValues:
+            return {}
+         return countValues(np.concatenate(allValues), 
+                            np.concatenate(allAreas))
+      
+      if window is None:
+         window = (0, 0, self.xSize, self.ySize)
+      self._checkWindow(*window)
+      values, areas = quadtreeLeafAreas(tree, window, 2**self.order)
+      return countValues(values, areas)
+   
+   # ...........................
+   def read(self, filename, lazy=False):
+      """
+      @summary: Reads in the compressed grid from a file
+      @param filename: The filename to read from
+      @param lazy: (optional) If True and the file has a node index (see 
+                      write), the file is memory mapped and subtrees are only
+                      decoded when a query needs them.  Call close to 
+                      release the file, and loadAll first to keep using the
+                      grid after that
+      """
+      self.close()
       with open(filename, 'rb') as f:
+         if lazy:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+         else:
+            buf = f.read()
+      
+      self._subtrees = {}
+      if isPackedTree(buf, self.METHOD, self.VERSION):
+         packed = PackedTree(buf, 4)
+         self.xSize = packed.xSize
+         self.ySize = packed.ySize
+         if lazy and packed.indexDepth > 0:
+            self.data = None
+            self._packed = packed
+            self._mmap = buf
+         else:
+            self.data = packed.tree(4)
+      else:
+         # Older files only have the sizes and byte flags
+         f = StringIO(buf[:])
          self.xSize = struct.unpack('<l', f.read(4))[0]
          self.ySize = struct.unpack('<l', f.read(4))[0]
 
          self.data = unpackData(f)
+      
+      # Files without an index are decoded right away and need no mapping
+      if lazy and self._mmap is None:
+         buf.close()
+      
+      self.order = 0
+      while 2**self.order < max([self.xSize, self.ySize]):
+         self.order += 1
    
    # ...........................
-   def write(self, filename):
+   def write(self, filename, indexDepth=0):
+      """
+      @summary: Writes out the compressed grid
+      @param filename: The filename to write to
+      @param indexDepth: (optional) If greater than zero, the file includes 
+                            the position of the subtree covering each of the 
+                            4**indexDepth cells at this depth so that it can 
+                            be read lazily
+      """
+      self.loadAll()
+      indexDepth = min(indexDepth, self.order)
+      flags, values, index = treeToStreams(self.data, 4, indexDepth)
       with open(filename, 'wb') as f:
-         # write version
-         f.write(struct.pack('<l', self.xSize))
-         f.write(struct.pack('<l', self.ySize))
-         packData(self.data, f)
+         f.write(packTree(self.METHOD, self.VERSION, self.xSize, self.ySize, 
+                          flags, values, indexDepth, index))
+   
+   # ...........................
+   def close(self):
+      """
+      @summary: Releases the memory map of a lazily read file, along with the
+                   subtrees decoded from it.  A lazily read grid can not be 
+                   queried after it is closed unless loadAll was called first
+      """
+      self._packed = None
+      self._subtrees = {}
+      if self._mmap is not None:
+         self._mmap.close()
+         self._mmap = None
+   
+   # ...........................
+   def loadAll(self):
+      """
+      @summary: Decodes the whole tree of a lazily read file so that the grid
+                   no longer needs the file
+      """
+      if self.data is None:
+         self._checkOpen()
+         self.data = self._packed.tree(4)
+         self._subtrees = {}
+   
+   # ...........................
+   def _getSubtree(self, cell):
+      """
+      @summary: Returns the subtree covering a cell of the node index of a 
+                   lazily read file, decoding it the first time
+      @param cell: The Morton code of the cell at the index depth
+      """
+      if not self._subtrees.has_key(cell):
+         self._subtrees[cell] = self._packed.subtree(cell, 4)
+      return self._subtrees[cell]
+   
+   # ...........................
+   def _checkOpen(self):
+      """
+      @summary: Checks that the file of a lazily read grid is still open
+      """
+      if self._packed is None:
+         raise Exception, "The file of this lazily read grid has been closed"
 
 # .............................................................................
 def packData(data, f):
@@ -136,59 +353,225 @@ def packData(data, f):
 
 # .............................................................................
 def unpackData(f):
-   isInt = struct.unpack('<?', f.read(1))[0]
-   if isInt:
-      return struct.unpack('<B', f.read(1))[0]
-   else:
-      return {
-              1: unpackData(f),
-              2: unpackData(f),
-              3: unpackData(f),
-              4: unpackData(f)
-             }
+   """
+   @summary: Reads a tree written by packData.  The rest of the file is read 
+                at once and decoded without recursion
+   @param f: An open file positioned at the start of the tree
+   """
+   flags, values = bytesToStreams(f.read())[:2]
+   return streamsToTree(flags, values, 4)
 
 # .............................................................................
 def quadtreeCompress(mtx):
    """
    @summary: Performs quadtree compression
-   @param mtx: List of lists, assumed to be square
+   @param mtx: List of lists or 2-D NumPy array, assumed to be square
    """
-   minV = min([min(r) for r in mtx])
-   maxV = max([max(r) for r in mtx])
+   mtx = np.asarray(mtx)
+   minV = mtx.min()
+   maxV = mtx.max()
 
    if minV == maxV:
-      return minV
+      return int(minV)
    else:
       h = len(mtx)
       return {
-              1 : quadtreeCompress([mtx[i][:h/2] for i in range(h/2)]),
-              2 : quadtreeCompress([mtx[i][h/2:] for i in range(h/2)]),
-              3 : quadtreeCompress([mtx[i][:h/2] for i in range(h/2, h)]),
-              4 : quadtreeCompress([mtx[i][h/2:] for i in range(h/2, h)])
+              1 : quadtreeCompress(mtx[:h/2, :h/2]),
+              2 : quadtreeCompress(mtx[:h/2, h/2:]),
+              3 : quadtreeCompress(mtx[h/2:, :h/2]),
+              4 : quadtreeCompress(mtx[h/2:, h/2:])
              }
 
+# .............................................................................
+def quadtreeBuild(mtx):
+   """
+   @summary: Performs quadtree compression from the bottom up.  The uniform 
+                blocks are found level by level without copying 
+                sub-matrices (see findUniformBlocks) and then the internal 
+                nodes are linked together one level at a time.  Returns the
+                same tree as quadtreeCompress
+   @param mtx: 2-D NumPy array, assumed to be square with a power of two sides
+   """
+   uniform, blockVals = findUniformBlocks(mtx)
+   return linkQuadtree(uniform, blockVals)
+
+# .............................................................................
+def linkQuadtree(uniform, blockVals, startLevel=0, nodes=None):
+   """
+   @summary: Links the blocks found by findUniformBlocks into a tree of nested
+                dictionaries, one level at a time from the bottom up
+   @param uniform: The list of uniform block flags from findUniformBlocks
+   @param blockVals: The list of block values from findUniformBlocks
+   @param startLevel: (optional) The level to start linking from.  Blocks 
+                         below this level are not part of the tree
+   @param nodes: (optional) An object array with the node to use for each 
+                    block at the start level that is not uniform, in Morton
+                    order
+   """
+   order = len(uniform) - 1
+   
+   if order == 0 or uniform[order][0]:
+      return int(blockVals[order][0])
+   if startLevel == order:
+      return nodes[0]
+   
+   # Every block that is not uniform is an internal node
+   with gcPaused():
+      nodeIdxs = None
+      if nodes is not None:
+         nodeIdxs = np.flatnonzero(~uniform[startLevel])
+      for level in xrange(startLevel + 1, order + 1):
+         idxs = np.flatnonzero(~uniform[level])
+         childIdxs = ((idxs << 2)[:, np.newaxis] + np.arange(4)).ravel()
+         
+         # Children are either values or nodes from the level below
+         children = np.empty(len(childIdxs), dtype=object)
+         if uniform[level-1] is None:
+            children[:] = blockVals[0][childIdxs].tolist()
+         else:
+            isLeaf = uniform[level-1][childIdxs]
+            children[isLeaf] = \
+                        blockVals[level-1][childIdxs[isLeaf]].tolist()
+            children[~isLeaf] = nodes[np.searchsorted(nodeIdxs, 
+                                                      childIdxs[~isLeaf])]
+         
+         nodes = np.empty(len(idxs), dtype=object)
+         children = children.reshape(-1, 4).tolist()
+         nodes[:] = [{1: c1, 2: c2, 3: c3, 4: c4} 
+                                          for c1, c2, c3, c4 in children]
+         nodeIdxs = idxs
+   return nodes[0]
+
 # .............................................................................
 def quadtreeDecompress(cmpMtx, sideLength):
    """
    @summary: Decompresses a quadtree compressed matrix
+   @param cmpMtx: The compressed matrix
+   @param sideLength: The length of each side of the matrix
+   @return: A 2-D NumPy array
+   """
+   minXs, minYs, sizes, values = quadtreeLeafBlocks(cmpMtx, sideLength)
+   return fillBlocks(sideLength, sideLength, minXs, minYs, sizes, sizes, 
+                     values)
+
+# .............................................................................
+def quadtreeLeafBlocks(cmpMtx, sideLength):
+   """
+   @summary: Finds the block covered by each leaf of a quadtree
+   @param cmpMtx: The compressed matrix
+   @param sideLength: The length of each side of the matrix
+   @return: Arrays with the left edge, top edge, side length and value of 
+               each leaf
+   """
+   minXs = []
+   minYs = []
+   sizes = []
+   values = []
+   
+   # Walk the tree one level at a time, collecting the leaf blocks
+   nodes = [cmpMtx]
+   nodeXs = np.zeros(1, dtype=np.int64)
+   nodeYs = np.zeros(1, dtype=np.int64)
+   l = sideLength
+   with gcPaused():
+      while nodes:
+         isLeaf = np.array(map(isinstance, nodes, repeat(int, len(nodes))), 
+                           dtype=bool)
+         nodeArr = np.empty(len(nodes), dtype=object)
+         nodeArr[:] = nodes
+         nodes = nodeArr
+         minXs.append(nodeXs[isLeaf])
+         minYs.append(nodeYs[isLeaf])
+         sizes.append(np.full(isLeaf.sum(), l, dtype=np.int64))
+         values.append(nodes[isLeaf].tolist())
+      
+         # The children of the internal nodes make up the next level
+         l = l / 2
+         nodes = list(chain.from_iterable(map(itemgetter(1, 2, 3, 4), 
+                                              nodes[~isLeaf].tolist())))
+         nodeXs = (nodeXs[~isLeaf, np.newaxis] + [0, l, 0, l]).ravel()
+         nodeYs = (nodeYs[~isLeaf, np.newaxis] + [0, 0, l, l]).ravel()
+   
+   return np.concatenate(minXs), np.concatenate(minYs), \
+          np.concatenate(sizes), np.array(sum(values, []), dtype=np.int64)
+   
+# .............................................................................
+def quadtreeQueryWindow(cmpMtx, ret, x0, y0, x1, y1, minX, minY, sideLength):
+   """
+   @summary: Fills in the part of a window covered by a quadtree section
    @param cmpMtx: The compressed section of the matrix
+   @param ret: The 2-D array for the window to fill in
+   @param x0: The left edge of the window (inclusive)
+   @param y0: The top edge of the window (inclusive)
+   @param x1: The right edge of the window (exclusive)
+   @param y1: The bottom edge of the window (exclusive)
+   @param minX: The left edge of this section
+   @param minY: The top edge of this section
    @param sideLength: The length of each side of this section
    """
+   # Find the part of the window covered by this section
+   iMinX = max(x0, minX)
+   iMinY = max(y0, minY)
+   iMaxX = min(x1, minX + sideLength)
+   iMaxY = min(y1, minY + sideLength)
+   if iMinX >= iMaxX or iMinY >= iMaxY:
+      return
+   
    if isinstance(cmpMtx, int):
-      return [[cmpMtx for i in xrange(sideLength)] for j in xrange(sideLength)]
+      ret[iMinY-y0:iMaxY-y0, iMinX-x0:iMaxX-x0] = cmpMtx
    else:
-      ret = []
       l = sideLength / 2
-      topLeft = quadtreeDecompress(cmpMtx[1], l)
-      topRight = quadtreeDecompress(cmpMtx[2], l)
-      bottomLeft = quadtreeDecompress(cmpMtx[3], l)
-      bottomRight = quadtreeDecompress(cmpMtx[4], l)
-      for i in xrange(l):
-         ret.append(topLeft[i] + topRight[i])
-      for i in xrange(l):
-         ret.append(bottomLeft[i] + bottomRight[i])
-      return ret
+      quadtreeQueryWindow(cmpMtx[1], ret, x0, y0, x1, y1, minX, minY, l)
+      quadtreeQueryWindow(cmpMtx[2], ret, x0, y0, x1, y1, minX + l, minY, l)
+      quadtreeQueryWindow(cmpMtx[3], ret, x0, y0, x1, y1, minX, minY + l, l)
+      quadtreeQueryWindow(cmpMtx[4], ret, x0, y0, x1, y1, minX + l, minY + l, 
+                          l)
+
+# .............................................................................
+def quadtreeLeafAreas(cmpMtx, window, sideLength):
+   """
+   @summary: Finds the number of cells of each leaf that are inside of a 
+                window
+   @param cmpMtx: The compressed matrix
+   @param window: An (x0, y0, x1, y1) window
+   @param sideLength: The length of each side of the matrix
+   @return: An array of leaf values and an array of the number of cells of 
+               each leaf in the window
+   """
+   x0, y0, x1, y1 = window
+   minXs, minYs, sizes, values = quadtreeLeafBlocks(cmpMtx, sideLength)
+   ws = np.minimum(minXs + sizes, x1) - np.maximum(minXs, x0)
+   hs = np.minimum(minYs + sizes, y1) - np.maximum(minYs, y0)
+   return values, np.maximum(ws, 0) * np.maximum(hs, 0)
+
+# .............................................................................
+def quadtreeQueryMany(cmpMtx, codes, vals, lo, hi, base, numCells):
+   """
+   @summary: Looks up sorted points in a quadtree section.  Points are 
+                identified by their Morton code, which orders them the same 
+                way that the quadtree orders its quadrants
+   @param cmpMtx: The compressed section of the matrix
+   @param codes: A sorted array of Morton codes for the points
+   @param vals: An array to fill in with the value of each point
+   @param lo: The index of the first point in this section
+   @param hi: The index after the last point in this section
+   @param base: The Morton code of the first cell of this section
+   @param numCells: The number of cells in this section
+   """
+   if lo >= hi:
+      return
    
+   if isinstance(cmpMtx, int):
+      vals[lo:hi] = cmpMtx
+   else:
+      q = numCells / 4
+      # Split the points between the quadrants
+      splits = np.searchsorted(codes[lo:hi], [base + q, base + 2*q, base + 3*q])
+      splits = [lo] + (lo + splits).tolist() + [hi]
+      for i in xrange(4):
+         quadtreeQueryMany(cmpMtx[i+1], codes, vals, splits[i], splits[i+1], 
+                           base + i * q, q)
+
 # .............................................................................
 def test():
    data = [
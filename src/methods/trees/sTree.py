@@ -26,9 +26,16 @@
           Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
           02110-1301, USA.
 """
+from cStringIO import StringIO
+from itertools import chain, repeat
+from operator import itemgetter
+import numpy as np
 import struct
 
-from matrix.matrix import _CompressedGrid, Grid
+from matrix.matrix import _CompressedGrid, countValues, Grid, findDtype
+from methods.trees.treeBase import bytesToStreams, fillBlocks, gcPaused, \
+                                   isPackedTree, packTree, streamsToTree, \
+                                   treeToStreams, unpackTree
 
 # .............................................................................
 class STreeCompressedGrid(_CompressedGrid):
@@ -38,7 +45,7 @@ class STreeCompressedGrid(_CompressedGrid):
    """
    
    METHOD = 4
-   VERSION = 2.0
+   VERSION = 3.0
    
    # ...........................
    def __init__(self, mtx=None):
@@ -60,6 +67,17 @@ class STreeCompressedGrid(_CompressedGrid):
       assert len(mtx.data[0]) == mtx.xSize
       
       # Determine order
+      self._findOrders()
+      
+      paddedMtx = mtx.toPaddedArray(2**self.xOrder, 2**self.yOrder)
+      
+      self.data = streeCompress(paddedMtx, self.xOrder, self.yOrder)
+   
+   # ...........................
+   def _findOrders(self):
+      """
+      @summary: Finds the orders of the padded grid from its size
+      """
       self.xOrder = self.yOrder = 0
       
       while 2**self.xOrder < self.xSize:
@@ -71,65 +89,124 @@ class STreeCompressedGrid(_CompressedGrid):
       self.order = 0
       while 2**self.order < max([self.xSize, self.ySize]):
          self.order += 1
-      
-      paddedMtx = []
-      for row in mtx.data:
-         paddedMtx.append(row + (2**self.xOrder - len(row)) * [0])
-      for i in xrange(len(paddedMtx), 2**self.yOrder):
-         paddedMtx.append(2**self.xOrder * [0])
-      
-      self.data = streeCompress(paddedMtx, self.xOrder, self.yOrder)
    
    # ...........................
    def decompress(self):
-      data = streeDecompress(self.data, self.xSize, self.ySize)
-      mtx = Grid(griddedData=data)
+      data = streeDecompress(self.data, 2**self.xOrder, 2**self.yOrder)
+      mtx = Grid(griddedData=data[:self.ySize, :self.xSize])
       return mtx
    
    # ...........................
    def query(self, x, y):
-      minX = minY = 0
-      maxX = self.xSize
-      maxY = self.ySize
+      """
+      @summary: Queries the compressed grid to find the value at the specified
+                   coordinates.  The tree splits the padded 2**xOrder by 
+                   2**yOrder grid, so each split picks a half from the next
+                   bit of x or y
+      @param x: The x (horizontal) coordinate, starts from the left, zero-based
+      @param y: The y (vertical) coordinate, starts at the top, zero-based
+      """
+      xOrder = self.xOrder
+      yOrder = self.yOrder
       
       val = self.data
       
       while not isinstance(val, int):
-         
          if val['splitX']:
-            cmpX = (maxX+minX) / 2
-            if x < cmpX:
-               maxX = cmpX
-               val = val[1]
-            else:
-               minX = cmpX
-               val = val[2]
+            xOrder -= 1
+            val = val[1 + ((x >> xOrder) & 1)]
          else:
-            cmpY = (maxY+minY) / 2
-            if y < cmpY:
-               maxY = cmpY
-               val = val[1]
-            else:
-               minY = cmpY
-               val = val[2]
+            yOrder -= 1
+            val = val[1 + ((y >> yOrder) & 1)]
    
       return val
    
+   # ...........................
+   def queryWindow(self, x0, y0, x1, y1):
+      """
+      @summary: Queries the compressed grid for all of the values in a window.
+                   Only the subtrees that intersect the window are visited
+      @param x0: The left edge of the window (inclusive)
+      @param y0: The top edge of the window (inclusive)
+      @param x1: The right edge of the window (exclusive)
+      @param y1: The bottom edge of the window (exclusive)
+      @return: A 2-D NumPy array with y1-y0 rows and x1-x0 columns
+      """
+      self._checkWindow(x0, y0, x1, y1)
+      ret = np.zeros((y1 - y0, x1 - x0), dtype=np.int64)
+      streeQueryWindow(self.data, ret, x0, y0, x1, y1, 0, 0, 
+                       2**self.xOrder, 2**self.yOrder)
+      if ret.size > 0:
+         ret = ret.astype(findDtype(ret.min(), ret.max()))
+      return ret
+   
+   # ...........................
+   def queryMany(self, xs, ys):
+      """
+      @summary: Queries the compressed grid for the values at many points.  
+                   The points are sorted into the order that the tree stores
+                   its leaves so that each node is visited at most once
+      @param xs: An array of x coordinates
+      @param ys: An array of y coordinates, broadcast against xs
+      @return: A NumPy array of values with the broadcast shape of xs and ys
+      """
+      xs, ys = self._checkPoints(xs, ys)
+      codes = streeCodes(xs, ys, self.xOrder, self.yOrder).ravel()
+      order = np.argsort(codes)
+      
+      vals = np.zeros(codes.shape, dtype=np.int64)
+      streeQueryMany(self.data, codes[order], vals, 0, len(vals), 0, 
+                     2**(self.xOrder + self.yOrder))
+      
+      ret = np.empty_like(vals)
+      ret[order] = vals
+      if ret.size > 0:
+         ret = ret.astype(findDtype(ret.min(), ret.max()))
+      return ret.reshape(xs.shape)
+   
+   # ...........................
+   def classCounts(self, window=None):
+      """
+      @summary: Counts the cells of each class from the sizes of the leaves
+      @param window: (optional) An (x0, y0, x1, y1) window to count the cells
+                        of instead of the whole grid (see queryWindow)
+      @return: A dictionary of class to number of cells
+      """
+      if window is None:
+         window = (0, 0, self.xSize, self.ySize)
+      self._checkWindow(*window)
+      values, areas = streeLeafAreas(self.data, window, 2**self.xOrder, 
+                                     2**self.yOrder)
+      return countValues(values, areas)
+   
    # ...........................
    def read(self, filename):
       with open(filename, 'rb') as f:
+         buf = f.read()
+      
+      if isPackedTree(buf, self.METHOD, self.VERSION):
+         self.xSize, self.ySize, flags, values = unpackTree(buf, 2)
+         self._findOrders()
+         
+         # The split direction at each depth is implied by the orders
+         splits = streeSplits(self.xOrder, self.yOrder)
+         self.data = streamsToTree(flags.tolist(), values.tolist(), 2, 
+                                   lambda depth: {'splitX': splits[depth]})
+      else:
+         # Older files only have the sizes and byte flags
+         f = StringIO(buf)
          self.xSize = struct.unpack('<l', f.read(4))[0]
          self.ySize = struct.unpack('<l', f.read(4))[0]
 
          self.data = unpackData(f)
+         self._findOrders()
    
    # ...........................
    def write(self, filename):
+      flags, values = treeToStreams(self.data, 2)[:2]
       with open(filename, 'wb') as f:
-         # write version
-         f.write(struct.pack('<l', self.xSize))
-         f.write(struct.pack('<l', self.ySize))
-         packData(self.data, f)
+         f.write(packTree(self.METHOD, self.VERSION, self.xSize, self.ySize, 
+                          flags, values))
 
 # .............................................................................
 def packData(data, f):
@@ -144,35 +221,36 @@ def packData(data, f):
 
 # .............................................................................
 def unpackData(f):
-   isInt = struct.unpack('<?', f.read(1))[0]
-   if isInt:
-      return struct.unpack('<B', f.read(1))[0]
-   else:
-      return {
-              'splitX' : struct.unpack('<?', f.read(1))[0],
-              1: unpackData(f),
-              2: unpackData(f)
-             }
+   """
+   @summary: Reads a tree written by packData.  The rest of the file is read 
+                at once and decoded without recursion
+   @param f: An open file positioned at the start of the tree
+   """
+   flags, values, splits = bytesToStreams(f.read(), hasSplits=True)
+   splits = iter(splits)
+   return streamsToTree(flags, values, 2, 
+                        lambda depth: {'splitX': splits.next()})
 
 # .............................................................................
 def streeCompress(mtx, xOrder, yOrder):
    """
    @summary: Performs s-tree compression (approximate)
-   @param mtx: List of lists
+   @param mtx: List of lists or 2-D NumPy array
    @param xOrder: 2**xOrder elements in each row
    @param yOrder: 2**yOrder rows
    """
-   minV = min([min(r) for r in mtx])
-   maxV = max([max(r) for r in mtx])
+   mtx = np.asarray(mtx)
+   minV = mtx.min()
+   maxV = mtx.max()
 
    if minV == maxV:
-      return minV
+      return int(minV)
    else:
       if xOrder > yOrder:
          return {
                  'splitX' : True,
-                 1: streeCompress([r[:2**(xOrder-1)] for r in mtx], xOrder-1, yOrder),
-                 2: streeCompress([r[2**(xOrder-1):] for r in mtx], xOrder-1, yOrder)
+                 1: streeCompress(mtx[:, :2**(xOrder-1)], xOrder-1, yOrder),
+                 2: streeCompress(mtx[:, 2**(xOrder-1):], xOrder-1, yOrder)
                 }
       else:
          return {
@@ -185,22 +263,189 @@ def streeCompress(mtx, xOrder, yOrder):
 def streeDecompress(cmpMtx, xSize, ySize):
    """
    @summary: Decompresses an s-tree compressed matrix
+   @param cmpMtx: The compressed matrix
+   @param xSize: The number of columns in the matrix, 2**xOrder
+   @param ySize: The number of rows in the matrix, 2**yOrder
+   @return: A 2-D NumPy array
+   """
+   minXs, minYs, widths, heights, values = streeLeafBlocks(cmpMtx, xSize, 
+                                                           ySize)
+   return fillBlocks(xSize, ySize, minXs, minYs, widths, heights, values)
+
+# .............................................................................
+def streeLeafBlocks(cmpMtx, xSize, ySize):
+   """
+   @summary: Finds the block covered by each leaf of an s-tree
+   @param cmpMtx: The compressed matrix
+   @param xSize: The number of columns in the matrix, 2**xOrder
+   @param ySize: The number of rows in the matrix, 2**yOrder
+   @return: Arrays with the left edge, top edge, width, height and value of
+               each leaf
+   """
+   minXs = []
+   minYs = []
+   widths = []
+   heights = []
+   values = []
+   
+   # Walk the tree one level at a time, collecting the leaf blocks
+   nodes = [cmpMtx]
+   nodeXs = np.zeros(1, dtype=np.int64)
+   nodeYs = np.zeros(1, dtype=np.int64)
+   nodeWs = np.full(1, xSize, dtype=np.int64)
+   nodeHs = np.full(1, ySize, dtype=np.int64)
+   with gcPaused():
+      while nodes:
+         isLeaf = np.array(map(isinstance, nodes, repeat(int, len(nodes))), 
+                           dtype=bool)
+         nodeArr = np.empty(len(nodes), dtype=object)
+         nodeArr[:] = nodes
+         nodes = nodeArr
+         minXs.append(nodeXs[isLeaf])
+         minYs.append(nodeYs[isLeaf])
+         widths.append(nodeWs[isLeaf])
+         heights.append(nodeHs[isLeaf])
+         values.append(nodes[isLeaf].tolist())
+      
+         # The children of the internal nodes make up the next level
+         internal = nodes[~isLeaf].tolist()
+         splitX = np.array(map(itemgetter('splitX'), internal), dtype=bool)
+         nodes = list(chain.from_iterable(map(itemgetter(1, 2), internal)))
+      
+         ws = np.where(splitX, nodeWs[~isLeaf] / 2, nodeWs[~isLeaf])
+         hs = np.where(splitX, nodeHs[~isLeaf], nodeHs[~isLeaf] / 2)
+         nodeXs = np.repeat(nodeXs[~isLeaf], 2)
+         nodeYs = np.repeat(nodeYs[~isLeaf], 2)
+         nodeXs[1::2] += np.where(splitX, ws, 0)
+         nodeYs[1::2] += np.where(splitX, 0, hs)
+         nodeWs = np.repeat(ws, 2)
+         nodeHs = np.repeat(hs, 2)
+   
+   return np.concatenate(minXs), np.concatenate(minYs), \
+          np.concatenate(widths), np.concatenate(heights), \
+          np.array(sum(values, []), dtype=np.int64)
+   
+# .............................................................................
+def streeQueryWindow(cmpMtx, ret, x0, y0, x1, y1, minX, minY, xSize, ySize):
+   """
+   @summary: Fills in the part of a window covered by an s-tree section
    @param cmpMtx: The compressed section of the matrix
+   @param ret: The 2-D array for the window to fill in
+   @param x0: The left edge of the window (inclusive)
+   @param y0: The top edge of the window (inclusive)
+   @param x1: The right edge of the window (exclusive)
+   @param y1: The bottom edge of the window (exclusive)
+   @param minX: The left edge of this section
+   @param minY: The top edge of this section
+   @param xSize: The number of columns in this section
+   @param ySize: The number of rows in this section
    """
+   # Find the part of the window covered by this section
+   iMinX = max(x0, minX)
+   iMinY = max(y0, minY)
+   iMaxX = min(x1, minX + xSize)
+   iMaxY = min(y1, minY + ySize)
+   if iMinX >= iMaxX or iMinY >= iMaxY:
+      return
+   
    if isinstance(cmpMtx, int):
-      return [[cmpMtx for i in xrange(xSize)] for j in xrange(ySize)]
+      ret[iMinY-y0:iMaxY-y0, iMinX-x0:iMaxX-x0] = cmpMtx
+   elif cmpMtx['splitX']:
+      l = xSize / 2
+      streeQueryWindow(cmpMtx[1], ret, x0, y0, x1, y1, minX, minY, l, ySize)
+      streeQueryWindow(cmpMtx[2], ret, x0, y0, x1, y1, minX + l, minY, l, 
+                       ySize)
    else:
-      ret = []
-      if cmpMtx['splitX']:
-         leftSide = streeDecompress(cmpMtx[1], xSize/2, ySize)
-         rightSide = streeDecompress(cmpMtx[2], xSize/2, ySize)
-         for i in xrange(ySize):
-            ret.append(leftSide[i] + rightSide[i])
+      l = ySize / 2
+      streeQueryWindow(cmpMtx[1], ret, x0, y0, x1, y1, minX, minY, xSize, l)
+      streeQueryWindow(cmpMtx[2], ret, x0, y0, x1, y1, minX, minY + l, xSize, 
+                       l)
+
+# .............................................................................
+def streeLeafAreas(cmpMtx, window, xSize, ySize):
+   """
+   @summary: Finds the number of cells of each leaf that are inside of a 
+                window
+   @param cmpMtx: The compressed matrix
+   @param window: An (x0, y0, x1, y1) window
+   @param xSize: The number of columns in the matrix, 2**xOrder
+   @param ySize: The number of rows in the matrix, 2**yOrder
+   @return: An array of leaf values and an array of the number of cells of 
+               each leaf in the window
+   """
+   x0, y0, x1, y1 = window
+   minXs, minYs, widths, heights, values = streeLeafBlocks(cmpMtx, xSize, 
+                                                           ySize)
+   ws = np.minimum(minXs + widths, x1) - np.maximum(minXs, x0)
+   hs = np.minimum(minYs + heights, y1) - np.maximum(minYs, y0)
+   return values, np.maximum(ws, 0) * np.maximum(hs, 0)
+
+# .............................................................................
+def streeSplits(xOrder, yOrder):
+   """
+   @summary: Returns whether streeCompress splits along x at each depth
+   @param xOrder: 2**xOrder elements in each row
+   @param yOrder: 2**yOrder rows
+   """
+   splits = []
+   while xOrder > 0 or yOrder > 0:
+      if xOrder > yOrder:
+         splits.append(True)
+         xOrder -= 1
       else:
-         ret = streeDecompress(cmpMtx[1], xSize, ySize/2)
-         ret.extend(streeDecompress(cmpMtx[2], xSize, ySize/2))
-      return ret
+         splits.append(False)
+         yOrder -= 1
+   return splits
+
+# .............................................................................
+def streeCodes(xs, ys, xOrder, yOrder):
+   """
+   @summary: Finds the position of points in the order that an s-tree stores 
+                its leaves.  The bits of the x and y coordinates are 
+                interleaved in the same order that streeCompress splits the 
+                grid
+   @param xs: An array of x coordinates
+   @param ys: An array of y coordinates, broadcast against xs
+   @param xOrder: 2**xOrder elements in each row
+   @param yOrder: 2**yOrder rows
+   """
+   xs = np.asarray(xs, dtype=np.int64)
+   ys = np.asarray(ys, dtype=np.int64)
+   codes = np.zeros(np.broadcast(xs, ys).shape, dtype=np.int64)
+   while xOrder > 0 or yOrder > 0:
+      if xOrder > yOrder:
+         xOrder -= 1
+         codes = (codes << 1) | ((xs >> xOrder) & 1)
+      else:
+         yOrder -= 1
+         codes = (codes << 1) | ((ys >> yOrder) & 1)
+   return codes
+
+# .............................................................................
+def streeQueryMany(cmpMtx, codes, vals, lo, hi, base, numCells):
+   """
+   @summary: Looks up sorted points in an s-tree section
+   @param cmpMtx: The compressed section of the matrix
+   @param codes: A sorted array of s-tree codes for the points (see 
+                    streeCodes)
+   @param vals: An array to fill in with the value of each point
+   @param lo: The index of the first point in this section
+   @param hi: The index after the last point in this section
+   @param base: The code of the first cell of this section
+   @param numCells: The number of cells in this section
+   """
+   if lo >= hi:
+      return
    
+   if isinstance(cmpMtx, int):
+      vals[lo:hi] = cmpMtx
+   else:
+      h = numCells / 2
+      # Split the points between the halves
+      split = lo + int(np.searchsorted(codes[lo:hi], base + h))
+      streeQueryMany(cmpMtx[1], codes, vals, lo, split, base, h)
+      streeQueryMany(cmpMtx[2], codes, vals, split, hi, base + h, h)
+
 # .............................................................................
 def test():
    data = [
@@ -0,0 +1,384 @@
+"""
+@summary: Module containing functions shared by the tree compression methods
+             for converting trees to and from a bit-packed file format
+@author: CJ Grady
+@version: 3.0
+@status: beta
+
+@license: gpl2
+@copyright: Copyright (C) 2014, University of Kansas Center for Research
+
+          Lifemapper Project, lifemapper [at] ku [dot] edu, 
+          Biodiversity Institute,
+          1345 Jayhawk Boulevard, Lawrence, Kansas, 66045, USA
+   
+          This program is free software; you can redistribute it and/or modify 
+          it under the terms of the GNU General Public License as published by 
+          the Free Software Foundation; either version 2 of the License, or (at 
+          your option) any later version.
+  
+          This program is distributed in the hope that it will be useful, but 
+          WITHOUT ANY WARRANTY; without even the implied warranty of 
+          MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU 
+          General Public License for more details.
+  
+          You should have received a copy of the GNU General Public License 
+          along with this program; if not, write to the Free Software 
+          Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 
+          02110-1301, USA.
+"""
+from contextlib import contextmanager
+import gc
+import numpy as np
+import struct
+
+from matrix.matrix import findDtype
+
+# Header for bit-packed tree files: method, version, x size, y size, number 
+#    of nodes, number of leaves, number of classes, depth of the node index
+TREE_HEADER = struct.Struct('<BfllLLLB')
+
+# .............................................................................
+@contextmanager
+def gcPaused():
+   """
+   @summary: Pauses garbage collection while a block runs.  Creating or 
+                walking the millions of nodes of a large tree would otherwise
+                trigger repeated collections that scan all of them, even 
+                though none of them can be collected
+   """
+   enabled = gc.isenabled()
+   gc.disable()
+   try:
+      yield
+   finally:
+      if enabled:
+         gc.enable()
+
+# .............................................................................
+def isPackedTree(buf, method, version):
+   """
+   @summary: Checks if a buffer holds a bit-packed tree.  Older tree files 
+                start with the x and y sizes and have no header
+   @param buf: The contents of the file
+   @param method: The method identifier of the tree class
+   @param version: The version of the bit-packed format
+   """
+   return len(buf) >= TREE_HEADER.size and \
+          struct.unpack_from('<Bf', buf) == (method, version)
+
+# .............................................................................
+def packTree(method, version, xSize, ySize, flags, values, indexDepth=0, 
+             index=None):
+   """
+   @summary: Packs a tree into a string.  The structure is stored with one bit
+                per node (1 for a leaf) and the leaf values are stored as
+                indices into a class table using as few bits as possible
+   @param method: The method identifier of the tree class
+   @param version: The version of the tree class
+   @param xSize: The number of columns in the grid
+   @param ySize: The number of rows in the grid
+   @param flags: A list of leaf flags for the nodes in pre-order
+   @param values: A list of the leaf values in pre-order
+   @param indexDepth: (optional) The depth of the node index, zero for none
+   @param index: (optional) The node index from treeToStreams
+   """
+   classes, ids = np.unique(np.asarray(values, dtype=np.int64), 
+                            return_inverse=True)
+   nBits = valueBits(len(classes))
+   
+   # Take the low nBits of each big-endian identifier
+   idBits = np.unpackbits(ids.astype('>u4').view(np.uint8).reshape(-1, 4), 
+                          axis=1)[:, 32 - nBits:]
+   
+   if indexDepth > 0:
+      indexStr = np.asarray(index, dtype='<u4').tobytes()
+   else:
+      indexStr = ''
+   
+   return ''.join([
+               TREE_HEADER.pack(method, version, xSize, ySize, len(flags), 
+                                len(values), len(classes), indexDepth),
+               struct.pack('<%sl' % len(classes), *classes.tolist()),
+               indexStr,
+               np.packbits(np.asarray(flags, dtype=np.uint8)).tobytes(),
+               np.packbits(idBits.ravel()).tobytes()
+              ])
+
+# .............................................................................
+def unpackTree(buf, numChildren):
+   """
+   @summary: Unpacks a tree packed with packTree
+   @param buf: The contents of the file
+   @param numChildren: The number of children of each internal node
+   @return: The x size, y size, an array of leaf flags for the nodes in 
+               pre-order and an array of the leaf values in pre-order
+   """
+   packed = PackedTree(buf, numChildren)
+   return packed.xSize, packed.ySize, \
+          packed.flags(0, packed.numNodes), packed.values(0, packed.numLeaves)
+
+# .............................................................................
+class PackedTree(object):
+   """
+   @summary: Provides access to the parts of a bit-packed tree without 
+                decoding all of it.  The buffer can be a string or a memory
+                mapped file
+   """
+   # ...........................
+   def __init__(self, buf, numChildren):
+      """
+      @summary: Constructor
+      @param buf: A string or memory map holding a tree packed with packTree
+      @param numChildren: The number of children of each internal node, used
+                             to size the node index
+      """
+      self.buf = buf
+      (method, version, self.xSize, self.ySize, self.numNodes, self.numLeaves,
+       numClasses, self.indexDepth) = TREE_HEADER.unpack_from(buf)
+      pos = TREE_HEADER.size
+      self.classes = np.frombuffer(buf, dtype='<i4', count=numClasses, 
+                                   offset=pos)
+      self.nBits = valueBits(numClasses)
+      pos += 4 * numClasses
+      
+      self.index = None
+      if self.indexDepth > 0:
+         numCells = numChildren**self.indexDepth
+         self.index = np.frombuffer(buf, dtype='<u4', count=2 * numCells, 
+                                    offset=pos).reshape(numCells, 2)
+         pos += 8 * numCells
+      
+      self.flagsPos = pos
+      self.valuesPos = pos + (self.numNodes + 7) / 8
+
+   # ...........................
+   def flags(self, first, last):
+      """
+      @summary: Returns the leaf flags of the nodes from first up to last
+      """
+      return self._bits(self.flagsPos, first, last)
+
+   # ...........................
+   def values(self, first, last):
+      """
+      @summary: Returns the values of the leaves from first up to last
+      """
+      if self.nBits == 0:
+         return self.classes[np.zeros(last - first, dtype=np.int64)]
+      idBits = self._bits(self.valuesPos, first * self.nBits, 
+                          last * self.nBits)
+      ids = idBits.reshape(last - first, self.nBits).dot(
+                  1 << np.arange(self.nBits - 1, -1, -1, dtype=np.int64))
+      return self.classes[ids]
+
+   # ...........................
+   def tree(self, numChildren, newNode=None):
+      """
+      @summary: Decodes the whole tree
+      @param numChildren: The number of children of each internal node
+      @param newNode: (optional) See streamsToTree
+      """
+      return streamsToTree(self.flags(0, self.numNodes).tolist(), 
+                           self.values(0, self.numLeaves).tolist(), 
+                           numChildren, newNode=newNode)
+
+   # ...........................
+   def subtree(self, cell, numChildren, newNode=None):
+      """
+      @summary: Decodes the subtree covering one cell of the node index.  The
+                   cell may be covered by a leaf higher up in the tree, in 
+                   which case the value of that leaf is returned
+      @param cell: The position of the cell at the index depth in tree order
+      @param numChildren: The number of children of each internal node
+      @param newNode: (optional) See streamsToTree
+      """
+      firstNode, firstLeaf = self.index[cell].tolist()
+      
+      # The subtree ends before the next subtree starts, but internal nodes
+      #    above the index depth may come in between
+      nxt = np.searchsorted(self.index[:, 0], firstNode, side='right')
+      if nxt < len(self.index):
+         lastNode, lastLeaf = self.index[nxt].tolist()
+      else:
+         lastNode, lastLeaf = self.numNodes, self.numLeaves
+      
+      return streamsToTree(self.flags(firstNode, lastNode).tolist(), 
+                           self.values(firstLeaf, lastLeaf).tolist(), 
+                           numChildren, newNode=newNode)
+
+   # ...........................
+   def _bits(self, pos, first, last):
+      """
+      @summary: Unpacks the bits from first up to last of the bit stream 
+                   starting at byte pos
+      """
+      start = first / 8
+      end = (last + 7) / 8
+      bits = np.unpackbits(np.frombuffer(self.buf, dtype=np.uint8, 
+                                         count=end - start, offset=pos + start))
+      return bits[first - 8 * start:last - 8 * start]
+
+# .............................................................................
+def valueBits(numClasses):
+   """
+   @summary: Returns the number of bits needed to store a class index
+   @param numClasses: The number of distinct classes
+   """
+   return max(numClasses - 1, 0).bit_length()
+
+# .............................................................................
+def treeToStreams(data, numChildren, indexDepth=0):
+   """
+   @summary: Walks a tree of nested dictionaries in pre-order
+   @param data: The tree, leaves are integers and internal nodes have their 
+                   children under the keys 1 to numChildren
+   @param numChildren: The number of children of each internal node
+   @param indexDepth: (optional) If greater than zero, also build an index of
+                         where the subtree covering each cell at this depth 
+                         starts
+   @return: A list of leaf flags (1 for a leaf, 0 for an internal node), a
+               list of leaf values and the index.  The index has a row for 
+               each of the numChildren**indexDepth cells, in tree order, 
+               with the position of the first node and first leaf of the 
+               subtree covering the cell
+   """
+   flags = []
+   values = []
+   index = []
+   stack = [(data, 0)]
+   while stack:
+      node, depth = stack.pop()
+      if depth <= indexDepth and (depth == indexDepth or 
+                                  isinstance(node, int)):
+         # This node covers one or more whole index cells
+         index.extend([(len(flags), len(values))] * 
+                                     numChildren**(indexDepth - depth))
+      if isinstance(node, int):
+         flags.append(1)
+         values.append(node)
+      else:
+         flags.append(0)
+         stack.extend([(node[k], depth + 1) 
+                                    for k in xrange(numChildren, 0, -1)])
+   return flags, values, index
+
+# .............................................................................
+def bytesToStreams(buf, hasSplits=False):
+   """
+   @summary: Decodes a tree in the older byte-per-flag format.  Each node 
+                starts with a leaf flag byte.  Leaves are followed by a value 
+                byte and, if hasSplits is True, internal nodes are followed by
+                a split direction byte
+   @param buf: A string holding the tree
+   @param hasSplits: (optional) Internal nodes have a split direction byte
+   @return: A list of leaf flags, a list of leaf values and a list of split 
+               directions for the internal nodes, all in pre-order
+   """
+   data = np.frombuffer(buf, dtype=np.uint8).tolist()
+   flags = []
+   values = []
+   splits = []
+   pos = 0
+   numOpen = 1
+   # Stop once every node has been read
+   while numOpen > 0:
+      flag = data[pos]
+      flags.append(flag)
+      if flag:
+         values.append(data[pos + 1])
+         numOpen -= 1
+      else:
+         if hasSplits:
+            splits.append(bool(data[pos + 1]))
+         numOpen += 1 if hasSplits else 3
+      pos += 2 if (flag or hasSplits) else 1
+   return flags, values, splits
+
+# .............................................................................
+def streamsToTree(flags, values, numChildren, newNode=None):
+   """
+   @summary: Rebuilds a tree of nested dictionaries from its pre-order leaf 
+                flags and leaf values.  Flags and values after the end of the
+                tree are ignored
+   @param flags: A list of leaf flags (1 for a leaf, 0 for an internal node)
+   @param values: A list of leaf values
+   @param numChildren: The number of children of each internal node
+   @param newNode: (optional) A function that takes the depth of an internal 
+                      node and returns a new dictionary for it
+   """
+   if newNode is None:
+      newNode = lambda depth: {}
+   
+   values = iter(values)
+   if flags[0]:
+      return values.next()
+   
+   with gcPaused():
+      root = newNode(0)
+      # Each stack entry is a node, its depth and the key of its next child
+      stack = [[root, 0, 1]]
+      for flag in flags[1:]:
+         if not stack:
+            break
+         top = stack[-1]
+         if flag:
+            top[0][top[2]] = values.next()
+         else:
+            child = newNode(top[1] + 1)
+            top[0][top[2]] = child
+         top[2] += 1
+         if top[2] > numChildren:
+            stack.pop()
+            # Close the ancestors that have all of their children
+            while stack and stack[-1][2] > numChildren:
+               stack.pop()
+         if not flag:
+            stack.append([child, top[1] + 1, 1])
+   return root
+
+# .............................................................................
+def fillBlocks(xSize, ySize, minXs, minYs, widths, heights, values):
+   """
+   @summary: Creates an array from a set of uniform rectangular blocks.  Blocks
+                with the same shape are filled together with fancy indexing
+                and large blocks are filled with slices
+   @param xSize: The number of columns in the array
+   @param ySize: The number of rows in the array
+   @param minXs: An array with the left edge of each block
+   @param minYs: An array with the top edge of each block
+   @param widths: An array with the width of each block
+   @param heights: An array with the height of each block
+   @param values: An array with the value of each block
+   """
+   minXs = np.asarray(minXs, dtype=np.int64)
+   minYs = np.asarray(minYs, dtype=np.int64)
+   widths = np.asarray(widths, dtype=np.int64)
+   heights = np.asarray(heights, dtype=np.int64)
+   values = np.asarray(values)
+   
+   dt = np.int64
+   if values.size > 0:
+      dt = findDtype(values.min(), values.max())
+   ret = np.zeros((ySize, xSize), dtype=dt)
+   
+   shapes, inverse = np.unique(widths * (ySize + 1) + heights, 
+                               return_inverse=True)
+   for i in xrange(len(shapes)):
+      idxs = np.flatnonzero(inverse == i)
+      w = int(widths[idxs[0]])
+      h = int(heights[idxs[0]])
+      if w * h >= 64:
+         for x, y, v in zip(minXs[idxs].tolist(), minYs[idxs].tolist(), 
+                            values[idxs].tolist()):
+            ret[y:y+h, x:x+w] = v
+      else:
+         # Limit the size of the index arrays
+         step = max(1, 2**20 / (w * h))
+         for j in xrange(0, len(idxs), step):
+            chunk = idxs[j:j+step]
+            ret[minYs[chunk, np.newaxis, np.newaxis] + 
+                                       np.arange(h)[:, np.newaxis], 
+                minXs[chunk, np.newaxis, np.newaxis] + np.arange(w)] = \
+                                    values[chunk, np.newaxis, np.newaxis]
+   return ret
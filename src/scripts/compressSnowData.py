@@ -28,14 +28,19 @@
 """
 import os
 from matrix.matrix import Grid
-from methods.combo.quadTreeCombo import QuadtreeComboCompressedGrid
+from methods.combo.comboBase import MIXED_METHODS
+from methods.combo.quadTreeCombo import QuadtreeComboCompressedGrid, \
+                                         QuadtreeComboSweep
+from methods.combo.sTreeCombo import STreeComboCompressedGrid
 
 from methods.rle.hilbert import HilbertRLECompressedGrid
+from methods.rle.morton import MortonRLECompressedGrid
 from methods.rle.normal import NormalRLECompressedGrid
 
 INPUT_FN = '../../data/snow2.txt'
 HILB_OUTPUT_FN = '../../data/snow2-2.hilb'
 NORM_OUTPUT_FN = '../../data/snow2-2.rle'
+MORT_OUTPUT_FN = '../../data/snow2-2.mort'
 OUT_DIR = '../../data/'
 
 # .............................................................................
@@ -54,24 +59,35 @@ if __name__ == "__main__":
       # Feed into compression
       cmp1 = NormalRLECompressedGrid(grid=grid)
       cmp2 = HilbertRLECompressedGrid(grid=grid)
-      cmp3 = QuadtreeComboCompressedGrid(NormalRLECompressedGrid, orderThreshold=6, grid=grid)
-      cmp4 = QuadtreeComboCompressedGrid(HilbertRLECompressedGrid, orderThreshold=6, grid=grid)
-      cmp5 = QuadtreeComboCompressedGrid(NormalRLECompressedGrid, orderThreshold=8, grid=grid)
-      cmp6 = QuadtreeComboCompressedGrid(HilbertRLECompressedGrid, orderThreshold=8, grid=grid)
-      cmp7 = QuadtreeComboCompressedGrid(NormalRLECompressedGrid, orderThreshold=10, grid=grid)
-      cmp8 = QuadtreeComboCompressedGrid(HilbertRLECompressedGrid, orderThreshold=10, grid=grid)
-      cmp9 = QuadtreeComboCompressedGrid(NormalRLECompressedGrid, orderThreshold=2, grid=grid)
-      cmp10 = QuadtreeComboCompressedGrid(HilbertRLECompressedGrid, orderThreshold=2, grid=grid)
-      cmp11 = QuadtreeComboCompressedGrid(NormalRLECompressedGrid, orderThreshold=4, grid=grid)
-      cmp12 = QuadtreeComboCompressedGrid(HilbertRLECompressedGrid, orderThreshold=4, grid=grid)
-      cmp13 = QuadtreeComboCompressedGrid(NormalRLECompressedGrid, orderThreshold=12, grid=grid)
-      cmp14 = QuadtreeComboCompressedGrid(HilbertRLECompressedGrid, orderThreshold=12, grid=grid)
-      cmp15 = QuadtreeComboCompressedGrid(NormalRLECompressedGrid, orderThreshold=14, grid=grid)
-      cmp16 = QuadtreeComboCompressedGrid(HilbertRLECompressedGrid, orderThreshold=14, grid=grid)
+      
+      # Build the quadtree once and cut it for each threshold
+      sweep = QuadtreeComboSweep(grid)
+      cmp3 = sweep.compress(NormalRLECompressedGrid, orderThreshold=6)
+      cmp4 = sweep.compress(HilbertRLECompressedGrid, orderThreshold=6)
+      cmp5 = sweep.compress(NormalRLECompressedGrid, orderThreshold=8)
+      cmp6 = sweep.compress(HilbertRLECompressedGrid, orderThreshold=8)
+      cmp7 = sweep.compress(NormalRLECompressedGrid, orderThreshold=10)
+      cmp8 = sweep.compress(HilbertRLECompressedGrid, orderThreshold=10)
+      cmp9 = sweep.compress(NormalRLECompressedGrid, orderThreshold=2)
+      cmp10 = sweep.compress(HilbertRLECompressedGrid, orderThreshold=2)
+      cmp11 = sweep.compress(NormalRLECompressedGrid, orderThreshold=4)
+      cmp12 = sweep.compress(HilbertRLECompressedGrid, orderThreshold=4)
+      cmp13 = sweep.compress(NormalRLECompressedGrid, orderThreshold=12)
+      cmp14 = sweep.compress(HilbertRLECompressedGrid, orderThreshold=12)
+      cmp15 = sweep.compress(NormalRLECompressedGrid, orderThreshold=14)
+      cmp16 = sweep.compress(HilbertRLECompressedGrid, orderThreshold=14)
+      cmp17 = MortonRLECompressedGrid(grid=grid)
+      cmp18 = QuadtreeComboCompressedGrid(HilbertRLECompressedGrid, 
+                                          orderThreshold='auto', grid=grid)
+      cmp19 = QuadtreeComboCompressedGrid(MIXED_METHODS, orderThreshold='auto',
+                                          grid=grid)
+      cmp20 = STreeComboCompressedGrid(HilbertRLECompressedGrid, 
+                                       orderThreshold=8, grid=grid)
       
       # Write out compressed data      
       cmp1.write(NORM_OUTPUT_FN)
       cmp2.write(HILB_OUTPUT_FN)
+      cmp17.write(MORT_OUTPUT_FN)
       
       # Combo tests
       cmp3.write(os.path.join(OUT_DIR, 'snow2-combo-normal-6.bin'))
@@ -88,6 +104,9 @@ if __name__ == "__main__":
       cmp14.write(os.path.join(OUT_DIR, 'snow2-combo-hilb-12.bin'))
       cmp15.write(os.path.join(OUT_DIR, 'snow2-combo-normal-14.bin'))
       cmp16.write(os.path.join(OUT_DIR, 'snow2-combo-hilb-14.bin'))
+      cmp18.write(os.path.join(OUT_DIR, 'snow2-combo-hilb-auto.bin'))
+      cmp19.write(os.path.join(OUT_DIR, 'snow2-combo-mixed-auto.bin'))
+      cmp20.write(os.path.join(OUT_DIR, 'snow2-stree-combo-hilb-8.bin'))
       
    else:
       print "File %s does not exist" % INPUT_FN